@@ -5,13 +5,14 @@
 # AUTHOR:       Collin Bode, UC Berkeley
 #               based on ssr_lidar.py
 # PURPOSE:
-# 	1. Accept xyz unfiltered LiDAR files and import them into GRASS gis as
-#          raster tiles.  Uses max value (elevation) for aggregation.
-# 	2. Merge tiles into single raster and delete tiles.
+# 	1. Accept xyz unfiltered LiDAR files and bin them on the region cells in
+#          one pass (ssr_points.py).  Uses max value (elevation) for aggregation,
+#          or any of the per cell statistics in pstats (count, min, mean, p95, p99...).
+# 	2. Merge tiles into single raster as they are read, no tile rasters.
 #       NOTE: this is intended to be a standalone script. It does not use the
 #       parameter file from ssr.
 #
-# DEPENDENCIES: ssr_utilities.py
+# DEPENDENCIES: ssr_points.py (numpy only)
 #
 # COPYRIGHT:    (c) 2015 Collin Bode
 #		(c) 2006 Hamish Bowman, and the GRASS Development Team
@@ -58,6 +59,7 @@ inSuffix='xyz'                          # filename suffix to filter for
 sep = ','				# separator in lidar files ' ' or ','
 overlap = float(0.00)			# tile overlap in meters
 pmaxpref = 'pmax_c'+str(C)+year		# prefix to the point rasters
+pstats = ['max']                        # per cell statistics: 'n','min','max','mean','p95','p99'. Rasters pmax,pmean,p95... +'_c'+C+year+pref
 
 #----------------------------------------------------------------------------
 # MAP NAMES
@@ -81,10 +83,14 @@ import datetime as dt
 gisdbase = os.path.abspath(gisdbase)
 os.environ['GISBASE'] = gisbase
 sys.path.append(os.path.join(os.environ['GISBASE'], "etc", "python"))
+import numpy
 import grass.script as grass
 import grass.script.setup as gsetup
-# ssr_utilities must go after grass.script imports
-#from ssr_utilities import *
+import grass.script.array as garray
+from ssr_points import mosaic_tiles, stat_prefix
+
+# null value used to pass NaN cells through r.in.bin / r.out.bin (as ssr_utilities.py)
+nullval = -9999.0
 
 def printout(str_text,lf):
     timestamp = dt.datetime.strftime(dt.datetime.now(),"%H:%M:%S")
@@ -108,6 +114,19 @@ def mapset_gotocreate(mapset,bregion,C,lf):
         printout("Mapset didn't exist. Created then changed mapsets to "+mapset,lf)
     set_region(bregion,C)
 
+def raster_new():
+    # NaN (null) filled float32 array over the current region, memory mapped to a GRASS temp file
+    a = garray.array(dtype=numpy.float32)
+    a.fill(numpy.nan)
+    return a
+
+def raster_write(data,raster,ow):
+    # write a float32 array from raster_new() (NaN = null) as FCELL raster, in place
+    for row in range(0,data.shape[0],1024):
+        strip = data[row:row+1024]
+        strip[numpy.isnan(strip)] = nullval
+    data.write(raster,null=nullval,overwrite=ow)
+
 def set_region(bregion,C):
     # remove g.region for normal runs
     if(bregion == "default"):
@@ -143,7 +162,8 @@ def main():
     printout('LPI mapset: '+mlpi,lf)
     printout("Point Cloud Path: "+inPath,lf)
     printout("Point Cloud ",lf)
-    printout("Point Cloud File Prefix: "+pmaxpref,lf)
+    printout("Point Cloud File Prefix: <stat>_c"+str(C)+year,lf)
+    printout("Point Cloud Cell Statistics: "+','.join(pstats),lf)
     printout("Point Cloud File Suffix: "+inSuffix,lf)
     printout("Point Cloud File Separator: "+sep,lf)
     printout("Point Cloud Tile Overlap (meters): "+str(overlap),lf)
@@ -158,65 +178,28 @@ def main():
     mapset_gotocreate(mlpi,'default',C,lf)
 
     #################################################
-    patch_list = ''
-    i = 0
-    for strFile in os.listdir(inPath):
-        printout("checking "+strFile,lf)
+    # One pass over each tile (ssr_points.mosaic_tiles), all of pstats binned in that pass.
+    # Tiles are clipped and written straight into region sized, memory mapped mosaics (first tile wins, as r.patch).
+    reg = grass.region()
+    frames = [(reg['n'],reg['w'],(reg['nsres'],reg['ewres']))]
+    tiles = []
+    for strFile in sorted(os.listdir(inPath)):
         t = strFile.split('.')
-	#printout("t[0]="+t[0]+", t[1] = "+t[1],lf)
         if(len(t) > 1 and t[1] == inSuffix):
-            tile=t[0]
-            fstart = dt.datetime.now()
-            printout("Importing: "+strFile+" as "+tile,lf)
-            # n=4399092 s=4396972 e=446782 w=444662 b=365 t=754
-            str_boundary = grass.read_command("r.in.xyz", flags = "sg", input = inPath+strFile, fs = sep, output = "temp")
-            printout("boundary: "+str_boundary,lf)
-            boundary = str_boundary.split(' ')
-            tn = (boundary[0].split('='))[1]
-            ts = (boundary[1].split('='))[1]
-            te = (boundary[2].split('='))[1]
-            tw = (boundary[3].split('='))[1]
-            tb = (boundary[4].split('='))[1]
-            tt = (boundary[5].split('='))[1]
-            grass.run_command("g.region", overwrite = "true", n=tn, s=ts, e=te, w=tw, b=tb, t=tt)
-            printout("set region to boundary",lf)
-            grass.run_command("r.in.xyz", overwrite = "true", input = inPath+strFile, output = tile,type="FCELL", fs= sep, method="max")
-            printout("r.in.xyz import finished for "+tile,lf)
-            
-            # clip tile, remove overlap
-            otn = float(tn) - overlap
-            ots = float(ts) + overlap
-            ote = float(te) - overlap
-            otw = float(tw) + overlap
-            grass.run_command("g.region", n = otn, s = ots, w = otw, e = ote)
-            printout("set region to clip",lf)
-            
-            ctile = 'c'+tile
-            grass.run_command("g.rename",rast=tile+","+ctile)
-            #grass.run_command("r.mapcalc", overwrite = "true", expression = ctile+" = "+tile)
-            #printout("clipped "+tile,lf)
-
-	    # delete unclipped tile
-            #grass.run_command("g.remove", flags = "f", rast = tile)
-            #printout("deleted unclipped tile, "+tile,lf)
-            
-            # append list of tiles to merge
-            if(i == 0):
-                patch_list = ctile
-            else:
-                patch_list += ","+ctile
-            i = i + 1
-            printout("Finished importing XYZ tiles!",lf)
+            tiles.append((inPath+strFile,t[0],['all']))
+    mosaics = {}
+    for stat in pstats:
+        mosaics[('all',0,stat)] = raster_new()
+    fstart = dt.datetime.now()
+    for n,(tilepath,tile,grids) in enumerate(mosaic_tiles(mosaics,tiles,frames,sep,overlap=overlap)):
+        printout("Imported: "+tilepath+" as "+tile+", "+str(n+1)+" of "+str(len(tiles))+" in "+str(dt.datetime.now() - fstart),lf)
+    printout("Finished importing XYZ tiles!",lf)
                 
-    # Mosaic all the tiles into one map
-    printout("Mosaic all tiles into one map",lf)
-    grass.run_command("g.region", flags = "d") # go back to default mapset
-    pointdensity = pmaxpref+pref
-    grass.run_command("r.patch", overwrite = "true", input = patch_list, output= pointdensity)
-    # Delete the clipped tiles, leaving only a completed point densitymap
-    ctile_list = patch_list.split(',')
-    for ctile in ctile_list:
-        grass.run_command("g.remove", flags = "f", rast = ctile)
+    for stat in pstats:
+        pointraster = stat_prefix(stat)+'_c'+str(C)+year+pref
+        raster_write(mosaics[('all',0,stat)],pointraster,"true")
+        del mosaics[('all',0,stat)]
+        printout("Created "+pointraster,lf)
     printout("Done with "+pref,lf)
     
     
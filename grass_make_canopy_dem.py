@@ -6,12 +6,14 @@
 #               based on ssr_lidar.py
 # PURPOSE:
 # 	1. Accept xyz unfiltered LiDAR files and import them into GRASS gis as
-#          raster tiles.  Uses max value (elevation) for aggregation.
+#          raster tiles.  Uses max value (elevation) for aggregation, or any of
+#          the per cell statistics in pstats (count, min, mean, p95, p99...).
+#          .las/.laz tiles are read once from inPath and split by classification.
 # 	2. Merge tiles into single raster and delete tiles.
 #       NOTE: this is intended to be a standalone script. It does not use the
 #       parameter file from ssr.
 #
-# DEPENDENCIES: ssr_utilities.py
+# DEPENDENCIES: ssr_utilities.py, ssr_points.py
 #
 # COPYRIGHT:    (c) 2015 Collin Bode
 #		(c) 2006 Hamish Bowman, and the GRASS Development Team
@@ -55,7 +57,7 @@ cansource = 'angelo20141mcan'
 # LiDAR downloaded from http://opentopography.org.
 # National Center for Airborne Laser Mapping (NCALM) distributes laser hits as 2 datasets:  total and ground filtered.
 year = 'y14'	        # Year the LiDAR was flown 2004 'y04', 2004 modified to match y09 'ym4',2009 'y09'
-if((year == 'y14'):
+if(year == 'y14'):
     inPath='/data/source/LiDAR/2014_EelBathymetry_LiDAR/Angelo/Tiles_ASCII_xyz/'
     LidarPoints = [ 'filtered' , 'unfiltered' ]
 elif(year == 'y09'):
@@ -64,10 +66,12 @@ elif(year == 'y09'):
 else: # year == 'y04' or 'ym4' 
     inPath='/data/source/LiDAR/2004_SFEel_LiDAR/TerraScan_EEL/laser_export/'
     LidarPoints = [ 'ground' , 'all' ]
-inSuffix='xyz'                          # filename suffix to filter for
+inSuffix='xyz'                          # filename suffix to filter for: 'xyz' in LidarPoints subdirectories, 'las'/'laz' in inPath
 sep = ','				# separator in lidar files ' ' or ','
 overlap = 10.00				# tile overlap in meters
+pointcache = gisdbase+'/ssr_pointcache'  # binary copy of the point files, '' = no cache
 pmaxpref = 'pmax_c'+str(C)+year	# prefix to the point density rasters
+pstats = ['max']                        # per cell statistics: 'n','min','max','mean','p95','p99'. Rasters pmax,pmean,p95... +'_c'+C+year
 
 #----------------------------------------------------------------------------
 # MAP NAMES
@@ -102,6 +106,7 @@ import grass.script as grass
 import grass.script.setup as gsetup
 # ssr_utilities must go after grass.script imports
 from ssr_utilities import *
+from ssr_points import *
 
 def main():
     gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
@@ -118,12 +123,14 @@ def main():
     printout('pref: '+pref,lf)
     printout('LPI mapset: '+mlpi,lf)
     printout("Point Cloud Path: "+inPath,lf)
-    printout("Point Cloud Ground,Total Directories: "+LidarPoints,lf)
+    printout("Point Cloud Ground,Total Directories: "+','.join(LidarPoints),lf)
     printout("Point Cloud ",lf)
-    printout("Point Cloud File Prefix: "+density_pref,lf)
+    printout("Point Cloud File Prefix: <stat>_c"+str(C)+year,lf)
+    printout("Point Cloud Cell Statistics: "+','.join(pstats),lf)
     printout("Point Cloud File Suffix: "+inSuffix,lf)
     printout("Point Cloud File Separator: "+sep,lf)
-    printout("Point Cloud Tile Overlap (meters): "+overlap,lf)
+    printout("Point Cloud Tile Overlap (meters): "+str(overlap),lf)
+    printout("Point Cache: "+pointcache,lf)
 
     printout('_________________________________',lf)
 	
@@ -134,57 +141,27 @@ def main():
     # Mapset and Region Defined
     mapset_gotocreate(mlpi,'default',C,lf)
 
+    reg = grass.region()    # tiles are binned on cells aligned to this region
+
     #################################################
+    # One pass over each tile (ssr_points.mosaic_tiles). A .las tile fills both point classes in the same read.
+    # Every statistic in pstats is binned in that pass. Tiles are clipped and written straight
+    # into region sized, memory mapped mosaics.
+    frames = [(reg['n'],reg['w'],(reg['nsres'],reg['ewres']))]
+    mosaics = {}
     for pref in LidarPoints:
-        i = 0
-        inDir = inPath+pref+"//"
-        for strFile in os.listdir(inDir):
-            #print "checking "+strFile
-            t = strFile.split('.')
-            if(len(t) > 1 and t[1] == inSuffix):
-                tile=t[0]
-                fstart = dt.datetime.now()
-                printout("Importing: "+strFile+" as "+tile,lf)
-                # n=4399092 s=4396972 e=446782 w=444662 b=365 t=754
-                str_boundary = grass.read_command("r.in.xyz", flags = "sg", input = inDir+strFile, fs = sep, output = "temp")
-                boundary = str_boundary.split(' ')
-                tn = (boundary[0].split('='))[1]
-                ts = (boundary[1].split('='))[1]
-                te = (boundary[2].split('='))[1]
-                tw = (boundary[3].split('='))[1]
-                tb = (boundary[4].split('='))[1]
-                tt = (boundary[5].split('='))[1]
-                grass.run_command("g.region", overwrite = "true", n=tn, s=ts, e=te, w=tw, b=tb, t=tt)
-                grass.run_command("r.in.xyz", overwrite = "true", input = inDir+strFile, output = tile,type="FCELL", fs= sep, method="n")
-                
-                # clip tile, remove overlap
-                otn = float(tn) - overlap
-                ots = float(ts) + overlap
-                ote = float(te) - overlap
-                otw = float(tw) + overlap
-                grass.run_command("g.region", n = otn, s = ots, w = otw, e = ote)
-                
-                ctile = 'c'+tile
-                grass.run_command("r.mapcalc", overwrite = "true", expression = ctile+" = float("+tile+")")
-                grass.run_command("g.remove", flags = "f", rast = tile)
-                
-                # append list of tiles to merge
-                if(i == 0):
-                    patch_list = ctile
-                else:
-                    patch_list += ","+ctile
-                i += 1
-                
-        # Mosaic all the tiles into one map
-        grass.run_command("g.region", flags = "d") # go back to default mapset
-        pointdensity = pmaxpref+pref
-        grass.run_command("r.patch", overwrite = "true", input = patch_list, output= pointdensity)
-        
-        # Delete the clipped tiles, leaving only a completed point densitymap
-        ctile_list = patch_list.split(',')
-        for ctile in ctile_list:
-            grass.run_command("g.remove", flags = "f", rast = ctile)
+        for stat in pstats:
+            mosaics[(pref,0,stat)] = raster_new()
+    tiles = point_tiles(inPath,inSuffix,LidarPoints)
+    for tilepath,tile,grids in mosaic_tiles(mosaics,tiles,frames,sep,overlap=overlap,cachedir=pointcache):
+        printout("Imported: "+tilepath+" as "+tile,lf)
             
+    for pref in LidarPoints:
+        for stat in pstats:
+            pointraster = stat_prefix(stat)+'_c'+str(C)+year+pref
+            raster_write(mosaics[(pref,0,stat)],pointraster,"true")
+            del mosaics[(pref,0,stat)]
+            printout("Created "+pointraster,lf)
         printout("Done with "+pref,lf)
     
     
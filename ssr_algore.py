@@ -14,6 +14,10 @@
 #               Migrated to unified parameter set.
 #               Simplified all the tweaks: JuneLPI kept, removed normalization for LPI
 #               R.sun calibration now serparated from algorithm ("HalfDiff")
+#               Each week is one pass in numpy (algore_week): the r.sun and LPI
+#               rasters are read once, the algorithm, maxheight mask and merge
+#               are done in memory in strips of rows, and only the SSR raster is
+#               written. keeptemp also writes the intermediate rasters.
 #
 # COPYRIGHT:    (c) 2011 Collin Bode
 #		(c) 2006 Hamish Bowman, and the GRASS Development Team
@@ -30,6 +34,8 @@ global gisbase
 global gisdbase
 
 # MODULES
+import numpy
+
 # GRASS & SSR environment setup for external use
 from ssr_params import *
 import os
@@ -43,6 +49,38 @@ import grass.script.setup as gsetup
 from ssr_utilities import *
 
 
+def algore_week(lpi,beam,diff,canbeam,candiff,veg):
+    # one strip of a week, float64 arrays, NaN = null (as r.mapcalc, any null input gives null).
+    # Returns the SSR and the intermediate maps by their name prefix.
+    with numpy.errstate(invalid='ignore'):
+        #1. SUBCANOPY Merge LPI and Bare-earth by Algorithm
+        if(algore == 'cl'): # 'cl' Cameau Linear regression
+            lpidiff = 0.94 * lpi * diff
+            lpibeam = beam * lpi
+        elif(algore == 'cn'): # 'cn' Cameau Normalized - assumes halfdiff is set to True
+            lpidiff = 0.94 * (1.428 * lpi) * diff
+            lpibeam = 1.428 * beam * lpi
+        elif(algore == 'gn'): #gn Diffuse Gendron Linear Normalized. y =  0.01719 + 1.024 * nLPI 
+            lpidiff = 0.01719 + 1.024 * (1.428 * lpi) * diff
+            lpibeam = (1.428 * lpi) * beam
+        elif(algore == 'gl'): #gl Diffuse Gendron Linear NON-normalized y =  0.01719 + 1.024 * LPI 
+            lpidiff = 0.01719 + 1.024 * lpi * diff
+            lpibeam = lpi * beam
+        else:   # 'pl' power law
+            lpidiff = 1.1224 * (lpi ** 0.3157) * diff
+            lpibeam = 1.2567 * beam * lpi
+        subcanopy = lpibeam + lpidiff
+
+        #2. OPEN CANOPY: Remove areas under tall trees (maxheight meters or higher), set to -88
+        canglob = canbeam + candiff
+        opencanopy = numpy.where(veg < float(maxheight), canglob, -88.0)
+        opencanopy[numpy.isnan(veg)] = numpy.nan
+
+        #3. Merge lpi*bare-earth with cleaned canopy, keeping whichever is higher (null if either is)
+        ssr = numpy.maximum(opencanopy, subcanopy)
+    return ssr,{'subbeam':lpibeam,'subdiff':lpidiff,'subcanopy':subcanopy,'canglob':canglob,'opencanopy':opencanopy}
+
+
 def main():
     gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
     # Algorithms for combining Diffuse and Direct
@@ -83,6 +121,10 @@ def main():
     # Goto Correct Mapset and make sure Region is correctly set (ssr_utilities)
     mapset_gotocreate(mssr,bregion,C,lf)
 
+    # Vegetation height and the LPI rasters are read once, LPI by the months that use it
+    veg = raster_load(vegheight+'@PERMANENT')
+    lpis = {}
+
     # For each week 
     for doyn in range(5,366,7):
         doy = str(doyn).zfill(3)
@@ -96,59 +138,48 @@ def main():
         demdiff = sundem + doy + 'diff@'+msun
         canbeam = suncan + doy + 'beam@'+msun
         candiff = suncan + doy + 'diff@'+msun
-        canglob = suncan + doy + 'glob'
-        veg = vegheight+'@PERMANENT'
-        lpi = lpipref + 'm'+ month + '@' + mlpi   # lpi_c30y14s17m01
+        # Months share the LPI raster of their weight, lpi_month_weights (ssr_params)
+        lpi = lpi_month(int(month)) + '@' + mlpi   # lpi_c30y14s17w1
         if(lpivsjune == True):
-            lpi = lpipref + '06@' + mlpi
+            lpi = lpi_month(6) + '@' + mlpi
+        if(lpi not in lpis):
+            lpis[lpi] = raster_load(lpi)
             
         # Output Raster Layers
         lpipart = C + 'm' + year + 's' + boxsize + 'm' + algore
         if(lpivsjune == True):
             lpipart = C + 'm' + year + 's' + boxsize+'mjune' + algore
         ssr = 'ssr_'+ lpipart + doy
-        opencanopy = 'opencanopy_' + lpipart + doy
-        subcanopy = 'subcanopy_' + lpipart + doy
-        lpibeam   = 'subbeam_' + lpipart + doy    
-        lpidiff   = 'subdiff_' + lpipart + doy 
-
-        ###################################################################
-        #1. SUBCANOPY Merge LPI and Bare-earth by Algorithm
-        printout("DOY "+doy+" 1. merging lpi and dem using: "+algore,lf)
-        if(algore == 'cl'): # 'cl' Cameau Linear regression
-            grass.mapcalc("$tmp_lpidiff = 0.94 * $lpi * $diff", tmp_lpidiff = lpidiff, diff = demdiff, lpi = lpi,overwrite = ow)
-            grass.mapcalc("$tmp_lpibeam = $beam * $lpi", tmp_lpibeam = lpibeam, beam = dembeam, lpi = lpi,overwrite = ow)
-        elif(algore == 'cn'): # 'cn' Cameau Normalized - assumes halfdiff is set to True
-            grass.mapcalc("$tmp_lpidiff = 0.94 * (1.428 * $lpi) * $diff", tmp_lpidiff = lpidiff, diff = demdiff, lpi = lpi,overwrite = ow)
-            grass.mapcalc("$tmp_lpibeam = 1.428 * $beam * $lpi", tmp_lpibeam = lpibeam, beam = dembeam, lpi = lpi,overwrite = ow)
-        elif(algore == 'gn'): #gn Diffuse Gendron Linear Normalized. y =  0.01719 + 1.024 * nLPI 
-            grass.mapcalc("$tmp_lpidiff = 0.01719 + 1.024 * (1.428 * $lpi) * $diff", tmp_lpidiff = lpidiff, diff = demdiff, lpi = lpi,overwrite = ow)
-            grass.mapcalc("$tmp_lpibeam = (1.428 * $lpi) * $beam", tmp_lpibeam = lpibeam, beam = dembeam, lpi = lpi,overwrite = ow)
-        elif(algore == 'gl'): #gl Diffuse Gendron Linear NON-normalized y =  0.01719 + 1.024 * LPI 
-            grass.mapcalc("$tmp_lpidiff = 0.01719 + 1.024 * $lpi * $diff", tmp_lpidiff = lpidiff, diff = demdiff, lpi = lpi,overwrite = ow)
-            grass.mapcalc("$tmp_lpibeam = $lpi * $beam", tmp_lpibeam = lpibeam, beam = dembeam, lpi = lpi,overwrite = ow)
-        else:   # 'pl' power law
-            grass.mapcalc("$tmp_lpidiff = 1.1224 * ($lpi^0.3157) * $diff", tmp_lpidiff = lpidiff, diff = demdiff, lpi = lpi,overwrite = ow)
-            grass.mapcalc("$tmp_lpibeam =  1.2567 * $beam * $lpi", tmp_lpibeam = lpibeam, beam = dembeam, lpi = lpi,overwrite = ow)
-        
-        grass.mapcalc("$subcanopy = $tmp_lpibeam + $tmp_lpidiff", subcanopy = subcanopy, tmp_lpidiff = lpidiff, tmp_lpibeam = lpibeam, overwrite = ow)
-
-        ###################################################################
-        #2. OPEN CANOPY: Remove areas under tall trees (maxheight meters or higher)
-        printout('DOY '+doy+' 2. set subcanopy values to -88',lf)
-        grass.mapcalc("$canglob = $canbeam + $candiff",canglob = canglob, canbeam = canbeam, candiff = candiff,overwrite = ow)
-        grass.mapcalc("$opencanopy = if($veg < $maxheight, $canglob,-88)",opencanopy = opencanopy, veg = veg, canglob = canglob, maxheight = maxheight,overwrite = ow)
+        temps = {'subbeam':'subbeam_' + lpipart + doy, 'subdiff':'subdiff_' + lpipart + doy, \
+                 'subcanopy':'subcanopy_' + lpipart + doy, 'opencanopy':'opencanopy_' + lpipart + doy, \
+                 'canglob':suncan + doy + 'glob'}
 
         ###################################################################
-        #3. Merge lpi*bare-earth with cleaned canopy, keeping whichever is higher.
-        printout("DOY "+doy+" 3. Merge lpi*dem with canopy shade = "+ssr,lf)
-        grass.mapcalc("$ssr = if($opencanopy > $subcanopy, $opencanopy, $subcanopy)", opencanopy = opencanopy, subcanopy = subcanopy,ssr = ssr,overwrite = ow)
+        # Algorithm (algore), maxheight mask and merge in one pass over strips of rows
+        printout("DOY "+doy+" merging lpi and dem using: "+algore+", canopy above "+maxheight+" m = -88 -> "+ssr,lf)
+        inputs = [lpis[lpi]] + [raster_load(rast) for rast in [dembeam,demdiff,canbeam,candiff]] + [veg]
+        out = raster_new()
+        parts = {}
+        if(keeptemp == True):
+            for key in temps:
+                parts[key] = raster_new()
+        for row in range(0,out.shape[0],1024):
+            strips = [numpy.array(a[row:row+1024],dtype=numpy.float64) for a in inputs]
+            strip,strip_parts = algore_week(*strips)
+            out[row:row+1024] = strip
+            for key in parts:
+                parts[key][row:row+1024] = strip_parts[key]
+        del inputs
+        raster_write(out,ssr,ow)
         grass.run_command("r.colors",map = ssr, color = "bcyr")
+        del out
 
-        #4. Remove temp maps
-        if(keeptemp == False):
-            for raster in [lpibeam,lpidiff,opencanopy,subcanopy,canglob]:
-                grass.run_command("g.remove",rast=raster)
+        #4. Intermediate maps, only for testing (keeptemp)
+        for key in sorted(parts):
+            raster_write(parts[key],temps[key],ow)
+            printout("DOY "+doy+" kept "+temps[key],lf)
+        del parts
+    del veg,lpis
 
     # Reset GRASS env values
     grass.run_command("g.mapset", mapset="PERMANENT")
@@ -160,7 +191,9 @@ def main():
     printout("--------------------------------------",lf)
 
     lf.close()
-    sys.exit("FINISHED.")
+    # exit status 0: ssr_pipeline.py tells a finished stage from a crashed one by it
+    print "FINISHED."
+    sys.exit(0)
 
 if __name__ == "__main__":
     main()
@@ -6,10 +6,16 @@
 #               ssr_lpi and ssr_lidar used to be merged. Now separated.
 # PURPOSE:
 # 	1. Accept ASCII xyz LiDAR files (filtered & unfiltered) and import them into GRASS gis as raster.
+#          Each file is read once (ssr_points.py) for bounds, point count and max elevation.
+#          .las/.laz files are read from a single directory and split by classification.
 #   	   This assumes filenames include an indicator that allows you to match filtered to unfiltered.
 #          Tiles sometimes overlap, so an overlap distance is added in parameters to clip tiles.
+#          Tile bounds and point counts are kept in an index per input directory (ssr_tiles.py).
+#          Tiles are written directly into region sized memory mapped mosaics, no tile rasters.
+#          A tile manifest lets reruns re-bin only new or changed tiles (lidar_incremental).
+#          Several cell sizes (lidar_cells) are rasterized from the same pass over the points.
 # 	2. Calculate point density using an asymetric nearest neighbor box.
-#       3. Calculate Canopy raster using point maximum.  Requires cansource = '' in ssr_parameter file.
+#       3. Calculate Canopy raster using point maximum (or a high percentile, canstat).  Requires cansource = '' in ssr_parameter file.
 #
 # COPYRIGHT:    (c) 2011 Collin Bode
 #		(c) 2006 Hamish Bowman, and the GRASS Development Team
@@ -26,6 +32,8 @@ global gisbase
 global gisdbase
 
 # MODULES
+import multiprocessing as mp
+
 # GRASS & SSR environment setup for external use
 from ssr_params import *
 import os
@@ -37,6 +45,15 @@ import grass.script as grass
 import grass.script.setup as gsetup
 # ssr_utilities must go after grass.script imports
 from ssr_utilities import *
+from ssr_points import *
+from ssr_tiles import *
+
+
+def tile_edges(grid,tbounds):
+    # overlap clip (n,s,e,w) of a tile, None when tiles do not overlap
+    if(overlap == 0):
+        return None
+    return grid_clip_edges(grid,tbounds,overlap)
 
 
 def main():
@@ -61,10 +78,17 @@ def main():
     printout("Point Cloud ",lf)
     printout("Point Cloud Path: "+inPath,lf)
     printout("Point Cloud Ground,Total Directories: "+LidarPoints[0]+" , "+LidarPoints[1],lf)
+    printout("Point Cloud LAS ground classes: "+str(las_ground),lf)
     printout("Point Cloud File Prefix: "+pdensitypref,lf)
+    printout("Point Cloud Cell Sizes: "+','.join(lidar_cells),lf)
+    printout("Point Cloud Cell Statistics: "+','.join(lidar_stats),lf)
+    printout("Canopy Statistic: "+canstat,lf)
     printout("Point Cloud File Suffix: "+inSuffix,lf)
     printout("Point Cloud File Separator: "+sep,lf)
     printout("Point Cloud Tile Overlap (meters): "+str(overlap),lf)
+    printout("Tile import cores (0 = all but 2): "+str(lidar_cores),lf)
+    printout("Incremental re-import: "+str(lidar_incremental),lf)
+    printout("Point cache: "+pointcache,lf)
     printout("Create Canopy Raster: "+str(boocan),lf)
     printout('_________________________________',lf)
 	
@@ -73,126 +97,271 @@ def main():
         L2start = dt.datetime.now()
         printout('START LiDAR point cloud import',lf)
         
-        # Mapset and Region Defined
+        # Mapset and Region Defined. Every cell size gets its own region, same bounds (set_region).
+        # The points are read once and binned on the cells of all of them.
         mapset_gotocreate(mlpi,'default',C,lf)
+        cells = list(lidar_cells)
+        if(C not in cells):
+            cells.insert(0,C)
+        regs = {}
+        frames = []
+        for c in cells:
+            set_region('default',c)
+            regs[c] = grass.region()    # tiles are binned on cells aligned to this region
+            frames.append((regs[c]['n'],regs[c]['w'],(regs[c]['nsres'],regs[c]['ewres'])))
+        printout("Cell sizes from one pass over the points: "+','.join(cells),lf)
 
         ow = int(lidar_run - 1)   # overwrite files? 0 = no, 1 = yes
 
+        # Canopy Raster can only be created from unfiltered points
+        canpref = ''
+        if(cansource == '' and (LidarPoints[1] == 'unfiltered' or LidarPoints[1] == 'all')):
+            canpref = LidarPoints[1]
+        boocan = (canpref != '')
+        printout('Will canopy raster will be created using '+LidarPoints[1]+'?:'+str(boocan),lf)
+
         #################################################
+        # Bin every tile once. A .las tile fills both point classes in the same read.
+        # Tiles are binned in parallel (numpy workers, no GRASS calls) and mosaicked here,
+        # one tile at a time in sorted tile order, so the mosaic does not depend on cores.
+        ncores = lidar_cores
+        if(ncores == 0):
+            ncores = max(1,mp.cpu_count() - 2)
+        tiles = point_tiles(inPath,inSuffix,LidarPoints)
+        # Per cell statistics binned from each point class (ssr_points AGGREGATORS)
+        stats = {}
+        for pref in LidarPoints:
+            stats[pref] = ['n']
+            if(pref == canpref and canstat not in stats[pref]):
+                stats[pref].append(canstat)
+            for stat in lidar_stats:
+                if(stat not in stats[pref]):
+                    stats[pref].append(stat)
+        # Tile bounds from the index in each input directory (ssr_tiles). Known bounds preallocate the grids.
+        indexes = indexes_load(tiles)
+        jobs = []
+        nindexed = 0
+        for tilepath,tile,prefs in tiles:
+            bounds = tile_bounds(indexes,tilepath)
+            if(bounds is not None):
+                nindexed += 1
+            jobs.append((tilepath,prefs,frames,sep,las_ground,bounds,pointcache,stats))
+        printout("Tile index: "+str(nindexed)+" of "+str(len(tiles))+" tiles already indexed",lf)
+
+        # Layers: one per point class and cell size. Outputs (name,stat) filled from each layer:
+        # point density, the canopy (canstat) and any lidar_stats. C keeps the usual names (pdensitypref, can).
+        layers = {}
+        outputs = {}
+        canopies = {}
         for pref in LidarPoints:
-            i = 0
-            # Canopy Raster can only be created from unfiltered points
-            if(cansource == '' and (pref == 'unfiltered' or pref == 'all')):
-                boocan = True
+            layers[pref] = []
+            for k,c in enumerate(cells):
+                layer = pref+'_c'+c
+                layers[pref].append(layer)
+                if(c == C):
+                    outputs[layer] = [(pdensitypref+pref,'n')]
+                    if(pref == canpref):
+                        canopies[layer] = can
+                else:
+                    outputs[layer] = [('pointdensity_c'+c+year+pref,'n')]
+                    if(pref == canpref):
+                        canopies[layer] = bregion+c+'m'+'can'
+                if(layer in canopies):
+                    outputs[layer].append((canopies[layer],canstat))
+                for stat in lidar_stats:
+                    outputs[layer].append((stat_prefix(stat)+'_c'+c+year+pref,stat))
+        order = []
+        for k,c in enumerate(cells):
+            for pref in LidarPoints:
+                order.append((c,pref,layers[pref][k]))
+
+        # Tile manifest (ssr_tiles): content hash, bounds and mosaic window of every tile
+        manifest_file = gisdbase+os.sep+location+os.sep+mlpi+os.sep+manifest_name+'_'+pdensitypref+'.json'
+        manifest = manifest_load(manifest_file)
+        # The canopy gaps are filled from the DEM, so a rewritten DEM forces a full import
+        demstamp = None
+        if(boocan == True):
+            demstamp = raster_stamp(dem,'PERMANENT')
+        names = []
+        for c,pref,layer in order:
+            names += [name for name,stat in outputs[layer]]
+        regions = [[regs[c]['n'],regs[c]['w'],regs[c]['rows'],regs[c]['cols'],regs[c]['nsres'],regs[c]['ewres']] for c in cells]
+        settings = manifest_settings(region=regions,
+                                     overlap=overlap,sep=sep,inPath=inPath,inSuffix=inSuffix,LidarPoints=LidarPoints,
+                                     las_ground=las_ground,outputs=names,stats=stats,sketch=sketch_tail,dem=demstamp)
+        entries = []
+        changed = []
+        for t in range(len(tiles)):
+            entries.append(tile_entry(manifest,tiles[t][0]))
+            if(tile_changed(manifest,tiles[t][0],entries[t])):
+                changed.append(t)
+        paths = set([tile[0] for tile in tiles])
+        removed = [path for path in manifest['tiles'] if path not in paths]
+
+        # Incremental: only with overwrite, unchanged settings and all outputs present
+        booinc = (lidar_incremental == True and ow == 1 and manifest['settings'] == settings)
+        for name in names:
+            booinc = booinc and raster_exists(name,mlpi)
+        if(booinc == True and len(changed) == 0 and len(removed) == 0):
+            printout("Tile manifest: no tiles changed since the last import. Nothing to do.",lf)
+            replay = []
+        elif(booinc == True):
+            printout("Tile manifest: "+str(len(changed))+" new or changed tiles, "+str(len(removed))+" removed. Patching their windows.",lf)
+        else:
+            changed = range(len(tiles))
+            replay = changed
+
+        # Region sized, memory mapped mosaics, one set per cell size (created under that cell's region).
+        # Tiles are written straight into them (no tile rasters, no r.patch).
+        mosaics = {}
+        shape = {}
+        for c,pref,layer in order:
+            shape[layer] = (regs[c]['rows'],regs[c]['cols'])
+        cached = {}
+        if(booinc == True and (len(changed) > 0 or len(removed) > 0)):
+            for c,pref,layer in order:
+                set_region('default',c)
+                for name,stat in outputs[layer]:
+                    mosaics[name] = raster_load(name)
+            # Changed tiles are binned first: their new windows decide what else has to be replayed
+            for i,grids in enumerate(bin_tiles([jobs[t] for t in changed],ncores)):
+                cached[changed[i]] = grids
+            affected = {}
+            for c,pref,layer in order:
+                affected[layer] = []
+            for path in removed + [tiles[t][0] for t in changed]:
+                if(path in manifest['tiles']):
+                    for layer,win in manifest['tiles'][path]['windows'].items():
+                        if(win is not None and layer in affected):
+                            affected[layer].append(win)
+            for t in changed:
+                tilepath,tile,prefs = tiles[t]
+                tbounds = cached[t][prefs[-1]][0]['bounds']
+                for pref in prefs:
+                    for k,grid in enumerate(cached[t][pref]):
+                        if(grid['npoints'] > 0):
+                            layer = layers[pref][k]
+                            win = mosaic_window(shape[layer],grid,tile_edges(grid,tbounds))
+                            if(win is not None):
+                                affected[layer].append(win)
+            # Clear the affected windows, then replay every tile that can write into them, in tile order.
+            # The first tile still wins in every cell, so the result is the same as a full import.
+            for c,pref,layer in order:
+                for name,stat in outputs[layer]:
+                    for r0,r1,c0,c1 in affected[layer]:
+                        mosaics[name][r0:r1,c0:c1] = numpy.nan
+            replay = tiles_replay([tile[0] for tile in tiles],manifest,cached,affected)
+        elif(booinc == False):
+            for c,pref,layer in order:
+                set_region('default',c)
+                for name,stat in outputs[layer]:
+                    mosaics[name] = raster_new()
+
+        printout("Binning "+str(len(replay))+" of "+str(len(tiles))+" tiles on "+str(ncores)+" cores",lf)
+        fstart = dt.datetime.now()
+        binned = bin_tiles([jobs[t] for t in replay if t not in cached],ncores)
+        for n,t in enumerate(replay):
+            tilepath,tile,prefs = tiles[t]
+            if(t in cached):
+                grids = cached.pop(t)
             else:
-                boocan = False
-            printout('Will canopy raster will be created using '+pref+'?:'+str(boocan),lf)
-            
-            inDir = inPath+pref+"//"
-            for strFile in os.listdir(inDir):
-                print "checking "+strFile
-                t = strFile.split('.')
-                if(len(t) > 1 and t[1] == inSuffix):
-                    tile=t[0]
-                    cantile = 'can_'+tile
-                    fstart = dt.datetime.now()
-                    printout("Importing: "+strFile+" as "+tile,lf)
-                    # n=4399092 s=4396972 e=446782 w=444662 b=365 t=754
-                    
-                    str_boundary = grass.read_command("r.in.xyz", flags = "sg", input = inDir+strFile, fs = sep, output = "temp")
-                    boundary = str_boundary.split(' ')
-                    Cf = float(C)
-                    tn = round(float((boundary[0].split('='))[1]))+Cf # add
-                    ts = round(float((boundary[1].split('='))[1]))-Cf # subtract
-                    te = round(float((boundary[2].split('='))[1]))+Cf  # add
-                    tw = round(float((boundary[3].split('='))[1]))-Cf  # subtract
-                    tb = (boundary[4].split('='))[1]
-                    tt = (boundary[5].split('='))[1]
-                    grass.run_command("g.region", overwrite = ow, n=tn, s=ts, e=te, w=tw, b=tb, t=tt)
-                    grass.run_command("r.in.xyz", overwrite = ow, input = inDir+strFile, output = tile,type="FCELL", fs= sep, method="n")
-                    if(boocan == True):
-                        grass.run_command("r.in.xyz", overwrite = ow, input = inDir+strFile, output = cantile,type="FCELL", fs= sep, method="max")
-                    
-                    # Some LiDAR Tiles overlap. These need to be clipped before merging together
-                    ctile = 'c'+tile
-                    ccantile = 'c'+cantile
-                    
-                    if(overlap == 0):
-                        grass.run_command("g.rename",rast=tile+","+ctile)
-                        if(boocan == True):
-                            grass.run_command("g.rename",rast=cantile+","+ccantile)
-                    else:
-                        # clip tile, remove overlap
-                        otn = float(tn) - overlap
-                        ots = float(ts) + overlap
-                        ote = float(te) - overlap
-                        otw = float(tw) + overlap
-                        grass.run_command("g.region", n = otn, s = ots, w = otw, e = ote)
-                        grass.mapcalc("$ctile = float($tile)",ctile = ctile, tile = tile, overwrite = ow)
-                        grass.run_command("g.remove", flags = "f", rast = tile)
-                        if(boocan == True):
-                             grass.mapcalc("$ccantile = float($cantile)",ccantile = ccantile, cantile = cantile, overwrite = ow)
-                             grass.run_command("g.remove", flags = "f", rast = cantile)
-                    
-                    # append list of tiles to merge
-                    if(i == 0):
-                        patch_list = ctile
-                        can_patch_list = ccantile
-                    else:
-                        patch_list += ","+ctile
-                        can_patch_list += ","+ccantile
-                    i += 1
-            
-            # Reset the mapset from tile size to default (with proper cell size)
-            set_region('lpi',C)
-            
+                grids = next(binned)
+            # the last class holds every point of the file (unfiltered for LAS)
+            gall = grids[prefs[-1]][0]
+            if(gall['npoints'] > 0):
+                index_put(indexes[os.path.dirname(tilepath)],tilepath,gall['bounds'],gall['npoints'])
+            tbounds = tile_bounds(indexes,tilepath)
+            entries[t]['bounds'] = tbounds
+            for pref in prefs:
+                for k,grid in enumerate(grids[pref]):
+                    layer = layers[pref][k]
+                    entries[t]['windows'][layer] = None
+                    if(grid['npoints'] == 0):
+                        continue
+                    # Some LiDAR Tiles overlap. These are clipped as the tile is written, first tile wins (r.patch).
+                    edges = tile_edges(grid,tbounds)
+                    for name,stat in outputs[layer]:
+                        entries[t]['windows'][layer] = mosaic_add(mosaics[name],grid,grid_stat(grid,stat),edges)
+                npoints = grids[pref][0]['npoints']
+                if(npoints == 0):
+                    printout("No "+pref+" points in "+tilepath+". skipping...",lf)
+                else:
+                    printout("Binned "+str(npoints)+" "+pref+" points from "+tile,lf)
+            printout("Tile "+tile+" imported, "+str(n+1)+" of "+str(len(replay))+" in "+str(dt.datetime.now() - fstart),lf)
+        for grids in binned:
+            pass
+        # tiles that were not replayed keep their recorded bounds and windows
+        for t in range(len(tiles)):
+            if(t not in replay):
+                old = manifest['tiles'][tiles[t][0]]
+                entries[t]['bounds'] = old['bounds']
+                entries[t]['windows'] = old['windows']
+
+        for inDir in indexes_save(indexes):
+            printout("WARNING: could not write tile index in "+inDir+". Bounds will be read again next run.",lf)
+
+        # Rasters are written under the region of their cell size
+        for c,pref,layer in order:
+            if(len(mosaics) == 0):
+                break
+            set_region('default',c)
             ##################
             # Point Density Map
-            # Mosaic all the tiles into one map
-            pointdensity = pdensitypref+pref
-            grass.run_command("r.patch", overwrite = ow, input = patch_list, output= pointdensity)
+            pointdensity,stat = outputs[layer][0]
+            raster_write(mosaics[pointdensity],pointdensity,ow)
+            del mosaics[pointdensity]
             printout('point density raster '+pointdensity+' has been created.',lf)
             
-            # Delete the clipped tiles, leaving only a completed point densitymap
-            ctile_list = patch_list.split(',')
-            for ctile in ctile_list:
-                grass.run_command("g.remove", flags = "f", rast = ctile)
-            
             ##################
             # Canopy Map
-            if(boocan == True):
-                # Mosaic all the tiles into one map
-                tmp_can = can+'_temp'
-                grass.run_command("r.patch", overwrite = ow, input = can_patch_list, output = tmp_can)
+            if(layer in canopies):
                 # Remove NoData gaps from canopy that are covered in bare-earth DEM. This is important for lakes and river pools 
-                grass.mapcalc("$can = if(isnull($tmp_can), $dem, $tmp_can)", can = can, dem = dem, tmp_can = tmp_can,overwrite = ow)
-                grass.run_command("g.remove", flags = "f", rast = tmp_can)
-                printout('Canopy raster '+can+' has been created.',lf)
-         
-                # Delete the clipped tiles, leaving only a completed canopy map
-                ccantile_list = can_patch_list.split(',')
-                for cctile in ccantile_list:
-                    grass.run_command("g.remove", flags = "f", rast = cctile)
+                # The DEM is resampled to the cell size as it is read.
+                canopy = canopies[layer]
+                demdata = raster_read(dem)
+                gaps = numpy.isnan(mosaics[canopy])
+                mosaics[canopy][gaps] = demdata[gaps]
+                del demdata,gaps
+                raster_write(mosaics[canopy],canopy,ow)
+                del mosaics[canopy]
+                printout('Canopy raster '+canopy+' ('+canstat+') has been created.',lf)
+
+            ##################
+            # Other cell statistics
+            for name,stat in outputs[layer][1:]:
+                if(name in mosaics):
+                    raster_write(mosaics[name],name,ow)
+                    del mosaics[name]
+                    printout('Point '+stat+' raster '+name+' has been created.',lf)
+
+            printout("Done with "+pref+" at "+c+" m",lf)
 
-            printout("Done with "+pref,lf)
+        manifest = {'settings':settings,'tiles':{}}
+        for t in range(len(tiles)):
+            manifest['tiles'][tiles[t][0]] = entries[t]
+        manifest_save(manifest_file,manifest)
 
         #################################################
         # Finish
         # Reset mapset and region 
         mapset_gotocreate('PERMANENT','default',C,lf)
      
-        # Move canopy raster to PERMANENT
+        # Move canopy rasters to PERMANENT
         if(boocan == True):
-            str_rasts = can+"@"+mlpi+","+can
-            grass.run_command("g.copy", rast = str_rasts)
-            #grass.run_command("g.remove", rast = can)
-            printout('Canopy raster '+can+' moved to PERMANENT',lf)    
+            for k,c in enumerate(cells):
+                canopy = canopies[layers[canpref][k]]
+                str_rasts = canopy+"@"+mlpi+","+canopy
+                grass.run_command("g.copy", rast = str_rasts)
+                #grass.run_command("g.remove", rast = canopy)
+                printout('Canopy raster '+canopy+' moved to PERMANENT',lf)    
         
         L2end = dt.datetime.now()
         L2processingtime = L2end - L2start
         printout("DONE with LiDAR import, processing time: "+str(L2processingtime),lf)
         printout("--------------------------------------",lf)
-    sys.exit("FINISHED.")
+    # exit status 0: ssr_pipeline.py tells a finished stage from a crashed one by it
+    print "FINISHED."
+    sys.exit(0)
 
 if __name__ == "__main__":
     main()
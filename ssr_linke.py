@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_linke.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               from linke_interp() in ssr_rsun.py
+# PURPOSE:      Linke atmospheric turbidity for every day of the year.
+#               Monthly series (built in, or a user CSV) are interpolated with the
+#               same cubic spline through the mid-month days as before (SciPy
+#               interp1d kind='cubic'), done in numpy. The spline is linear in the
+#               monthly values, so it is kept as a table of weights per day:
+#               366-day tables of any series, and the daily blend of 12 monthly
+#               Linke rasters, come from the same weights.
+#               Tables are computed once per process and cached.
+#
+# COPYRIGHT:    (c) 2012 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import numpy
+
+# put monthly data here
+# Angelo area LT from helios satellite data (http://www.soda-is.com/linke/linke_helioserve.html)
+# ltm1 and angelo-1 are identical, kept for backwards compatibility.  They are helios - 1
+linke_monthly = {
+    'helios':   [3.2,3.2,3.2,3.4,3.7,3.8,3.7,3.8,3.5,3.4,3.1,2.9],
+    'angelo80': [2.56,2.56,2.56,2.72,2.96,3.04,2.96,3.04,2.80,2.72,2.48,2.32],
+    'angelo70': [2.3,2.3,2.3,2.5,2.7,2.8,2.7,2.8,2.6,2.5,2.3,2.1],
+    'angelo-1': [2.2,2.2,2.2,2.4,2.7,2.8,2.7,2.8,2.5,2.4,2.1,1.9],
+    'ltm1':     [2.2,2.2,2.2,2.4,2.7,2.8,2.7,2.8,2.5,2.4,2.1,1.9],
+    'default':  [1.5,1.6,1.8,1.9,2.0,2.3,2.3,2.3,2.1,1.8,1.6,1.5],  # any other name
+}
+
+_weights = None     # (367,12) spline weights of the months for day 0..366
+_tables = {}        # series name or CSV path: 367 values, index = day of year
+
+
+###############################################################
+#
+#   SPLINE
+#
+###############################################################
+
+def spline_weights(xs,x):
+    # not-a-knot cubic spline through points xs (as interp1d kind='cubic'), evaluated at x:
+    # matrix W with spline(x) = W . y for any values y at xs
+    xs = numpy.asarray(xs,dtype=numpy.float64)
+    x = numpy.asarray(x,dtype=numpy.float64)
+    n = len(xs)
+    dx = numpy.diff(xs)
+    # slopes s = S . y from the tridiagonal system A . s = B . y
+    A = numpy.zeros((n,n))
+    B = numpy.zeros((n,n))
+    M = numpy.zeros((n-1,n))        # secant slopes m = M . y
+    for i in range(0,n-1):
+        M[i,i] = -1.0 / dx[i]
+        M[i,i+1] = 1.0 / dx[i]
+    for i in range(1,n-1):
+        A[i,i-1] = dx[i]
+        A[i,i] = 2.0 * (dx[i-1] + dx[i])
+        A[i,i+1] = dx[i-1]
+        B[i] = 3.0 * (dx[i] * M[i-1] + dx[i-1] * M[i])
+    d = xs[2] - xs[0]
+    A[0,0] = dx[1]
+    A[0,1] = d
+    B[0] = ((dx[0] + 2.0 * d) * dx[1] * M[0] + dx[0] ** 2 * M[1]) / d
+    d = xs[-1] - xs[-3]
+    A[-1,-1] = dx[-2]
+    A[-1,-2] = d
+    B[-1] = (dx[-1] ** 2 * M[-2] + (2.0 * d + dx[-1]) * dx[-2] * M[-1]) / d
+    S = numpy.linalg.solve(A,B)
+    # cubic Hermite on the interval of each x
+    k = numpy.clip(numpy.searchsorted(xs,x,side='right') - 1,0,n-2)
+    h = dx[k][:,None]
+    t = (x - xs[k])[:,None]
+    Y = numpy.eye(n)
+    c2 = (3.0 * M[k] - 2.0 * S[k] - S[k+1]) / h
+    c3 = (S[k] + S[k+1] - 2.0 * M[k]) / h ** 2
+    return Y[k] + S[k] * t + c2 * t ** 2 + c3 * t ** 3
+
+def linke_weights(day=None):
+    # weights of the 12 months for every day 0..366 (or one day): the spline through the
+    # mid-month days, wrapped three months into the previous and next year
+    global _weights
+    if(_weights is None):
+        monthDays = numpy.array([0,31,28,31,30,31,30,31,31,30,31,30,31])
+        midmonth_day = 15 + numpy.cumsum(monthDays)[:12]
+        midmonth_day_wrap = numpy.concatenate((midmonth_day[9:12]-365,midmonth_day,midmonth_day[0:3]+365))
+        W = spline_weights(midmonth_day_wrap,numpy.arange(0,367))
+        # fold the wrapped points back onto their months
+        months = numpy.concatenate((numpy.arange(9,12),numpy.arange(0,12),numpy.arange(0,3)))
+        _weights = numpy.zeros((367,12))
+        for j in range(0,len(months)):
+            _weights[:,months[j]] += W[:,j]
+    if(day is None):
+        return _weights
+    return _weights[int(day)]
+
+
+###############################################################
+#
+#   SERIES
+#
+###############################################################
+
+def linke_csv(path):
+    # user series: one value per line (the last number on the line), 12 monthly values
+    # or 365/366 daily values. Lines without a number (headers, comments) are skipped.
+    values = []
+    f = open(path,'r')
+    try:
+        for line in f:
+            fields = line.replace(';',',').split('#')[0].split(',')
+            try:
+                values.append(float(fields[-1]))
+            except ValueError:
+                continue
+    finally:
+        f.close()
+    if(len(values) not in [12,365,366]):
+        raise ValueError(path+': '+str(len(values))+' Linke values, need 12 (monthly) or 365/366 (daily)')
+    return values
+
+def linke_table(name):
+    # Linke turbidity of every day, index = day of year (1..366, day 0 as well for the spline).
+    # name: built in series, or a .csv file (linke_csv)
+    if(name in _tables):
+        return _tables[name]
+    if(name.lower().endswith('.csv')):
+        values = linke_csv(name)
+    else:
+        values = linke_monthly.get(name,linke_monthly['default'])
+    if(len(values) == 12):
+        table = numpy.dot(linke_weights(),numpy.array(values,dtype=numpy.float64))
+    else:
+        # daily values: day 1 is the first line, day 366 repeats day 365 when missing
+        table = numpy.zeros(367)
+        table[1:len(values)+1] = values
+        table[len(values)+1:] = values[-1]
+        table[0] = values[-1]
+    _tables[name] = table
+    return table
+
+def linke_day(day,name):
+    return linke_table(name)[int(day)]
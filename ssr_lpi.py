@@ -6,6 +6,11 @@
 #               modified from r.out.xyz
 # PURPOSE:
 # 	2. Calculate point density using an asymetric nearest neighbor box.
+#          The box sums are read from a summed-area table of each density raster
+#          (ssr_neighbors.py), same result as r.neighbors method=sum with the weight files.
+#          Done in strips of rows with halos across a process pool, within a memory budget.
+#          A sweep of other box sizes and layouts (lpi_sweep) comes from the same pass.
+#          Weight files of any shape work: non rectangular kernels are summed directly or by FFT.
 # 	3. Calculate LPI as the ratio of filtered to unfiltered.
 #
 # COPYRIGHT:    (c) 2011 Collin Bode
@@ -23,6 +28,8 @@ global gisbase
 global gisdbase
 
 # MODULES
+import multiprocessing as mp
+
 # GRASS & SSR environment setup for external use
 from ssr_params import *
 import os
@@ -34,6 +41,7 @@ import grass.script as grass
 import grass.script.setup as gsetup
 # ssr_utilities must go after grass.script imports
 from ssr_utilities import *
+from ssr_neighbors import *
 
 
 def main():
@@ -53,6 +61,10 @@ def main():
     printout("LPI pref: "+lpipref,lf)
     printout('LPI mapset: '+mlpi,lf)
     printout("Boxsize: "+boxsize,lf)
+    printout("LPI cores (0 = all but 2): "+str(lpi_cores),lf)
+    printout("LPI memory (MB): "+str(lpi_memory),lf)
+    printout("LPI sweep: "+str(lpi_sweep),lf)
+    printout("LPI method: "+lpi_method,lf)
     printout('Overwrite: '+str(ow),lf)
     printout('_________________________________',lf)
 	
@@ -65,10 +77,9 @@ def main():
         # Mapset and Region Defined
         mapset_gotocreate(mlpi,'default',C,lf)
 
-        # LPI Weights Translation table
+        # LPI Weights. Months share the raster of their weight (lpi_month_weights), looked up by ssr_algore.py.
         weight_num = 4
         weight_name = 'lpi_box18x18_weight'
-        month_weights = {1:1, 2:2, 3:2, 4:3, 5:4, 6:4, 7:4, 8:3, 9:3, 10:2, 11:2, 12:1}
         scriptPath = get_path()
 
         printout("R2 Starting LPI Calculation using size("+str(boxsize)+")",lf)
@@ -78,45 +89,71 @@ def main():
         pdensityunf = pdensitypref + LidarPoints[1]
         
         
-        # NOT needed. r.neighbors ignores nulls. Remove NULL from the maps to prevent nulls propagating to the final result.
-        grass.run_command("r.null", map = pdensityfilt, null = 0)
-        #grass.run_command("r.null", map = pdensityunf, null = 0)
-
-        # Iterate through all the neighborhood weights and calculate LPI
+        # LPI weight kernels (r.neighbors weight files), then the calibration sweep (lpi_sweep):
+        # more window sizes and layouts, computed from the same summed-area tables in the same pass.
+        kernels = []
+        lpis = []
         for weight in range(1,(weight_num+1)):
-                weight = str(weight)
-                weight_file = scriptPath+weight_name+weight+'.txt'
-                pneighfilt = pdensitypref + "w"+weight+LidarPoints[0]
-                pneighunf = pdensitypref + "w"+weight+LidarPoints[1]
-                lpi = lpipref + "w"+weight
+                kernels.append(weight_read(scriptPath+weight_name+str(weight)+'.txt'))
+                lpis.append(lpipref + "w"+str(weight))
+        for size,layout in lpi_sweep:
+                for weight in range(1,(weight_num+1)):
+                        if(layout == 'box'):
+                                w = kernel_box(size,weight)
+                        else:
+                                w = weight_read(scriptPath+layout+str(weight)+'.txt')
+                        lpi = 'lpi_c'+C+year+'s'+str(w.shape[0])+layout+'w'+str(weight)
+                        if(lpi not in lpis):
+                                kernels.append(w)
+                                lpis.append(lpi)
+        printout("LPI rasters from one pass: "+','.join(lpis),lf)
+        # Box sums by summed-area table, direct sum or FFT (ssr_neighbors), cheapest for each kernel unless lpi_method is set
+        for lpi,w in zip(lpis,kernels):
+                method = lpi_method
+                if(method == 'auto'):
+                        method = kernel_method(w)
+                printout(lpi+": "+str(w.shape[0])+"x"+str(w.shape[0])+" kernel, "+method,lf)
 
-                # LPI is calculated by running a neighborhood analysis on grids which contain a count of lidar points (ground filtered and raw - all points)
-                # The neighborhood analysis uses a bounding box defined by month (4 possible boxes) and sums all the lidar points within range
-                # LPI = Ground Filtered sum of LiDAR points / Raw All summed Points.  Result is a dimensionless ratio of Canopy Gap or Openness.
-                # Ratios occasionally exceed 1.0 (100%), so additional cleaning step included to set those to 100%.
-                printout("running neighborhood operation for ground filtered, weight"+weight,lf)
-                grass.run_command("r.neighbors", overwrite = ow, input= pdensityfilt, output = pneighfilt, method = "sum", size = boxsize, weight = weight_file)
-                grass.run_command("r.neighbors", overwrite = ow, input= pdensityunf, output = pneighunf, method = "sum", size = boxsize, weight = weight_file)
-                if(year == 'ym4'):
-                        str_formula = "3.71 * ( A / B )^1.3455"
-                elif(year == 'yr4'):
-                        str_formula = "6.5 * ( A / B )^1.57 + 0.005"                                
-                else:
-                        str_formula = "A / B"
-                grass.run_command("r.mapcalculator", overwrite = ow, amap = pneighfilt, bmap = pneighunf, formula = str_formula, outfile = lpi)	
-                str_formula = "if( A > 1.0, 1.0, A)"
-                grass.run_command("r.mapcalculator", overwrite = ow, amap =  lpi, formula = str_formula, outfile = lpi)	
+        # LPI is calculated by running a neighborhood analysis on grids which contain a count of lidar points (ground filtered and raw - all points)
+        # The neighborhood analysis uses a bounding box defined by month (4 possible boxes) and sums all the lidar points within range.
+        # Each box is a rectangle of the weight file, so its sum is 4 lookups in a summed-area table of the density raster.
+        # LPI = Ground Filtered sum of LiDAR points / Raw All summed Points.  Result is a dimensionless ratio of Canopy Gap or Openness.
+        # Ratios occasionally exceed 1.0 (100%), so those are set to 100%.
+        # Year calibration: ym4 = 3.71 * ( A / B )^1.3455, yr4 = 6.5 * ( A / B )^1.57 + 0.005, else A / B
+        # One fused pass for all the weights: box sums, ratio, year formula and clamp in memory. Only the LPI rasters are written.
+        # The region is done in strips of rows (halo of boxsize//2 rows) across lpi_cores processes, within lpi_memory.
+        # Inputs and outputs are memory mapped, so no process holds a whole raster.
+        ncores = lpi_cores
+        if(ncores == 0):
+            ncores = max(1,mp.cpu_count() - 2)
+        densityfilt = raster_load(pdensityfilt)
+        # Filtered nulls count as 0 points (this used to be r.null on the density raster itself).
+        for row in range(0,densityfilt.shape[0],1024):
+                strip = densityfilt[row:row+1024]
+                strip[numpy.isnan(strip)] = 0.0
+        densityfilt.flush()
+        densityunf = raster_load(pdensityunf)
+        densityunf.flush()
+        outputs = []
+        for lpi in lpis:
+                outputs.append(raster_new())
+                outputs[-1].flush()
+        shape = densityfilt.shape
+        pad = max([w.shape[0]//2 for w in kernels])
+        nrows = strip_rows(shape,pad,lpi_memory,ncores)
+        printout("LPI in strips of "+str(nrows)+" rows on "+str(ncores)+" cores",lf)
+        if(strip_memory(shape,pad,nrows,ncores) > lpi_memory):
+                printout("WARNING: lpi_memory of "+str(lpi_memory)+" MB is too small for strips of at least "+str(2*pad)+ \
+                        " rows (the box halo). Using "+str(int(strip_memory(shape,pad,nrows,ncores))+1)+" MB.",lf)
+        done = 0
+        for r0,r1 in lpi_strips(densityfilt.filename,densityunf.filename,shape,kernels,year,[a.filename for a in outputs],lpi_memory,ncores,lpi_method):
+                done += r1 - r0
+                printout("LPI rows "+str(r0)+"-"+str(r1)+" done, "+str(done)+" of "+str(shape[0]),lf)
+        del densityfilt,densityunf
+        for lpi,out in zip(lpis,outputs):
+                raster_write(out,lpi,ow)
                 printout("finished creating "+lpi,lf)
-        
-        # Copy/rename each weight to their respective months
-        for month,weight in month_weights.items():
-                wlpi = lpipref + "w"+str(weight)
-                monthlpi = lpipref+"m"+str(month).zfill(2)
-                str_rasts = wlpi+","+monthlpi
-                str_message = "Copying "+wlpi+" to "+monthlpi+" at "+str(dt.datetime.now())
-                grass.message(str_message)
-                printout(str_message,lf)
-                grass.run_command("g.copy",overwrite = ow,rast = str_rasts)
+        del outputs
         
         # Finish
         set_region('default',C)
@@ -127,7 +164,9 @@ def main():
         printout('END  at '+ L2endtime+ ', processing time: '+str(L2processingtime),lf)
         printout("DONE with LPI Calculations",lf)
         printout("--------------------------------------",lf)
-    sys.exit("FINISHED.")
+    # exit status 0: ssr_pipeline.py tells a finished stage from a crashed one by it
+    print "FINISHED."
+    sys.exit(0)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_neighbors.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               based on ssr_lpi.py
+# PURPOSE:      Weighted neighborhood sums for the LPI.
+#               Same result as r.neighbors method=sum size=.. weight=..:
+#               null cells are skipped, a cell is null only when its whole
+#               window is null, and cells outside the region are null.
+#               The LPI weight files are 0/1 rectangles inside the window,
+#               so a kernel is split into rectangles of constant weight and
+#               each rectangle sum is read from a summed-area table (SAT):
+#               4 lookups per cell, whatever the window size. Other kernels
+#               are summed directly or by FFT, whichever is cheaper.
+#               Large regions are done in strips of rows with a halo of
+#               kernel size//2 rows, across a process pool (lpi_strips).
+#               NOTE: numpy only, no GRASS calls. Reading and writing the
+#               rasters is done by the caller (ssr_utilities).
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import multiprocessing
+import numpy
+
+
+###############################################################
+#
+#   KERNELS: r.neighbors weight files, first row is north.
+#
+###############################################################
+
+def weight_read(filename):
+    w = numpy.loadtxt(filename,dtype=numpy.float64,ndmin=2)
+    if(w.shape[0] != w.shape[1] or w.shape[0] % 2 == 0):
+        raise ValueError(filename+': weights must be an odd sized square, not '+str(w.shape))
+    return w
+
+def kernel_box(size,weight):
+    # LPI box of the weight files scaled to any odd window size: a square of size//2+1 cells,
+    # centred east-west, starting at the centre row and moved north as the weight goes up
+    # (one row per weight for size 17, proportionally more for bigger windows).
+    size = int(size)
+    if(size % 2 == 0):
+        raise ValueError('LPI window size must be odd, not '+str(size))
+    h = size//2
+    shift = int(round((int(weight)-1)*h/8.0))
+    r0 = max(0,h-shift)
+    w = numpy.zeros((size,size),dtype=numpy.float64)
+    w[r0:r0+h+1,h-h//2:h-h//2+h+1] = 1.0
+    return w
+
+def kernel_rects(w):
+    # Split the non zero weights into rectangles of constant weight:
+    # [(r0,r1,c0,c1,weight)], rows r0:r1 and cols c0:c1 of the kernel.
+    # Runs of equal weight in a row are merged with the same run in the row above.
+    rects = []
+    open_runs = {}
+    for r in range(w.shape[0]+1):
+        runs = []
+        if(r < w.shape[0]):
+            row = w[r]
+            c = 0
+            while c < row.size:
+                if(row[c] == 0):
+                    c += 1
+                    continue
+                c1 = c
+                while c1 < row.size and row[c1] == row[c]:
+                    c1 += 1
+                runs.append((c,c1,row[c]))
+                c = c1
+        still_open = {}
+        for run in runs:
+            still_open[run] = open_runs.pop(run,r)
+        for (c0,c1,v),r0 in open_runs.items():
+            rects.append((r0,r,c0,c1,v))
+        open_runs = still_open
+    return sorted(rects)
+
+
+###############################################################
+#
+#   NEIGHBORHOOD SUMS: three methods, same nulls as r.neighbors.
+#     sat:    rectangles of constant weight from summed-area tables,
+#             cost independent of the window size (the LPI boxes).
+#     direct: one shifted multiply-add per non zero weight, for small
+#             or sparse kernels.
+#     fft:    overlap-add FFT convolution in blocks, for large dense
+#             kernels of any shape (circles, gaussians, sun paths).
+#
+###############################################################
+
+fft_cost = 60       # operations per cell charged to the FFT method when choosing one
+fft_block = 256     # overlap-add block size (cells), FFTs are (block + kernel size - 1) square
+
+
+###############################################################
+#
+#   SUMMED-AREA TABLES: cumulative sums of a raster padded by
+#   pad null cells on every side, so windows reaching past the
+#   region edge need no special case.
+#   A strip of rows carries halo rows of real data above and
+#   below instead of padding (see STRIPS).
+#
+###############################################################
+
+def sat_new(data,pad,halo=0):
+    # data: 2D array, NaN = null. Keeps the sum of the values, the count of non null cells
+    # and the values themselves with nulls as 0 (for the direct and FFT methods).
+    # The first and last halo rows of data are only read by the windows, the table covers the rows in between.
+    rows = data.shape[0] - 2*halo
+    cols = data.shape[1]
+    if(halo > pad):
+        raise ValueError('halo of '+str(halo)+' rows is wider than the padding '+str(pad))
+    valid = ~numpy.isnan(data)
+    Z = numpy.zeros((rows+2*pad,cols),dtype=numpy.float64)
+    Z[pad-halo:pad-halo+data.shape[0]] = numpy.where(valid,data,0.0)
+    S = numpy.zeros((rows+2*pad+1,cols+2*pad+1),dtype=numpy.float64)
+    S[1:1+rows+2*pad,pad+1:pad+1+cols] = Z
+    S.cumsum(axis=0,out=S)
+    S.cumsum(axis=1,out=S)
+    N = numpy.zeros(S.shape,dtype=numpy.int32 if S.size < 2**31 else numpy.int64)
+    N[pad-halo+1:pad-halo+1+data.shape[0],pad+1:pad+1+cols] = valid
+    N.cumsum(axis=0,out=N)
+    N.cumsum(axis=1,out=N)
+    whole = bool(numpy.all(Z == numpy.floor(Z)))
+    return {'sum':S,'count':N,'data':Z,'whole':whole,'pad':pad,'shape':(rows,cols)}
+
+def sat_box(sat,table,dr0,dr1,dc0,dc1):
+    # sum over rows i+dr0:i+dr1, cols j+dc0:j+dc1 for every cell i,j of the region
+    S = sat[table]
+    rows,cols = sat['shape']
+    p = sat['pad']
+    return (S[p+dr1:p+dr1+rows,p+dc1:p+dc1+cols] - S[p+dr0:p+dr0+rows,p+dc1:p+dc1+cols]
+            - S[p+dr1:p+dr1+rows,p+dc0:p+dc0+cols] + S[p+dr0:p+dr0+rows,p+dc0:p+dc0+cols])
+
+def kernel_method(w):
+    # cheapest way to sum a kernel, in operations per cell: 4 lookups per rectangle (sat),
+    # one multiply-add per non zero weight (direct), or a roughly constant FFT cost (fft)
+    cost = {'sat':4*len(kernel_rects(w)),'direct':numpy.count_nonzero(w),'fft':fft_cost}
+    return min(['sat','direct','fft'],key=lambda m: cost[m])
+
+def direct_sum(sat,w):
+    # weighted sum by shifting the data once per non zero weight
+    h = w.shape[0]//2
+    p = sat['pad']
+    rows,cols = sat['shape']
+    Z = sat['data']
+    out = numpy.zeros((rows,cols),dtype=numpy.float64)
+    for a,b in zip(*numpy.nonzero(w)):
+        c0 = max(0,h-b)
+        c1 = min(cols,cols+h-b)
+        if(c0 < c1):
+            out[:,c0:c1] += w[a,b]*Z[p+a-h:p+a-h+rows,c0+b-h:c1+b-h]
+    return out
+
+def fft_correlate(data,w,block=None):
+    # sum of w over the window of every cell of data, zeros outside (same shape as data).
+    # Overlap-add: data in blocks of block x block, each convolved with the flipped kernel by FFT.
+    if(block is None):
+        block = fft_block
+    K = w.shape[0]
+    h = K//2
+    rows,cols = data.shape
+    n = block + K - 1
+    kf = numpy.fft.rfft2(w[::-1,::-1],s=(n,n))
+    out = numpy.zeros((rows+K-1,cols+K-1),dtype=numpy.float64)
+    for r in range(0,rows,block):
+        for c in range(0,cols,block):
+            blk = data[r:r+block,c:c+block]
+            y = numpy.fft.irfft2(numpy.fft.rfft2(blk,s=(n,n))*kf,s=(n,n))
+            out[r:r+blk.shape[0]+K-1,c:c+blk.shape[1]+K-1] += y[:blk.shape[0]+K-1,:blk.shape[1]+K-1]
+    return out[h:h+rows,h:h+cols]
+
+def fft_sum(sat,w):
+    h = w.shape[0]//2
+    p = sat['pad']
+    rows,cols = sat['shape']
+    out = fft_correlate(sat['data'][p-h:p+h+rows],w)[h:h+rows]
+    # whole numbers (point counts) with whole weights: round off the FFT noise, exact as the other methods
+    if(sat['whole'] and numpy.all(w == numpy.floor(w))):
+        numpy.round(out,out=out)
+    return out
+
+def neighbor_sum(sat,w,method='auto'):
+    # r.neighbors method=sum with weights w. float64, NaN where the whole window is null.
+    # method: 'sat', 'direct', 'fft' or 'auto' (kernel_method)
+    h = w.shape[0]//2
+    if(h > sat['pad']):
+        raise ValueError('kernel of size '+str(w.shape[0])+' needs a table padded by '+str(h))
+    if(method == 'auto'):
+        method = kernel_method(w)
+    rows,cols = sat['shape']
+    if(method == 'direct'):
+        out = direct_sum(sat,w)
+    elif(method == 'fft'):
+        out = fft_sum(sat,w)
+    elif(method == 'sat'):
+        out = numpy.zeros((rows,cols),dtype=numpy.float64)
+        for r0,r1,c0,c1,v in kernel_rects(w):
+            box = sat_box(sat,'sum',r0-h,r1-h,c0-h,c1-h)
+            if(v == 1):
+                out += box
+            else:
+                out += v*box
+    else:
+        raise ValueError('unknown neighborhood method: '+method)
+    empty = sat_box(sat,'count',-h,h+1,-h,h+1) == 0
+    out[empty] = numpy.nan
+    return out
+
+
+###############################################################
+#
+#   LPI: ratio of the filtered to unfiltered box sums, with the
+#   year calibration and the clamp to 1.0, as r.mapcalc did it:
+#   null where either sum is null or the unfiltered sum is 0.
+#
+###############################################################
+
+def lpi_ratio(filt,unf,year):
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        ratio = filt/unf
+        ratio[unf == 0] = numpy.nan
+        if(year == 'ym4'):
+            lpi = 3.71 * ratio**1.3455
+        elif(year == 'yr4'):
+            lpi = 6.5 * ratio**1.57 + 0.005
+        else:
+            lpi = ratio
+        lpi[lpi > 1.0] = 1.0
+    return lpi
+
+
+###############################################################
+#
+#   STRIPS: the LPI in strips of rows, each read with a halo of
+#   pad rows above and below, so every window sees the same cells
+#   as over the whole region. Inputs and outputs are raw float32
+#   files (the memory maps behind grass.script.array), so workers
+#   only hold their own strip in memory.
+#   Density rasters are point counts: the sums are whole numbers,
+#   exact in float64, so strips give the same result as one pass.
+#
+###############################################################
+
+strip_row_bytes = 96    # bytes per cell of a strip: two tables, the halo data and the sums
+
+def strip_rows(shape,pad,memory,cores):
+    # rows per strip so that cores strips fit in memory (MB). At least 2*pad rows: thinner
+    # strips read more halo than rows and rebuild the tables for each, so the budget is
+    # exceeded instead (strip_memory tells by how much)
+    rows = int(memory*1024*1024 // (cores*(shape[1]+2*pad+1)*strip_row_bytes)) - 2*pad
+    return max(1,min(max(rows,2*pad),shape[0]))
+
+def strip_memory(shape,pad,rows,cores):
+    # MB used by cores strips of rows rows
+    return cores*(rows+2*pad)*(shape[1]+2*pad+1)*strip_row_bytes / (1024.0*1024.0)
+
+def strip_read(path,shape,r0,r1,pad):
+    # rows r0-pad:r1+pad of a raw float32 raster, null (NaN) past the region edges
+    data = numpy.memmap(path,dtype=numpy.float32,mode='r',shape=shape)
+    out = numpy.empty((r1-r0+2*pad,shape[1]),dtype=numpy.float64)
+    out.fill(numpy.nan)
+    s0 = max(0,r0-pad)
+    s1 = min(shape[0],r1+pad)
+    out[s0-(r0-pad):s1-(r0-pad)] = data[s0:s1]
+    del data
+    return out
+
+def lpi_strip(job):
+    # multiprocessing worker: job = (filtpath,unfpath,shape,r0,r1,kernels,year,outpaths,method)
+    # writes rows r0:r1 of the LPI of every kernel into its output file
+    filtpath,unfpath,shape,r0,r1,kernels,year,outpaths,method = job
+    pad = max([w.shape[0]//2 for w in kernels])
+    satfilt = sat_new(strip_read(filtpath,shape,r0,r1,pad),pad,pad)
+    satunf = sat_new(strip_read(unfpath,shape,r0,r1,pad),pad,pad)
+    for w,outpath in zip(kernels,outpaths):
+        out = numpy.memmap(outpath,dtype=numpy.float32,mode='r+',shape=shape)
+        out[r0:r1] = lpi_ratio(neighbor_sum(satfilt,w,method),neighbor_sum(satunf,w,method),year)
+        out.flush()
+        del out
+    return r0,r1
+
+def lpi_strips(filtpath,unfpath,shape,kernels,year,outpaths,memory=1024,cores=1,method='auto'):
+    # LPI of every kernel over the whole region, strip by strip. Yields (r0,r1) as strips finish.
+    pad = max([w.shape[0]//2 for w in kernels])
+    nrows = strip_rows(shape,pad,memory,cores)
+    jobs = []
+    for r0 in range(0,shape[0],nrows):
+        jobs.append((filtpath,unfpath,shape,r0,min(shape[0],r0+nrows),kernels,year,outpaths,method))
+    if(cores <= 1 or len(jobs) == 1):
+        for job in jobs:
+            yield lpi_strip(job)
+        return
+    pool = multiprocessing.Pool(min(cores,len(jobs)))
+    try:
+        for done in pool.imap_unordered(lpi_strip,jobs):
+            yield done
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -18,14 +18,21 @@
 #               for details.
 #
 #############################################################################
+import os
 
 #----------------------------------------------------------------------------
 # Run Parts?  0 = do not run, 1 = run, but do not overwrite maps, 2 = run, overwrite maps
+# ssr_pipeline.py reads them as: 0 = stage off, 1 = run when its products are stale, 2 = always run
 lidar_run = 2           # Imports point cloud as canopy and point density rasters
 lpi_run = 0             # Creates Light Penetration Index (LPI) from point cloud
 preprocessing_run = 0   # Creates derivative GIS products slope, aspect, tree height, albedo
+horizon_run = 0         # Horizon angles for r.sun, computed once per surface. 1 = only if dem or canopy changed, 2 = always
 rsun_run = 0            # Runs GRASS light model, r.sun
 algore_run = 0          # Algorithm for combining all the parts into the SRR
+# Any run part can be set from the environment, e.g. SSR_RSUN_RUN=2 (this is how ssr_pipeline.py runs stages)
+for _part in ['lidar_run','lpi_run','preprocessing_run','horizon_run','rsun_run','algore_run']:
+    if('SSR_'+_part.upper() in os.environ):
+        globals()[_part] = int(os.environ['SSR_'+_part.upper()])
 
 #----------------------------------------------------------------------------
 # GENERAL PARAMETERS
@@ -55,20 +62,27 @@ aspectc = P + 'canaspect'        # aspect, canopy
 vegheight = P + 'vegheight'      # vegetation height
 albedo = P + 'albedo'            # albedo by vegtype
 demhor = P + 'demhor'            # horizon, bare-earth
-canhor = P + 'demhor'            # horizon, canopy
+canhor = P + 'canhor'            # horizon, canopy
 
 #----------------------------------------------------------------------------
 # SSR1: LIDAR IMPORT PARAMETERS
 # LiDAR downloaded from http://opentopography.org.
 # National Center for Airborne Laser Mapping (NCALM) distributes laser hits as 2 datasets:  total and ground filtered.
-# Version 1.0 only processes ASCII files with ground filtered exported to a separate directory.  Future versions will 
-# use .las files in a single directory.
+# ASCII files need ground filtered exported to a separate directory (LidarPoints).  .las/.laz files are read
+# from a single directory (inPath) and split into ground/total by the classification byte.
 year = 'y14'	        		            # Year the LiDAR was flown 2004 'y04', 2004 modified to match y09 'ym4',2009 'y09'
 pdensitypref = 'pointdensity_c'+str(C)+year	    # prefix to the point density rasters
-inSuffix='xyz'                                      # filename suffix to filter for
+lidar_cells = [C]                                   # cell sizes rasterized in the same pass, e.g. ['1','2','30']. Prefix 'pointdensity_c'+cell+year
+canstat = 'max'                                     # canopy from point 'max', or a percentile 'p99'/'p95' that ignores bird and noise hits
+lidar_stats = []                                    # extra per cell elevation rasters 'min','max','mean','p95','p99'. Prefix pmin,pmax,pmean,p95,p99 +'_c'+cell+year
+inSuffix='xyz'                                      # filename suffix to filter for: 'xyz' ascii, 'las' or 'laz' (laz needs laszip)
+las_ground = [2]                                    # LAS classification codes counted as ground, 2 = ASPRS ground
 overlap = float(0)				    # tile overlap in meters  10.00 m (y04,y09), 0.00 m (y14)
 sep = ','				            # separator in lidar files ' ' or ','
 LidarPoints = [ 'filtered' , 'unfiltered' ]         # subdirectories under inPath.  y04 = [ 'ground' , 'all' ]
+lidar_incremental = True                            # with lidar_run = 2, re-bin only new or changed tiles (tile manifest in mlpi)
+pointcache = gisdbase+'/ssr_pointcache'            # binary copy of the point files, read by memory mapping. '' = no cache
+lidar_cores = 0                                     # processes binning tiles in parallel. 0 = cpu count - 2, 1 = one at a time
 inPath='/data/source/LiDAR/2014_EelBathymetry_LiDAR/Angelo/Tiles_ASCII_xyz/'
 #inPath='/data/source/LiDAR/2009_SFEel_LiDAR/ascii/'
 #inPath='/data/source/LiDAR/2004_SFEel_LiDAR/TerraScan_EEL/laser_export/'
@@ -77,7 +91,14 @@ inPath='/data/source/LiDAR/2014_EelBathymetry_LiDAR/Angelo/Tiles_ASCII_xyz/'
 # SSR2: LPI PARAMETERS
 #Radius = 8				# Previous radius was 8, but that is actually 8 cells per side * 2meters per cell = 32 meters, and actually I used 31x31 cell square.
 boxsize = '17'                          # Size is cell size of box for r.neighbors.  This is different than the actual box (9 cells x 2 meter cells = 18 meters)
-lpipref = 'lpi_c'+C+year+'s'+boxsize   # add the month to the end, e.g. lpi_c2y09s17m10
+lpipref = 'lpi_c'+C+year+'s'+boxsize   # add the weight to the end, e.g. lpi_c2y09s17w3
+lpi_sweep = []                          # calibration: [(size,layout)] more LPI from the same pass, e.g. [(31,'box'),(45,'box')]
+                                        # layout 'box' = weight file boxes scaled to size, or a weight file prefix in the script directory (size from the files)
+                                        # rasters 'lpi_c'+C+year+'s'+size+layout+'w'+weight
+lpi_method = 'auto'                     # LPI box sums: 'sat' (rectangles), 'direct', 'fft' (large kernels of any shape), 'auto' = cheapest per kernel
+lpi_cores = 0                           # processes computing LPI strips. 0 = cpu count - 2
+lpi_memory = 2048                       # MB for the LPI strips of all processes together
+lpi_month_weights = {1:1, 2:2, 3:2, 4:3, 5:4, 6:4, 7:4, 8:3, 9:3, 10:2, 11:2, 12:1}  # LPI weight (box) used for each month
 
 #----------------------------------------------------------------------------
 # SSR3: R.HORIZON PARAMETERS
@@ -90,10 +111,29 @@ dist = '0.5'                    # normal range (0.5 - 1.5) previous runs used 0.
 # SSR4: R.SUN Solar Model Parameters
 # r.sun is designed to be run for 1 day, 24 hours.  script runs for 1 year, every week.
 linke_array = 'helios'          # various options of turbidity values, "helios" is default for Angelo.
+                                # or a CSV file of 12 monthly or 365/366 daily values (ssr_linke.py)
+linke_rasters = ''              # prefix of 12 monthly Linke turbidity rasters in PERMANENT (prefix01..prefix12),
+                                # blended per day for spatially varying turbidity. '' = linke_array everywhere
 tl = linke_array
 start_day = 5                   # First Julian Day calculated
 week_step = 7                   # run r.sun once every week
 timestep = '0.1'                # 0.1 decimal hour = 6 minute timestep, default 0.5(30min), last run 0.5
+rsun_dedup = 0.0                # pair days whose solar declination differs by at most this (degrees). r.sun runs
+                                # once per pair, the other day is scaled by clear-sky ratios (ssr_solar.py). 0 = off
+rsun_dedup_maxerr = 0.02        # pairs whose error bound on daily global irradiation is larger run both days
+rsun_cores = 0                  # r.sun processes pulling (surface, day) jobs from a shared queue. 0 = cpu count - 2
+rsun_tile = 0                   # r.sun on tiles of this many cells (rows and cols) with a halo, patched together. 0 = whole region
+                                # Needs horizon_run > 0: shadows on the fly need a halo of maxdistance, so without
+                                # horizons r.sun runs on the whole region (with a warning).
+rsun_engine = 'rsun'            # 'rsun' = one r.sun process per day, 'numpy' = clear-sky engine of ssr_solar.py (uses horizon_run)
+rsun_memory = 2048              # MB for the engine strips of all processes together
+rsun_batch = 13                 # days per engine pass. Each pass reads the packed horizons once.
+rsun_validate = []              # days also run with r.sun to check the engine, e.g. [5,173]
+rsun_validate_tol = 0.05        # largest 95th percentile error of the engine against r.sun, relative to the mean
+rsun_outputs = []               # r.sun outputs written: 'beam','diff','refl','dur'. [] = all four.
+                                # ssr_pipeline.py writes only what later stages read (beam, diff) plus these
+if('SSR_RSUN_OUTPUTS' in os.environ):
+    rsun_outputs = [s for s in os.environ['SSR_RSUN_OUTPUTS'].split(',') if s != '']
 calib = 'hd'                    # r.sun calibration code:  'hd' = 0.50 * Diffuse, 1.0 * Direct, reflection is ignored.
                                 # calibration needs to be moved to algore script
 
@@ -101,7 +141,7 @@ calib = 'hd'                    # r.sun calibration code:  'hd' = 0.50 * Diffuse
 # SSR5: ALGORE PARAMETERS
 maxheight = '2'   			    # Vegetation height after which canopy is set to null
 #halfdiff = True                            # Reduces the r.sun diffuse output by half. suffix 'half' on diffuse and global maps
-keeptemp = True 			    # Testing only. Should be false for production.
+keeptemp = False 			    # Testing only: also write the intermediate maps (subbeam, subdiff, subcanopy, canglob, opencanopy)
 lpivsjune = False                           # Analysis only. Uses June LPI only
 sky = 'cs'				    # cs 'clear sky' or rs 'real sky' which includes cloudiness index.
 algore = 'gl'		                    # Options: 'pl' = Power Law, 'nl' = Natural Log, 'd' for old default value of 1, 
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_pipeline.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               from ssr_run_all.sh
+# PURPOSE:      Runs the SSR stages (lidar, lpi, preprocessing, horizon, rsun,
+#               algore) in order, each only when its products are stale.
+#               Every stage lists the products it reads and makes (rasters,
+#               files) and the parameters of ssr_params.py it depends on. Its key
+#               is the hash of those parameters and the content (md5) of its
+#               inputs, so a stage runs again when an upstream product really
+#               changed, not when it was only rewritten. A stage whose key,
+#               outputs and output checksums match the last run is skipped.
+#               The *_run flags pick the stages: 0 = off (its products are
+#               used as they are), 1 = run when stale, 2 = always run.
+#               r.sun writes only the outputs a later stage reads (beam, diff
+#               for ssr_algore.py) plus rsun_outputs. That list is not part of
+#               its key: outputs asked for later are built when missing, and
+#               only the missing kinds.
+#               Stages run as the usual scripts, with SSR_*_RUN (ssr_params.py)
+#               set in their environment. A stage runs with overwrite on, and
+#               is done when the script exits 0 and all its outputs are there.
+#               Run with -n to only list what is stale. The stages and when
+#               they are stale are in ssr_stages.py.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+# GLOBALS
+global lf
+global gisbase
+global gisdbase
+
+# MODULES
+import json
+import hashlib
+import subprocess
+
+# GRASS & SSR environment setup for external use
+from ssr_params import *
+import os
+import sys
+gisdbase = os.path.abspath(gisdbase)
+os.environ['GISBASE'] = gisbase
+sys.path.append(os.path.join(os.environ['GISBASE'], "etc", "python"))
+import grass.script as grass
+import grass.script.setup as gsetup
+# ssr_utilities must go after grass.script imports
+from ssr_utilities import *
+from ssr_points import point_tiles
+from ssr_tiles import file_md5, file_stamp, manifest_load, manifest_save
+from ssr_stages import *
+
+pipeline_name = 'ssr_pipeline.json'
+run_flags = ['lidar_run','lpi_run','preprocessing_run','horizon_run','rsun_run','algore_run']
+
+
+###############################################################
+#
+#   PRODUCT HASHES: md5 of rasters and files, size and mtime of
+#   the LiDAR tiles of a directory (the tiles are hashed by
+#   ssr_lidar.py itself).
+#
+###############################################################
+
+def product_path(product):
+    if(product.startswith('file:')):
+        path = product[5:]
+        if(os.path.exists(path)):
+            return path
+        return None
+    name,mapset = product.split('@')
+    return raster_file(name,mapset)
+
+def product_hash(files,product):
+    # md5 of a product, None if missing. Files whose size and mtime did not change
+    # keep their checksum from the last run (files cache), the others are hashed again.
+    if(product.startswith('points:')):
+        stamps = []
+        for tilepath,tile,prefs in point_tiles(product[7:],inSuffix,LidarPoints):
+            stamps.append([tilepath] + list(file_stamp(tilepath)))
+        return hashlib.md5(json.dumps(stamps).encode('utf-8')).hexdigest()
+    path = product_path(product)
+    if(path is None):
+        return None
+    size,mtime = file_stamp(path)
+    old = files.get(path)
+    if(old is not None and old['size'] == size and old['mtime'] == mtime):
+        return old['md5']
+    md5 = file_md5(path)
+    files[path] = {'size':size,'mtime':mtime,'md5':md5}
+    return md5
+
+def product_hashes(files,products):
+    return dict([(p,product_hash(files,p)) for p in products])
+
+
+###############################################################
+#
+#   RUN
+#
+###############################################################
+
+def stage_run(stage,runenv,lf):
+    # runs the stage script with only this stage switched on, returns its exit status
+    env = dict(os.environ)
+    for flag in run_flags:
+        env['SSR_'+flag.upper()] = '0'
+    env.update(runenv)
+    printout("Running "+stage['script']+" with "+' '.join([k+'='+v for k,v in sorted(runenv.items())]),lf)
+    return subprocess.call([sys.executable,get_path()+stage['script']],env=env,cwd=get_path())
+
+def main():
+    # Open log file
+    tlog = dt.datetime.strftime(dt.datetime.now(),"%Y-%m-%d_h%Hm%M")
+    lf = open(gisdbase+os.sep+'ssr_'+tlog+'_pipeline.log', 'a')
+    dryrun = ('-n' in sys.argv[1:])
+    gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
+
+    printout('---------------------------------------',lf)
+    printout('-- SSR PIPELINE --',lf)
+    printout('          location: '+location,lf)
+    printout('            region: '+bregion,lf)
+    printout('           dry run: '+str(dryrun),lf)
+    stages = pipeline_stages()
+    for stage in stages:
+        printout('%14s: run = %d, %d inputs, %d outputs, after %s' % (stage['name'],globals()[stage['run']], \
+                    len(stage['inputs']),len(stage['outputs']),','.join(stage_upstream(stages,stage)) or '-'),lf)
+    printout('---------------------------------------',lf)
+
+    # Manifest of the last run: key and output checksums of every stage, checksum cache of the files
+    manifest_file = gisdbase+os.sep+location+os.sep+pipeline_name
+    manifest = manifest_load(manifest_file)
+    manifest.setdefault('stages',{})
+    files = manifest.setdefault('files',{})
+
+    for stage in stages:
+        if(globals()[stage['run']] == 0):
+            printout(stage['name']+": off",lf)
+            continue
+        # inputs are hashed now, after the stages before this one ran
+        key = stage_key(stage,product_hashes(files,stage['inputs']))
+        reason,missing = stage_stale(manifest,stage,key,product_hashes(files,stage['outputs']))
+        if(reason == ''):
+            printout(stage['name']+": current, skipped",lf)
+            continue
+        printout(stage['name']+": stale, "+reason,lf)
+        if(dryrun):
+            continue
+        start = dt.datetime.now()
+        ret = stage_run(stage,stage_env(stage,missing),lf)
+        failed = stage_record(manifest,stage,key,ret,product_hashes(files,stage['outputs']))
+        manifest_save(manifest_file,manifest)
+        if(failed != ''):
+            printout(stage['name']+": FAILED, "+failed,lf)
+            printout("Stopping. Later stages would read stale products.",lf)
+            break
+        printout(stage['name']+": done, processing time: "+str(dt.datetime.now() - start),lf)
+
+    printout('ssr_pipeline.py DONE',lf)
+    lf.close()
+
+if __name__ == "__main__":
+    main()
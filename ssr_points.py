@@ -0,0 +1,729 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_points.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               based on ssr_lidar.py
+# PURPOSE:      Streaming point cloud binning for the LiDAR import.
+#               1. Read xyz point files once, in chunks of bounded size, or
+#                  memory-map the point records of .las files (.laz through
+#                  laszip) and split ground/non-ground by classification.
+#                  Points are kept in a binary columnar cache after the
+#                  first read, so later runs skip the text parsing.
+#               2. Bin each chunk into grids aligned to the GRASS region,
+#                  one per cell size, filling the per cell statistics asked
+#                  for (count, min, max, mean, percentiles, see AGGREGATORS)
+#                  and the tile bounds (n,s,e,w,b,t) in the same pass.
+#               3. Bin tiles in parallel across a process pool (bin_tiles).
+#               4. Mosaic tile windows straight into a region sized array,
+#                  clipping the tile overlap on the way (mosaic_add).
+#               This replaces r.in.xyz -sg followed by method=n and
+#               method=max, which read every file three times.
+#               NOTE: numpy only, no GRASS calls. Writing the grids to
+#               rasters is done by the caller (ssr_utilities.raster_write).
+#
+# DEPENDENCIES: numpy 1.13 to 2.4 (numpy.isin is new in 1.13, numpy.in1d is
+#               gone in 2.4). 1.16 is the last numpy release for Python 2.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import json
+import struct
+import hashlib
+import collections
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+import numpy
+
+chunk_bytes = 64*1024*1024      # text read per chunk, keeps memory bounded for any file size
+chunk_points = 4*1024*1024      # points per chunk for binary (.las) readers
+asprs_ground = [2]              # ASPRS classification codes counted as ground (filtered)
+
+
+###############################################################
+#
+#   READERS: yield (x,y,z) numpy arrays, one chunk at a time
+#
+###############################################################
+
+def read_xyz(filename,sep=',',chunk=chunk_bytes):
+    # ASCII x,y,z[,...] file. Extra columns are ignored, like r.in.xyz defaults.
+    f = open(filename,'r')
+    try:
+        ncols = 0
+        while True:
+            lines = f.readlines(chunk)
+            if(len(lines) == 0):
+                break
+            text = ''.join(lines).replace('\r','').strip()
+            if(text == ''):
+                continue
+            if(ncols == 0):
+                ncols = len(lines[0].strip().split(sep.strip() or None))
+            if(sep.strip() != ''):
+                text = text.replace('\n',sep)
+            values = numpy.fromstring(text,dtype=numpy.float64,sep=sep)
+            if(values.size % ncols != 0):
+                raise ValueError("malformed point file "+filename+": rows do not all have "+str(ncols)+" columns")
+            values = values.reshape(-1,ncols)
+            yield values[:,0],values[:,1],values[:,2]
+    finally:
+        f.close()
+
+
+def las_header(filename):
+    # Public header block, LAS 1.0 - 1.4. Only the fields needed to map the point records.
+    f = open(filename,'rb')
+    try:
+        head = f.read(375)
+    finally:
+        f.close()
+    if(head[0:4] != b'LASF'):
+        raise ValueError(filename+" is not a LAS file")
+    h = {}
+    h['version'] = struct.unpack('<BB',head[24:26])
+    h['offset'] = struct.unpack('<I',head[96:100])[0]
+    h['format'] = struct.unpack('<B',head[104:105])[0] & 0x3f     # bits 6,7 flag laz compression
+    h['reclen'] = struct.unpack('<H',head[105:107])[0]
+    h['count'] = struct.unpack('<I',head[107:111])[0]
+    h['scale'] = struct.unpack('<3d',head[131:155])
+    h['shift'] = struct.unpack('<3d',head[155:179])
+    maxx,minx,maxy,miny,maxz,minz = struct.unpack('<6d',head[179:227])
+    h['bounds'] = [maxy,miny,maxx,minx,minz,maxz]   # n,s,e,w,b,t like r.in.xyz -sg
+    if(h['version'] >= (1,4) and h['count'] == 0):
+        h['count'] = struct.unpack('<Q',head[247:255])[0]
+    return h
+
+def las_records(filename,h):
+    # memory-map the fixed size point records. Classification moved to byte 16 in formats 6-10.
+    if(h['format'] < 6):
+        names = ['X','Y','Z','flags']
+        offsets = [0,4,8,15]
+    else:
+        names = ['X','Y','Z','flags','cls']
+        offsets = [0,4,8,15,16]
+    formats = ['<i4','<i4','<i4','u1','u1'][0:len(names)]
+    rec = numpy.dtype({'names':names,'formats':formats,'offsets':offsets,'itemsize':h['reclen']})
+    return numpy.memmap(filename,dtype=rec,mode='r',offset=h['offset'],shape=(h['count'],))
+
+def read_las(filename,ground=asprs_ground,chunk=chunk_points):
+    # yields x,y,z,isground. Withheld points are dropped. .laz is decompressed once with laszip.
+    tmpdir = None
+    if(filename.lower().endswith('.laz')):
+        tmpdir = tempfile.mkdtemp(prefix='ssr_laz')
+        lasfile = os.path.join(tmpdir,os.path.basename(filename)[:-1]+'s')
+        try:
+            subprocess.check_call(['laszip','-i',filename,'-o',lasfile])
+        except OSError:
+            shutil.rmtree(tmpdir)
+            raise ValueError("reading "+filename+" requires the laszip command (LAStools)")
+        filename = lasfile
+    try:
+        h = las_header(filename)
+        pts = las_records(filename,h)
+        sx,sy,sz = h['scale']
+        ox,oy,oz = h['shift']
+        for i in range(0,h['count'],chunk):
+            p = pts[i:i+chunk]
+            if(h['format'] < 6):
+                keep = (p['flags'] & 0x80) == 0
+                cls = p['flags'] & 0x1f
+            else:
+                keep = (p['flags'] & 0x04) == 0     # bit 2 withheld, bit 3 is overlap (kept)
+                cls = p['cls']
+            p = p[keep]
+            x = p['X']*sx + ox
+            y = p['Y']*sy + oy
+            z = p['Z']*sz + oz
+            yield x,y,z,numpy.isin(cls[keep],ground)
+        del pts
+    finally:
+        if(tmpdir is not None):
+            shutil.rmtree(tmpdir)
+
+def is_las(filename):
+    return filename.lower().endswith('.las') or filename.lower().endswith('.laz')
+
+
+###############################################################
+#
+#   POINT CACHE: one binary file per column (x,y float64, z float32,
+#   ground flag uint8) plus a .json stamp, read back by memory mapping.
+#   Written during the first read of a tile, used while the source
+#   file keeps its size and mtime.
+#   z as float32 does not change the outputs, which are FCELL, and
+#   read_points hands out float32 z from the source files as well.
+#
+###############################################################
+
+cache_columns = [('x',numpy.float64),('y',numpy.float64),('z',numpy.float32),('g',numpy.uint8)]
+
+def cache_base(cachedir,filename):
+    # tiles from different directories often share names (filtered/unfiltered)
+    key = hashlib.md5(os.path.abspath(filename).encode('utf-8')).hexdigest()[0:8]
+    return os.path.join(cachedir,os.path.basename(filename)+'.'+key)
+
+def cache_stamp(filename,ground):
+    st = os.stat(filename)
+    return {'source':os.path.abspath(filename),'size':st.st_size,'mtime':st.st_mtime,'ground':list(ground)}
+
+def cache_valid(cachedir,filename,ground):
+    base = cache_base(cachedir,filename)
+    if(os.path.exists(base+'.json') == False):
+        return False
+    f = open(base+'.json','r')
+    try:
+        meta = json.load(f)
+    except ValueError:
+        return False
+    finally:
+        f.close()
+    count = meta.pop('count',-1)
+    if(meta != json.loads(json.dumps(cache_stamp(filename,ground)))):
+        return False
+    for col,dtype in cache_columns:
+        if(os.path.exists(base+'.'+col) == False or os.path.getsize(base+'.'+col) != count*numpy.dtype(dtype).itemsize):
+            return False
+    return True
+
+def cache_read(cachedir,filename,chunk=chunk_points):
+    # yields x,y,z,isground from the memory mapped columns
+    base = cache_base(cachedir,filename)
+    cols = {}
+    for col,dtype in cache_columns:
+        if(os.path.getsize(base+'.'+col) == 0):
+            return
+        cols[col] = numpy.memmap(base+'.'+col,dtype=dtype,mode='r')
+    for i in range(0,cols['x'].size,chunk):
+        yield cols['x'][i:i+chunk],cols['y'][i:i+chunk],cols['z'][i:i+chunk],cols['g'][i:i+chunk].view(numpy.bool_)
+
+def cache_write(cachedir,filename,ground,points):
+    # pass the chunks through while appending them to the cache. The stamp is written last,
+    # so an interrupted read leaves an invalid cache, not a truncated one.
+    try:
+        os.makedirs(cachedir)
+    except OSError:
+        pass    # exists, or created by another worker
+    base = cache_base(cachedir,filename)
+    if(os.path.exists(base+'.json')):
+        os.remove(base+'.json')
+    files = {}
+    for col,dtype in cache_columns:
+        files[col] = open(base+'.'+col,'wb')
+    count = 0
+    try:
+        for x,y,z,g in points:
+            if(g is None):
+                g = numpy.zeros(x.size,dtype=numpy.bool_)   # xyz files: class comes from the directory
+            for col,dtype,data in [('x',numpy.float64,x),('y',numpy.float64,y),('z',numpy.float32,z),('g',numpy.uint8,g)]:
+                numpy.asarray(data,dtype=dtype).tofile(files[col])
+            count += x.size
+            yield x,y,z,g
+    finally:
+        for col in files:
+            files[col].close()
+    meta = cache_stamp(filename,ground)
+    meta['count'] = count
+    f = open(base+'.json','w')
+    try:
+        json.dump(meta,f)
+    finally:
+        f.close()
+
+def read_points(filename,sep=',',ground=asprs_ground,cachedir=''):
+    # x,y,z,isground chunks of any tile: from the point cache when it is current, else from
+    # the file itself (filling the cache). isground is None for xyz files read from text.
+    if(cachedir != '' and cache_valid(cachedir,filename,ground)):
+        for points in cache_read(cachedir,filename):
+            yield points
+        return
+    if(is_las(filename)):
+        points = read_las(filename,ground)
+    else:
+        points = ((x,y,z,None) for x,y,z in read_xyz(filename,sep))
+    if(cachedir != ''):
+        points = cache_write(cachedir,filename,ground,points)
+    # z as float32, as it reads back from the cache, so cell means and percentiles
+    # do not depend on whether the cache was used
+    for x,y,z,g in points:
+        yield x,y,z.astype(numpy.float32),g
+
+
+###############################################################
+#
+#   GRIDS: a window of cells aligned to the region (north,west,res).
+#   res is a cell size or (nsres,ewres) as reported by g.region.
+#   The window grows as points arrive, so the bounds do not have to
+#   be known before the file is read.
+#   Each grid keeps the arrays of the statistics it was made for
+#   (see AGGREGATORS), all filled from the same pass.
+#
+###############################################################
+
+default_stats = ['n','max']     # point count and max elevation: point density and canopy
+
+def grid_new(north,west,res,stats=None):
+    if(numpy.isscalar(res)):
+        res = (res,res)
+    if(stats is None):
+        stats = default_stats
+    grid = {'north':float(north),'west':float(west),'nsres':float(res[0]),'ewres':float(res[1]),
+            'row0':0,'col0':0,'stats':list(stats),'arrays':{'count':(numpy.uint32,0,0)},
+            'npoints':0,'bounds':None}
+    for stat in stats:
+        for key,dtype,depth,fill in aggregator(stat)[0]:
+            grid['arrays'][key] = (dtype,depth,fill)
+    for key,(dtype,depth,fill) in grid['arrays'].items():
+        grid[key] = _cell_array((0,0),dtype,depth,fill)
+    return grid
+
+def _cell_array(shape,dtype,depth,fill):
+    # rows x cols, or rows x cols x depth for per cell buffers
+    if(depth > 0):
+        shape = shape + (depth,)
+    a = numpy.empty(shape,dtype=dtype)
+    a.fill(fill)
+    return a
+
+def _grow(grid,rmin,rmax,cmin,cmax):
+    rows,cols = grid['count'].shape
+    if(rows > 0):
+        if(rmin >= grid['row0'] and rmax < grid['row0']+rows and cmin >= grid['col0'] and cmax < grid['col0']+cols):
+            return
+        rmin = min(rmin,grid['row0'])
+        rmax = max(rmax,grid['row0']+rows-1)
+        cmin = min(cmin,grid['col0'])
+        cmax = max(cmax,grid['col0']+cols-1)
+    r = grid['row0']-rmin
+    c = grid['col0']-cmin
+    for key,(dtype,depth,fill) in grid['arrays'].items():
+        a = _cell_array((rmax-rmin+1,cmax-cmin+1),dtype,depth,fill)
+        if(rows > 0):
+            a[r:r+rows,c:c+cols] = grid[key]
+        grid[key] = a
+    grid['row0'] = rmin
+    grid['col0'] = cmin
+
+def _cells(grid,n,s,e,w):
+    # rows and columns of the cells holding the points on the edges n,s,e,w
+    rmin = int(numpy.floor((grid['north'] - n)/grid['nsres']))
+    rmax = int(numpy.floor((grid['north'] - s)/grid['nsres']))
+    cmin = int(numpy.floor((w - grid['west'])/grid['ewres']))
+    cmax = int(numpy.floor((e - grid['west'])/grid['ewres']))
+    return rmin,rmax,cmin,cmax
+
+def grid_reserve(grid,bounds):
+    # allocate the window for known tile bounds n,s,e,w
+    rmin,rmax,cmin,cmax = _cells(grid,bounds[0],bounds[1],bounds[2],bounds[3])
+    _grow(grid,rmin,rmax,cmin,cmax)
+
+def _groups(idx):
+    # sort cell indices so each cell's points are contiguous; returns order, cells, starts
+    order = numpy.argsort(idx,kind='mergesort')
+    sidx = idx[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True],sidx[1:] != sidx[:-1])))
+    return order,sidx[starts],starts
+
+def grid_add(grid,x,y,z):
+    if(x.size == 0):
+        return
+    rows = numpy.floor((grid['north'] - y)/grid['nsres']).astype(numpy.int64)
+    cols = numpy.floor((x - grid['west'])/grid['ewres']).astype(numpy.int64)
+    # tile bounds, same as r.in.xyz -sg
+    b = [y.max(),y.min(),x.max(),x.min(),z.min(),z.max()]
+    if(grid['bounds'] is not None):
+        o = grid['bounds']
+        b = [max(b[0],o[0]),min(b[1],o[1]),max(b[2],o[2]),min(b[3],o[3]),min(b[4],o[4]),max(b[5],o[5])]
+    grid['bounds'] = b
+    grid['npoints'] += x.size
+    _grow(grid,rows.min(),rows.max(),cols.min(),cols.max())
+    ncols = grid['count'].shape[1]
+    idx = (rows - grid['row0'])*ncols + (cols - grid['col0'])
+    # points sorted by cell, in file order within each cell (stable sort)
+    order,cells,starts = _groups(idx)
+    zs = z[order]
+    count = grid['count'].reshape(-1)
+    before = count[cells].astype(numpy.int64)
+    count[cells] += numpy.diff(numpy.append(starts,idx.size)).astype(numpy.uint32)
+    for stat in grid['stats']:
+        add = aggregator(stat)[1]
+        if(add is not None):
+            add(grid,stat,cells,starts,zs,before)
+
+
+###############################################################
+#
+#   AGGREGATORS: per cell statistics of the point elevations.
+#   aggregators[stat] = (arrays,add,value)
+#     arrays: [(key,dtype,depth,fill)] kept in the grid for the stat
+#     add(grid,stat,cells,starts,zs,before): one chunk of points, zs sorted
+#         by cell (starts), before = point count of the cells before the chunk
+#     value(grid,stat): float64 cell values, the count is 0 where no points fell
+#   'n','min','max','mean' are exact. 'pNN' (e.g. 'p95','p99') is a
+#   percentile. Only the tail on the side of the percentile is kept: the
+#   highest sketch_tail heights of each cell for p95, p99 (the lowest for
+#   p < 0.5). It is exact (as numpy.percentile) while the percentile lies
+#   in the upper half of the tail, (count-1)*(1-p) <= sketch_tail/2-2:
+#   up to 1241 points per cell for p95, 6201 for p99. Past that, each time
+#   the count doubles the tail is thinned to every other height, so a kept
+#   height stands for w = 2, 4, .. points, w < 2*count*(1-p)/(sketch_tail/2-2).
+#   The percentile is then off by a few ranks of w, growing with the number
+#   of chunks that add points to the cell (within 3w for 20 chunks in the
+#   tests), more if the points of a cell arrive sorted by height. Memory
+#   per cell is bounded whatever the point density.
+#
+###############################################################
+
+sketch_tail = 128    # heights kept per cell and percentile (512 bytes)
+
+def _add_min(grid,stat,cells,starts,zs,before):
+    zmin = grid['zmin'].reshape(-1)
+    zmin[cells] = numpy.minimum(zmin[cells],numpy.minimum.reduceat(zs,starts))
+
+def _add_max(grid,stat,cells,starts,zs,before):
+    zmax = grid['zmax'].reshape(-1)
+    zmax[cells] = numpy.maximum(zmax[cells],numpy.maximum.reduceat(zs,starts))
+
+def _add_sum(grid,stat,cells,starts,zs,before):
+    zsum = grid['zsum'].reshape(-1)
+    zsum[cells] += numpy.add.reduceat(zs.astype(numpy.float64),starts)
+
+def _value_count(grid,stat):
+    return grid['count'].astype(numpy.float64)
+
+def _value_min(grid,stat):
+    return grid['zmin']
+
+def _value_max(grid,stat):
+    return grid['zmax']
+
+def _value_mean(grid,stat):
+    return grid['zsum']/numpy.maximum(grid['count'],1)
+
+def stat_quantile(stat):
+    # 'p95' -> 0.95, 'p99.9' -> 0.999
+    try:
+        p = float(stat[1:])/100.0
+    except ValueError:
+        p = -1.0
+    if(stat[0] != 'p' or p <= 0.0 or p >= 1.0):
+        raise ValueError('unknown cell statistic: '+stat)
+    return p
+
+def _tail_side(p):
+    # the tail kept: highest heights (1) for p >= 0.5, else the lowest, stored negated (-1)
+    if(p >= 0.5):
+        return 1.0
+    return -1.0
+
+def _tail_level(n,p):
+    # thinning level of cells of n points: a kept height stands for 2**level points.
+    # 0 (exact) while the percentile lies in the upper half of the kept tail, the lower
+    # half leaves room for the heights that move up as points arrive.
+    over = (numpy.maximum(n,1)-1)*min(p,1.0-p)/(sketch_tail//2-2)
+    return numpy.ceil(numpy.log2(numpy.maximum(over,1.0)) - 1e-9).astype(numpy.int64)
+
+def _tail_keep(rank,step):
+    # heights kept when a tail is thinned by step: one of every step, the middle one,
+    # the upper and lower middle in turn when step is even so the ranks stay centred
+    return (rank % step) == (step - 1 + (rank//step) % 2)//2
+
+def _sort_desc(g,v):
+    # order by cell g, largest v first in each cell: numpy.lexsort((-v,g)) on whole number keys, faster
+    rank = numpy.empty(v.size,dtype=numpy.int64)
+    rank[numpy.argsort(-v)] = numpy.arange(v.size)
+    return numpy.argsort(g.astype(numpy.int64)*v.size + rank)
+
+def _add_quantile(grid,stat,cells,starts,zs,before):
+    p = stat_quantile(stat)
+    K = sketch_tail
+    sizes = numpy.diff(numpy.append(starts,zs.size))
+    lb = _tail_level(before,p)
+    la = _tail_level(before + sizes,p)
+    tail = grid['q'+stat].reshape(-1,K)
+    level = grid['l'+stat].reshape(-1)
+    cut = grid['c'+stat].reshape(-1)
+    r = numpy.arange(cells.size)
+    # kept tails of the cells that had points, largest first (-inf unused). Once a tail was
+    # cut to K heights, heights below its lowest one have lost their rank and are not added.
+    had = numpy.flatnonzero(before > 0)
+    old = tail[cells[had]]
+    kept = numpy.isfinite(old)
+    lowest = numpy.empty(cells.size)
+    lowest.fill(-numpy.inf)
+    last = numpy.maximum(kept.sum(axis=1)-1,0)
+    lowest[had] = numpy.where(cut[cells[had]] > 0,old[numpy.arange(had.size),last],-numpy.inf)
+    # thinned to the new level
+    kept &= _tail_keep(numpy.arange(K)[None,:],(2**(la-lb))[had][:,None])
+    # with the heights of the chunk, largest first in each cell
+    g = numpy.concatenate((numpy.repeat(had,kept.sum(axis=1)),numpy.repeat(r,sizes)))
+    v = numpy.concatenate((old[kept].astype(numpy.float64),_tail_side(p)*zs.astype(numpy.float64)))
+    new = numpy.concatenate((numpy.zeros(g.size-zs.size,dtype=numpy.bool_),numpy.ones(zs.size,dtype=numpy.bool_)))
+    order = _sort_desc(g,v)
+    g = g[order]
+    v = v[order]
+    new = new[order]
+    # the chunk's heights are thinned the same way, by their rank among the chunk's heights of the cell
+    first = numpy.searchsorted(g,r)[g]
+    seen = numpy.cumsum(new)
+    rank = seen - (seen[first] - new[first]) - 1
+    keep = ~new | ((v >= lowest[g]) & _tail_keep(rank,(2**la)[g]))
+    g = g[keep]
+    v = v[keep]
+    # the K largest of each cell are kept
+    rank = numpy.arange(g.size) - numpy.searchsorted(g,r)[g]
+    sel = rank < K
+    tail[cells[had]] = -numpy.inf
+    tail[cells[g[sel]],rank[sel]] = v[sel]
+    level[cells] = la
+    cut[cells] |= (numpy.bincount(g[~sel],minlength=cells.size) > 0)
+
+def _value_quantile(grid,stat):
+    # linear interpolation between the kept heights, as numpy.percentile. The percentile
+    # is (n-1)*(1-p) heights from the top (from the bottom for p < 0.5), each kept height
+    # the middle of w.
+    p = stat_quantile(stat)
+    K = sketch_tail
+    n = grid['count'].reshape(-1).astype(numpy.int64)
+    out = numpy.empty(n.size)
+    out.fill(numpy.nan)
+    c = numpy.flatnonzero(n > 0)
+    tail = grid['q'+stat].reshape(-1,K)[c].astype(numpy.float64)
+    last = numpy.maximum(numpy.isfinite(tail).sum(axis=1) - 1,0)
+    w = 2.0**grid['l'+stat].reshape(-1)[c]
+    u = numpy.maximum(((n[c]-1)*min(p,1.0-p) - (w-1)/2.0)/w,0.0)
+    lo = numpy.minimum(numpy.floor(u).astype(numpy.int64),last)
+    hi = numpy.minimum(lo+1,last)
+    r = numpy.arange(c.size)
+    out[c] = _tail_side(p)*(tail[r,lo] + numpy.minimum(u-lo,1.0)*(tail[r,hi]-tail[r,lo]))
+    return out.reshape(grid['count'].shape)
+
+aggregators = {
+    'n':    ([],None,_value_count),
+    'min':  ([('zmin',numpy.float64,0,numpy.inf)],_add_min,_value_min),
+    'max':  ([('zmax',numpy.float64,0,-numpy.inf)],_add_max,_value_max),
+    'mean': ([('zsum',numpy.float64,0,0.0)],_add_sum,_value_mean),
+    }
+
+def aggregator(stat):
+    # percentiles are registered the first time they are asked for
+    if(stat not in aggregators):
+        stat_quantile(stat)
+        aggregators[stat] = ([('q'+stat,numpy.float32,sketch_tail,-numpy.inf),
+                              ('l'+stat,numpy.uint8,0,0),
+                              ('c'+stat,numpy.uint8,0,0)],_add_quantile,_value_quantile)
+    return aggregators[stat]
+
+def stat_prefix(stat):
+    # raster name prefix of a statistic: 'n' -> 'pn', 'max' -> 'pmax', 'p95' -> 'p95'
+    if(stat in ['n','min','max','mean']):
+        return 'p'+stat
+    stat_quantile(stat)
+    return stat
+
+def grid_stat(grid,stat):
+    # float32 cell values of a statistic, NaN where no points fell (as r.in.xyz)
+    out = aggregator(stat)[2](grid,stat).astype(numpy.float32)
+    out[grid['count'] == 0] = numpy.nan
+    return out
+
+def bin_file(grids,filename,sep=',',cachedir=''):
+    # grids: one grid per cell size, all filled from the same read
+    for x,y,z,g in read_points(filename,sep,asprs_ground,cachedir):
+        for grid in grids:
+            grid_add(grid,x,y,z)
+    return grids
+
+def bin_las(grids_ground,grids_all,filename,ground=asprs_ground,cachedir=''):
+    # one read of a .las/.laz tile fills both the ground (filtered) and all points (unfiltered) grids
+    # at every cell size. Either list may be empty when only one class is wanted (e.g. canopy from all points)
+    for x,y,z,g in read_points(filename,',',ground,cachedir):
+        for grid in grids_all:
+            grid_add(grid,x,y,z)
+        if(len(grids_ground) > 0):
+            xg,yg,zg = x[g],y[g],z[g]
+            for grid in grids_ground:
+                grid_add(grid,xg,yg,zg)
+    return grids_ground,grids_all
+
+def point_tiles(inPath,inSuffix,LidarPoints):
+    # List of (file path, tile name, point classes the file fills), sorted so runs are repeatable.
+    # ASCII xyz: one subdirectory per class in LidarPoints. LAS/LAZ: a single directory,
+    # ground and all points are split by the classification byte.
+    tiles = []
+    if(is_las('.'+inSuffix)):
+        for strFile in sorted(os.listdir(inPath)):
+            t = strFile.split('.')
+            if(len(t) > 1 and t[1] == inSuffix):
+                tiles.append((inPath+strFile,t[0],list(LidarPoints)))
+    else:
+        for pref in LidarPoints:
+            inDir = inPath+pref+os.sep
+            for strFile in sorted(os.listdir(inDir)):
+                t = strFile.split('.')
+                if(len(t) > 1 and t[1] == inSuffix):
+                    tiles.append((inDir+strFile,t[0],[pref]))
+    return tiles
+
+def bin_tile(tilepath,prefs,frames,sep=',',ground=asprs_ground,bounds=None,cachedir='',stats=None):
+    # One pass over a tile file. Returns a list of grids per point class (prefs = [ground, all] for LAS),
+    # one grid per frame. frames: (north,west,res) of every cell size wanted, see grid_new.
+    # bounds (n,s,e,w,...) from the tile index preallocate the windows, so they never grow.
+    # cachedir: binary point cache, '' = always read the file.
+    # stats: {point class: [statistics]} (see AGGREGATORS), None = default_stats
+    grids = {}
+    for pref in prefs:
+        grids[pref] = []
+        pstats = None
+        if(stats is not None):
+            pstats = stats[pref]
+        for north,west,res in frames:
+            grid = grid_new(north,west,res,pstats)
+            if(bounds is not None):
+                grid_reserve(grid,bounds)
+            grids[pref].append(grid)
+    if(is_las(tilepath)):
+        if(len(prefs) > 1):
+            bin_las(grids[prefs[0]],grids[prefs[-1]],tilepath,ground,cachedir)
+        else:
+            bin_las([],grids[prefs[0]],tilepath,ground,cachedir)
+    else:
+        bin_file(grids[prefs[0]],tilepath,sep,cachedir)
+    return grids
+
+def bin_tile_job(job):
+    # multiprocessing worker: job = (tilepath,prefs,frames,sep,ground,bounds,cachedir,stats)
+    return bin_tile(*job)
+
+def bin_tiles(jobs,cores=1,inflight=0):
+    # Bin tiles across a process pool. Grids come back in job order, so the
+    # mosaic is the same whatever the number of cores or the finishing order.
+    # At most inflight tiles (default 2 per core) are binned or waiting to be
+    # taken, so tiles finished early do not pile up behind a slow one.
+    if(cores <= 1):
+        for job in jobs:
+            yield bin_tile_job(job)
+        return
+    if(inflight < 1):
+        inflight = 2 * cores
+    pool = multiprocessing.Pool(cores)
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.apply_async(bin_tile_job,(job,)))
+            if(len(pending) >= inflight):
+                yield pending.popleft().get()
+        while(len(pending) > 0):
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def grid_edges(grid):
+    # n,s,e,w of the grid window, on cell boundaries of the region
+    rows,cols = grid['count'].shape
+    n = grid['north'] - grid['row0']*grid['nsres']
+    s = n - rows*grid['nsres']
+    w = grid['west'] + grid['col0']*grid['ewres']
+    e = w + cols*grid['ewres']
+    return n,s,e,w
+
+def grid_clip_edges(grid,bounds,overlap):
+    # n,s,e,w of the cells whose centers lie inside the tile bounds less the overlap.
+    # Edges are on cell boundaries of the region, so g.region does not change the resolution.
+    nsres = grid['nsres']
+    ewres = grid['ewres']
+    n = bounds[0] - overlap
+    s = bounds[1] + overlap
+    e = bounds[2] - overlap
+    w = bounds[3] + overlap
+    rmin = int(numpy.ceil((grid['north'] - n)/nsres - 0.5))
+    rmax = int(numpy.floor((grid['north'] - s)/nsres - 0.5))
+    cmin = int(numpy.ceil((w - grid['west'])/ewres - 0.5))
+    cmax = int(numpy.floor((e - grid['west'])/ewres - 0.5))
+    return grid['north'] - rmin*nsres,grid['north'] - (rmax+1)*nsres,grid['west'] + (cmax+1)*ewres,grid['west'] + cmin*ewres
+
+def mosaic_window(shape,grid,edges=None):
+    # rows r0:r1, cols c0:c1 of a region sized mosaic that a tile may write, or None.
+    # edges (n,s,e,w) is the overlap clip.
+    rows,cols = grid['count'].shape
+    r0 = grid['row0']
+    c0 = grid['col0']
+    r1 = r0 + rows
+    c1 = c0 + cols
+    if(edges is not None):
+        r0 = max(r0,int(round((grid['north'] - edges[0])/grid['nsres'])))
+        r1 = min(r1,int(round((grid['north'] - edges[1])/grid['nsres'])))
+        c0 = max(c0,int(round((edges[3] - grid['west'])/grid['ewres'])))
+        c1 = min(c1,int(round((edges[2] - grid['west'])/grid['ewres'])))
+    r0 = max(r0,0)
+    c0 = max(c0,0)
+    r1 = min(r1,shape[0])
+    c1 = min(c1,shape[1])
+    if(r0 >= r1 or c0 >= c1):
+        return None
+    return [r0,r1,c0,c1]
+
+def mosaic_add(mosaic,grid,values,edges=None):
+    # Write a tile window into a region sized array (e.g. a memory mapped grass.script.array).
+    # Only cells inside edges (n,s,e,w overlap clip) are written, and only where the mosaic
+    # is still null, so the first tile wins as it does with r.patch. Returns the window.
+    win = mosaic_window(mosaic.shape,grid,edges)
+    if(win is None):
+        return None
+    r0,r1,c0,c1 = win
+    src = values[r0-grid['row0']:r1-grid['row0'],c0-grid['col0']:c1-grid['col0']]
+    dst = mosaic[r0:r1,c0:c1]
+    mask = numpy.isnan(dst) & ~numpy.isnan(src)
+    dst[mask] = src[mask]
+    return win
+
+def mosaic_tiles(mosaics,tiles,frames,sep=',',ground=asprs_ground,overlap=0,cachedir='',cores=1):
+    # The import loop shared by the canopy scripts: bin every tile once and write each statistic
+    # into its mosaic, first tile wins. mosaics: {(point class,frame index,stat): region sized array}.
+    # tiles as returned by point_tiles. Yields (tilepath,tile,grids) as each tile is written.
+    stats = {}
+    for pref,k,stat in sorted(mosaics.keys()):
+        if(stat not in stats.setdefault(pref,[])):
+            stats[pref].append(stat)
+    jobs = []
+    for tilepath,tile,prefs in tiles:
+        for pref in prefs:
+            stats.setdefault(pref,['n'])
+        jobs.append((tilepath,prefs,frames,sep,ground,None,cachedir,stats))
+    for (tilepath,tile,prefs),grids in zip(tiles,bin_tiles(jobs,cores)):
+        tbounds = grids[prefs[-1]][0]['bounds']
+        for pref in prefs:
+            for k,grid in enumerate(grids[pref]):
+                if(grid['npoints'] == 0):
+                    continue
+                # clip tile, remove overlap
+                edges = None
+                if(overlap != 0):
+                    edges = grid_clip_edges(grid,tbounds,overlap)
+                for stat in stats[pref]:
+                    if((pref,k,stat) in mosaics):
+                        mosaic_add(mosaics[(pref,k,stat)],grid,grid_stat(grid,stat),edges)
+        yield tilepath,tile,grids
+
+def windows_intersect(a,b):
+    return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+
+def grid_count(grid):
+    # float point count, NaN where no points fell (r.in.xyz method=n writes null)
+    return grid_stat(grid,'n')
+
+def grid_max(grid):
+    # maximum elevation, NaN where no points fell (r.in.xyz method=max)
+    return grid_stat(grid,'max')
@@ -8,6 +8,26 @@
 # PURPOSE:      Run the entire sequence of processing for the r.sun model.
 #               Threads a process per core for multicore processors (poor
 #               man's multithreading).
+#               Horizon angles are computed once per surface (r.horizon) into
+#               the horizon mapset and reused by every r.sun day. They are only
+#               recomputed when the dem or canopy changes (horizon manifest).
+#               Optionally days of equal solar declination are paired (rsun_dedup):
+#               r.sun runs once per pair, the other day is scaled (ssr_solar.py).
+#               rsun_engine = 'numpy' replaces the r.sun processes by the clear-sky
+#               engine of ssr_solar.py: all days in one pass over strips of the
+#               region, reading the packed horizons. rsun_validate days are also
+#               run with r.sun and compared.
+#               rsun_tile splits the region into tiles, each run with a halo and
+#               cropped to its core, so (surface, day, tile) jobs fill any number of
+#               cores. Tiles are patched together into the sun mapset. Tiling needs
+#               the horizons (horizon_run > 0), otherwise the region is not tiled.
+#               Linke turbidity from ssr_linke.py: 366-day tables of a built in series
+#               or a CSV file, or the daily blend of 12 monthly rasters (linke_rasters).
+#               r.sun jobs are kept in a ledger (state, temp mapset, output sizes and mtimes),
+#               so a rerun after a crash only runs the jobs that did not finish and
+#               merges every job from the temp mapset that holds it.
+#               The merge renames the raster files from the temp mapsets into the sun
+#               mapset (same file system), g.copy only where a rename is not possible.
 #               NOTE: run ssr_lidar.py first!
 #
 # SOURCE MAPS:  bare-earth dem and canopy dem.  all else is calculated from them.
@@ -29,9 +49,9 @@ global gisdbase
 
 # MODULES REQUIRED
 import traceback
+import Queue
 import multiprocessing as mp
 import numpy
-from scipy.interpolate import interpolate
 
 # GRASS & SSR environment setup for external use
 from ssr_params import *
@@ -44,6 +64,12 @@ import grass.script as grass
 import grass.script.setup as gsetup
 # ssr_utilities must go after grass.script imports
 from ssr_utilities import *
+from ssr_tiles import file_md5, manifest_load, manifest_save, manifest_settings
+from ssr_linke import linke_day, linke_table, linke_weights
+from ssr_solar import day_pairs, pair_factors, horizon_pack_new, horizon_pack_put, sun_strips, sun_strip_rows
+
+horizon_manifest = 'ssr_horizon_manifest.json'
+ledger_name = 'ssr_rsun_ledger.json'
 
 
 # FUNCTIONS
@@ -81,11 +107,151 @@ def preprocessing(localpath,mapset,canr,ow):
     str_result = 'Preprocessing: completed successfully using canopy raster: ',canr
     return str_result
 
-def worker_sun(cpu,julian_seed,step,demr,ow):
-    mtemp = 'temp'+str(cpu).zfill(2)
-    gsetup.init(gisbase, gisdbase, location, mtemp)
-    set_region(bregion,C)
-    
+def horizon_maps(horr):
+    # raster names r.horizon gives the angles of prefix horr, as r.sun reads them back
+    step = float(hstep)
+    return [horr+'_'+str(int(i*step+0.5)).zfill(3) for i in range(0,int(360/step))]
+
+def horizon_entry(old,elev):
+    # manifest entry of a surface: content hash of the elevation raster and horizon settings.
+    # The hash is only recomputed when the raster file was rewritten (size or mtime changed).
+    stamp = raster_stamp(elev,'PERMANENT')
+    if(old is not None and old['stamp'] == stamp):
+        md5 = old['md5']
+    else:
+        md5 = file_md5(raster_file(elev,'PERMANENT'))
+    return manifest_settings(stamp=stamp,md5=md5,region=[bregion,C],hstep=hstep,maxdistance=maxdistance,dist=dist)
+
+def horizon_current(old,entry,horr):
+    # horizons can be reused if the surface and settings match and every angle map is there
+    if(old is None or old['md5'] != entry['md5']):
+        return False
+    for key in ['region','hstep','maxdistance','dist']:
+        if(old[key] != entry[key]):
+            return False
+    rasters = grass.list_grouped('rast').get(mhorizon,[])
+    for hmap in horizon_maps(horr):
+        if(hmap not in rasters):
+            return False
+    return True
+
+def worker_horizon(demr,ow):
+    # region is set on the horizon mapset before the workers start
+    gsetup.init(gisbase, gisdbase, location, mhorizon)
+    if(demr == 'dem'):
+        elevdem = dem+'@PERMANENT'
+        horr = demhor
+    else:
+        elevdem = can+'@PERMANENT'
+        horr = canhor
+    grass.run_command("r.horizon", elevin=elevdem, horizonstep=hstep, \
+                        maxdistance=maxdistance, dist=dist, horizon=horr, overwrite=ow)
+
+def horizon_stage(force,lf):
+    # r.horizon for each surface whose dem or canopy changed, both surfaces in parallel
+    mapset_gotocreate_outside(mhorizon,bregion,C,lf)
+    manifest_file = gisdbase+os.sep+location+os.sep+mhorizon+os.sep+horizon_manifest
+    manifest = manifest_load(manifest_file)
+    surfaces = manifest.get('surfaces',{})
+    entries = {}
+    jobs = []
+    for demr,elev,horr in [('dem',dem,demhor),('can',can,canhor)]:
+        entries[demr] = horizon_entry(surfaces.get(demr),elev)
+        if(force == False and horizon_current(surfaces.get(demr),entries[demr],horr)):
+            printout("r.horizon: "+demr+" unchanged since horizons were computed. Using "+horr+"@"+mhorizon,lf)
+            continue
+        p = mp.Process(target=worker_horizon, args=(demr,1))
+        p.start()
+        jobs.append((demr,p))
+        printout("r.horizon: dem = "+demr+" pid = "+str(p.pid),lf)
+    for demr,p in jobs:
+        p.join()
+        if(p.exitcode != 0):
+            printout("r.horizon: "+demr+" FAILED. exit code "+str(p.exitcode),lf)
+            surfaces.pop(demr,None)
+        else:
+            printout("r.horizon: "+demr+" done.",lf)
+            surfaces[demr] = entries[demr]
+    manifest_save(manifest_file,{'surfaces':surfaces})
+
+def region_latitude():
+    # latitude of the region center, degrees
+    return float(grass.parse_command('g.region', flags='bg')['ll_clat'])
+
+def sun_pairs(days,lf):
+    # days of equal declination (within rsun_dedup degrees) whose error bound is within
+    # rsun_dedup_maxerr. Returns {day run by r.sun: [(scaled day, factors)]}
+    derived = {}
+    lat = region_latitude()
+    z = float(grass.parse_command('r.univar', flags='g', map=dem+'@PERMANENT')['mean'])
+    printout("Day pairs: latitude "+str(round(lat,4))+", mean elevation "+str(round(z,1))+" m",lf)
+    for a,b,dd in day_pairs(days,rsun_dedup):
+        f = pair_factors(lat,a,b,linke_interp(a,linke_array),linke_interp(b,linke_array),z,float(timestep))
+        msg = "Day pair "+str(a).zfill(3)+" -> "+str(b).zfill(3)+": declination diff "+str(round(dd,3))+ \
+                " deg, beam x"+str(round(f['beam'],4))+" diff x"+str(round(f['diff'],4))+ \
+                ", error bound beam "+str(round(f['errbeam']*100,2))+"% global "+str(round(f['errglob']*100,2))+"%"
+        if(f['errglob'] > rsun_dedup_maxerr):
+            printout(msg+". Too large, both days run.",lf)
+            continue
+        printout(msg,lf)
+        derived[a] = [(b,f)]
+    return derived
+
+def tile_tag(t):
+    # raster name suffix of tile t, none when the region is not tiled
+    if(t is None):
+        return ''
+    return '_t'+str(t).zfill(3)
+
+def tile_halo():
+    # cells around a tile. With precomputed horizons (made over the whole region) only the
+    # slope and aspect r.sun derives from the elevation look past the tile, one cell.
+    # Shadows on the fly (-s) need the terrain out to maxdistance.
+    if(horizon_run > 0):
+        return 1
+    return int(numpy.ceil(float(maxdistance) / float(C)))
+
+def sun_tiles(size,halo):
+    # tiles of size x size cells over the current region: [(core,halo window)], windows as
+    # g.region n,s,e,w. Halos are clipped to the region. [] when size is 0 (no tiling).
+    if(size <= 0):
+        return []
+    reg = grass.region()
+    rows = int(reg['rows'])
+    cols = int(reg['cols'])
+    tiles = []
+    for r0 in range(0,rows,size):
+        for c0 in range(0,cols,size):
+            r1 = min(rows,r0+size)
+            c1 = min(cols,c0+size)
+            windows = []
+            for a0,a1,b0,b1 in [(r0,r1,c0,c1),(max(0,r0-halo),min(rows,r1+halo),max(0,c0-halo),min(cols,c1+halo))]:
+                windows.append({'n':reg['n'] - a0 * reg['nsres'],'s':reg['n'] - a1 * reg['nsres'], \
+                                'w':reg['w'] + b0 * reg['ewres'],'e':reg['w'] + b1 * reg['ewres'], \
+                                'nsres':reg['nsres'],'ewres':reg['ewres']})
+            tiles.append(tuple(windows))
+    return tiles
+
+def sun_jobs(days,ntiles=0):
+    # (surface, day, tile) r.sun jobs, both surfaces interleaved, tile None when not tiled.
+    # Long summer days first, so the short winter days fill in the gaps at the end of the run.
+    tiles = [None]
+    if(ntiles > 0):
+        tiles = range(0,ntiles)
+    jobs = []
+    for doy in days:
+        for t in tiles:
+            for demr in ['dem','can']:
+                jobs.append((demr,doy,t))
+    jobs.sort(key=lambda job: abs(job[1] - 172))
+    return jobs
+
+def sun_suffixes():
+    # r.sun outputs written (rsun_outputs), in r.sun order
+    return [s for s in ['beam','diff','refl','dur'] if len(rsun_outputs) == 0 or s in rsun_outputs]
+
+def sun_day(demr,doy,ow,tag=''):
+    # one r.sun run over the current region, returns its exit code. tag is appended to the output names.
     # Input Maps
     if(demr == 'dem'):
         elevdem = dem+'@PERMANENT'
@@ -93,58 +259,445 @@ def worker_sun(cpu,julian_seed,step,demr,ow):
     else:
         elevdem = can+'@PERMANENT'
         horr = canhor
+    day = str(doy).zfill(3)
+    # Output maps
+    beam = P+demr+day+'beam'+tag
+    diff = P+demr+day+'diff'+tag
+    refl = P+demr+day+'refl'+tag
+    dur = P+demr+day+'dur'+tag
+    #glob = P+demr+day+'glob'
+    opts = {'elevin':elevdem, 'albedo':albedo, 'horizonstep':hstep, \
+            'day':doy, 'step':timestep, 'overwrite':ow}
+    for suffix,opt,name in [('beam','beam_rad',beam),('diff','diff_rad',diff),('refl','refl_rad',refl),('dur','insol_time',dur)]:
+        if(suffix in sun_suffixes()):
+            opts[opt] = name
+    if(horizon_run > 0):
+        # shadows from the precomputed horizons in mhorizon
+        opts['horizon'] = horr
+    else:
+        opts['flags'] = 's'
+    if(linke_rasters != ''):
+        # Linke turbidity raster of the day, blended from the monthly rasters in this mapset
+        opts['linkein'] = 'linke'+day
+        grass.mapcalc("$out = "+linke_expr(doy), out = opts['linkein'], overwrite = 1)
+    else:
+        opts['lin'] = linke_interp(doy,linke_array)
+    ret = grass.run_command("r.sun", **opts)
+    if('linkein' in opts):
+        grass.run_command("g.remove", rast=opts['linkein'], quiet=1)
+    return ret
+
+def sun_tile(demr,doy,ow,t,tile):
+    # r.sun over the tile with its halo, then cropped to the tile core (r.mapcalc uses the current region).
+    # The region is left on the core for the days derived from this one, the worker restores it.
+    core,halo = tile
+    grass.run_command("g.region", **halo)
+    ret = sun_day(demr,doy,ow,'_halo')
+    grass.run_command("g.region", **core)
+    if(ret != 0):
+        return ret
+    day = str(doy).zfill(3)
+    for suffix in sun_suffixes():
+        name = P+demr+day+suffix
+        grass.mapcalc("$out = $inp", overwrite = ow, out = name+tile_tag(t), inp = name+'_halo')
+        grass.run_command("g.remove", rast=name+'_halo', quiet=1)
+    return 0
+
+def sun_derive(demr,a,b,f,ow,tag=''):
+    # outputs of day b scaled from the r.sun outputs of day a (day pairs). Insolation time is copied.
+    da = str(a).zfill(3)
+    db = str(b).zfill(3)
+    for suffix,k in [('beam',f['beam']),('diff',f['diff']),('refl',f['glob'])]:
+        if(suffix in sun_suffixes()):
+            grass.mapcalc("$out = $inp * $k", overwrite = ow, \
+                            out = P+demr+db+suffix+tag, inp = P+demr+da+suffix+tag, k = '%.6f' % k)
+    if('dur' not in sun_suffixes()):
+        return 0
+    return grass.run_command("g.copy", rast=P+demr+da+'dur'+tag+','+P+demr+db+'dur'+tag, overwrite=ow)
+
+def job_outputs(job,derived):
+    # rasters a job leaves in its temp mapset: its day and the days scaled from it
+    demr,doy,t = job
+    names = []
+    for d in [doy] + [b for b,f in derived.get(doy,[])]:
+        for suffix in sun_suffixes():
+            names.append(P+demr+str(d).zfill(3)+suffix+tile_tag(t))
+    return names
+
+def job_clear(job,derived,mapset):
+    # removes what an earlier attempt of the job left in the temp mapset (a crashed or failed
+    # run, or a ledger reset by new settings), so r.sun writes it again without overwrite
+    demr,doy,t = job
+    names = job_outputs(job,derived)
+    if(t is not None):
+        names += [P+demr+str(doy).zfill(3)+suffix+'_halo' for suffix in sun_suffixes()]
+    names = [name for name in names if raster_file(name,mapset) is not None]
+    if(len(names) > 0):
+        grass.run_command("g.remove", rast=','.join(names), quiet=1)
+
+def job_files(names,mapset):
+    # size and mtime of the data file of each raster, None if one is missing
+    files = {}
+    for name in names:
+        stamp = raster_stamp(name,mapset)
+        if(stamp is None):
+            return None
+        files[name] = {'size':stamp[0],'mtime':stamp[1]}
+    return files
+
+def job_key(job):
+    demr,doy,t = job
+    return demr+'_'+str(doy)+'_'+('-' if t is None else str(t))
+
+###############################################################
+#   LEDGER: state of every r.sun job (pending, running, done,
+#   failed) with its temp mapset and output sizes and mtimes. Kept in
+#   the location directory, rewritten as jobs start and finish.
+###############################################################
 
-    # Run r.sun for each week of the year 366
-    for doy in range(julian_seed,366,step): # 366 normal max day of year
-        day = str(doy).zfill(3)
-        linke = linke_interp(doy,linke_array)
-        # Output maps
-        beam = P+demr+day+'beam'
-        diff = P+demr+day+'diff'
-        refl = P+demr+day+'refl'
-        dur = P+demr+day+'dur'
-        #glob = P+demr+day+'glob'
-        grass.run_command("r.sun", flags="s", elevin=elevdem, albedo=albedo, \
-                            horizonstep=hstep, \
-                            beam_rad=beam, insol_time=dur, \
-                            diff_rad=diff, refl_rad=refl, \
-                            day=doy, step=timestep, \
-                            lin=linke, overwrite=ow) 
-                            # horizon=horr, glob_rad=glob,
+def ledger_load(path,settings,lf):
+    # ledger of the last run if it had the same settings, else a new one.
+    # The number of temp mapsets created is kept either way, so they are all removed at the end.
+    ledger = manifest_load(path)
+    if(ledger['settings'] != settings or 'jobs' not in ledger):
+        if(ledger['settings'] is not None):
+            printout("Ledger: settings changed since the last run. Starting over.",lf)
+        return {'settings':settings,'jobs':{},'mapsets':ledger.get('mapsets',0)}
+    for entry in ledger['jobs'].values():
+        if('cpu' in entry and 'mapset' not in entry):
+            entry['mapset'] = 'temp'+str(entry['cpu']).zfill(2)
+    return ledger
+
+def ledger_set(ledger,job,state,cpu=None,files=None):
+    # files of a done job are in the temp mapset of its cpu until merged (entry mapset)
+    entry = ledger['jobs'].setdefault(job_key(job),{})
+    entry['state'] = state
+    if(cpu is not None):
+        entry['cpu'] = cpu
+        entry['mapset'] = 'temp'+str(cpu).zfill(2)
+    if(files is not None):
+        entry['files'] = files
+
+def ledger_done(ledger,job):
+    # True if the job is done and its outputs are still where the ledger has them
+    # (temp mapset, or msun once merged), with the size and mtime recorded. A file
+    # rewritten since is only hashed when the ledger has its checksum (older ledgers).
+    entry = ledger['jobs'].get(job_key(job))
+    if(entry is None or entry['state'] != 'done' or entry.get('files') is None):
+        return False
+    mapset = entry['mapset']
+    for name,old in entry['files'].items():
+        stamp = raster_stamp(name,mapset)
+        if(stamp is None):
+            return False
+        if(stamp == [old['size'],old['mtime']]):
+            continue
+        if('md5' not in old or file_md5(raster_file(name,mapset)) != old['md5']):
+            return False
+    return True
+
+def ledger_todo(ledger,jobs,lf):
+    # jobs still to run. Running jobs of a run that died are run again.
+    todo = []
+    for job in jobs:
+        if(ledger_done(ledger,job) == False):
+            ledger_set(ledger,job,'pending')
+            todo.append(job)
+    if(len(todo) < len(jobs)):
+        printout("Ledger: "+str(len(jobs)-len(todo))+" of "+str(len(jobs))+" jobs already done. Resuming.",lf)
+    return todo
+
+def ledger_mapsets(ledger):
+    # number of temp mapsets created by the runs in the ledger
+    cpus = [entry['cpu'] + 1 for entry in ledger['jobs'].values() if 'cpu' in entry]
+    return max([ledger.get('mapsets',0)] + cpus)
+
+def worker_sun(cpu,tasks,results,ow,derived,tiles):
+    # persistent worker on its own temp mapset: takes jobs until it gets None
+    mtemp = 'temp'+str(cpu).zfill(2)
+    gsetup.init(gisbase, gisdbase, location, mtemp)
+    set_region(bregion,C)
+    if(horizon_run > 0):
+        grass.run_command("g.mapsets", addmapset=mhorizon)
+    while True:
+        job = tasks.get()
+        if(job is None):
+            break
+        demr,doy,t = job
+        results.put((cpu,job,None,0.0,None))
+        t0 = dt.datetime.now()
+        files = None
+        try:
+            job_clear(job,derived,mtemp)
+            if(t is None):
+                ret = sun_day(demr,doy,ow)
+            else:
+                ret = sun_tile(demr,doy,ow,t,tiles[t])
+            for b,f in derived.get(doy,[]):
+                if(ret == 0):
+                    ret = sun_derive(demr,doy,b,f,ow,tile_tag(t))
+            if(ret == 0):
+                files = job_files(job_outputs(job,derived),mtemp)
+                if(files is None):
+                    ret = 1
+        except:
+            ret = -1
+            traceback.print_exc()
+        if(t is not None):
+            # sun_tile leaves the region on the tile
+            set_region(bregion,C)
+        seconds = (dt.datetime.now() - t0).total_seconds()
+        results.put((cpu,job,ret,seconds,files))
+
+def sun_run(jobs,derived,tiles,cores,ow,ledger,ledger_file,lf):
+    # runs the jobs on a shared queue, logs progress and ETA as they finish. The ledger is
+    # saved as jobs start and finish. Returns {job: cpu} of the jobs done and the list of failed jobs.
+    tasks = mp.Queue()
+    results = mp.Queue()
+    for job in jobs:
+        tasks.put(job)
+    for cpu in range(0,cores):
+        tasks.put(None)
+    workers = []
+    for cpu in range(0,cores):
+        p = mp.Process(target=worker_sun, args=(cpu,tasks,results,ow,derived,tiles))
+        p.start()
+        workers.append(p)
+        printout("r.sun: worker cpu = "+str(cpu)+" pid = "+str(p.pid),lf)
+
+    tstart = dt.datetime.now()
+    cputime = 0.0
+    done = {}
+    failed = []
+    while len(done) + len(failed) < len(jobs):
+        try:
+            cpu,job,ret,seconds,files = results.get(True,60)
+        except Queue.Empty:
+            if(len([p for p in workers if p.is_alive()]) == 0):
+                printout("r.sun: all workers exited with "+str(len(jobs)-len(done)-len(failed))+" jobs left.",lf)
+                break
+            continue
+        if(ret is None):
+            ledger_set(ledger,job,'running',cpu)
+            manifest_save(ledger_file,ledger)
+            continue
+        cputime += seconds
+        if(ret != 0):
+            failed.append(job)
+            ledger_set(ledger,job,'failed',cpu)
+        else:
+            done[job] = cpu
+            ledger_set(ledger,job,'done',cpu,files)
+        manifest_save(ledger_file,ledger)
+        demr,doy,t = job
+        n = len(done) + len(failed)
+        elapsed = (dt.datetime.now() - tstart).total_seconds()
+        eta = dt.timedelta(seconds=int(elapsed / n * (len(jobs) - n)))
+        printout("r.sun: "+demr+" day "+str(doy).zfill(3)+("" if t is None else " tile "+str(t))+ \
+                    " on cpu "+str(cpu).zfill(2)+(" FAILED" if ret != 0 else "")+" in "+str(int(seconds))+"s. "+ \
+                    str(n)+" of "+str(len(jobs))+" done, ETA "+str(eta),lf)
+    for p in workers:
+        p.join()
+    wall = (dt.datetime.now() - tstart).total_seconds()
+    if(wall > 0):
+        printout("r.sun: wall "+str(int(wall))+"s, cpu "+str(int(cputime))+"s, "+ \
+                    str(round(cputime / wall / cores * 100,1))+"% of "+str(cores)+" cores busy",lf)
+    return done,failed
+
+def sun_merge(jobs,derived,ledger,ledger_file,ow,lf):
+    # move the outputs of every done job from its temp mapset into msun: a rename of the
+    # raster files (raster_move), g.copy only where that is not possible. Merged jobs are
+    # marked in the ledger, so a resumed run does not merge them again.
+    moved = 0
+    copied = 0
+    for job in jobs:
+        entry = ledger['jobs'].get(job_key(job))
+        if(entry is None or entry['state'] != 'done' or entry['mapset'] == msun):
+            continue
+        for name in job_outputs(job,derived):
+            if(raster_move(name,entry['mapset'],msun,ow)):
+                moved += 1
+            else:
+                printout("g.copy, rast="+name+"@"+entry['mapset']+","+name+", overwrite="+str(ow),lf)
+                grass.run_command("g.copy", rast=name+'@'+entry['mapset']+','+name, overwrite=ow)
+                copied += 1
+        # a move keeps the stamps, a copy is a new file
+        entry['files'] = job_files(job_outputs(job,derived),msun)
+        entry['mapset'] = msun
+        manifest_save(ledger_file,ledger)
+    printout("Merged into "+msun+": "+str(moved)+" rasters moved, "+str(copied)+" copied",lf)
+
+def sun_stitch(done,derived,tiles,ow,lf):
+    # patch the tiles of every surface and day from the temp mapsets into the current mapset (msun).
+    # Tiles do not overlap, so r.patch only puts them side by side. Days with a missing tile are skipped.
+    days = {}
+    for (demr,doy,t),cpu in done.items():
+        for d in [doy] + [b for b,f in derived.get(doy,[])]:
+            days.setdefault((demr,d),{})[t] = 'temp'+str(cpu).zfill(2)
+    for (demr,doy) in sorted(days):
+        mapsets = days[(demr,doy)]
+        if(len(mapsets) < len(tiles)):
+            printout("Stitch: "+demr+" day "+str(doy)+" has "+str(len(mapsets))+" of "+str(len(tiles))+" tiles. Skipped.",lf)
+            continue
+        for suffix in sun_suffixes():
+            name = P+demr+str(doy).zfill(3)+suffix
+            inputs = [name+tile_tag(t)+'@'+mapsets[t] for t in range(0,len(tiles))]
+            grass.run_command("r.patch", input=','.join(inputs), output=name, overwrite=ow)
+        printout("Stitch: "+demr+" day "+str(doy)+" from "+str(len(tiles))+" tiles",lf)
+
+def horizon_pack(demr,horr,lf):
+    # horizons of a surface packed in one file for the engine (ssr_solar), next to the horizon maps.
+    # Rebuilt when the horizons were recomputed for a changed surface. Returns path,directions.
+    manifest_file = gisdbase+os.sep+location+os.sep+mhorizon+os.sep+horizon_manifest
+    entry = manifest_load(manifest_file).get('surfaces',{}).get(demr)
+    if(entry is None):
+        printout("Horizon pack: no horizons for "+demr+". Run with horizon_run > 0 first.",lf)
+        return None,0
+    reg = grass.region()
+    shape = (int(reg['rows']),int(reg['cols']))
+    hmaps = horizon_maps(horr)
+    key = dict([(k,v) for k,v in entry.items() if k != 'stamp'])
+    key = manifest_settings(horizon=key,shape=shape)
+    packfile = gisdbase+os.sep+location+os.sep+mhorizon+os.sep+horr+'.hpack'
+    if(os.path.exists(packfile) and manifest_load(packfile+'.json')['settings'] == key):
+        printout("Horizon pack: "+packfile+" is current",lf)
+        return packfile,len(hmaps)
+    printout("Horizon pack: packing "+str(len(hmaps))+" horizon maps of "+demr+" into "+packfile,lf)
+    pack = horizon_pack_new(packfile,shape,len(hmaps))
+    for i in range(0,len(hmaps)):
+        horizon_pack_put(pack,i,raster_read(hmaps[i]+'@'+mhorizon))
+    pack.flush()
+    del pack
+    manifest_save(packfile+'.json',{'settings':key})
+    return packfile,len(hmaps)
+
+def engine_run(days,ow,cores,lf):
+    # clear-sky engine (ssr_solar) for both surfaces, written straight to msun.
+    # rsun_batch days per pass over the strips, each pass reads the horizons once.
+    mapset_gotocreate_outside(msun,bregion,C,lf)
+    lat = region_latitude()
+    linkes = [float(linke_interp(doy,linke_array)) for doy in days]
+    suffixes = sun_suffixes()
+    months = []
+    if(linke_rasters != ''):
+        months = [raster_load(rast) for rast in linke_monthly_rasters()]
+    for demr,elev,slope,aspect,horr in [('dem',dem,sloped,aspectd,demhor),('can',can,slopec,aspectc,canhor)]:
+        inputs = {'z':raster_load(elev+'@PERMANENT'),'slope':raster_load(slope+'@PERMANENT'), \
+                    'aspect':raster_load(aspect+'@PERMANENT'),'alb':raster_load(albedo+'@PERMANENT')}
+        for a in inputs.values():
+            a.flush()
+        shape = inputs['z'].shape
+        horpath,ndir = None,0
+        if(horizon_run > 0):
+            horpath,ndir = horizon_pack(demr,horr,lf)
+        if(horpath is None):
+            printout("Engine: "+demr+" without horizons, self shading only",lf)
+        for b0 in range(0,len(days),rsun_batch):
+            batch = days[b0:b0+rsun_batch]
+            blinkes = linkes[b0:b0+len(batch)]
+            if(len(months) > 0):
+                # Linke raster of each day, passed to the strips as a file
+                blinkes = []
+                for doy in batch:
+                    w = linke_weights(doy)
+                    a = raster_new()
+                    for r0 in range(0,shape[0],1024):
+                        a[r0:r0+1024] = sum([w[k] * months[k][r0:r0+1024] for k in range(0,12)])
+                    a.flush()
+                    blinkes.append(a)
+            outs = {}
+            for doy in batch:
+                for key in suffixes:
+                    outs[(doy,key)] = raster_new()
+                    outs[(doy,key)].flush()
+            printout("Engine: "+demr+" days "+','.join([str(d) for d in batch])+" in strips of "+ \
+                        str(sun_strip_rows(shape,ndir,len(batch),rsun_memory,cores))+" rows on "+str(cores)+" cores",lf)
+            done = 0
+            for r0,r1 in sun_strips(dict([(k,a.filename) for k,a in inputs.items()]),horpath,ndir,shape, \
+                                    float(hstep),lat,batch,[getattr(l,'filename',l) for l in blinkes],float(timestep), \
+                                    dict([(k,a.filename) for k,a in outs.items()]),rsun_memory,cores):
+                done += r1 - r0
+                printout("Engine: "+demr+" rows "+str(r0)+"-"+str(r1)+" done, "+str(done)+" of "+str(shape[0]),lf)
+            for doy,key in sorted(outs):
+                raster_write(outs[(doy,key)],P+demr+str(doy).zfill(3)+key,ow)
+            del outs,blinkes
+        del inputs
+    del months
+
+def engine_validate(days,lf):
+    # runs r.sun for the days in their own mapset and compares with the engine output in msun.
+    # Error per cell relative to the mean r.sun value, so dark cells do not blow it up.
+    mval = 'rsun_validate'
+    mapset_gotocreate_outside(mval,bregion,C,lf)
+    if(horizon_run > 0):
+        grass.run_command("g.mapsets", addmapset=mhorizon)
+    ok = True
+    for doy in days:
+        for demr in ['dem','can']:
+            if(sun_day(demr,doy,1) != 0):
+                printout("Validate: r.sun failed for "+demr+" day "+str(doy),lf)
+                ok = False
+                continue
+            for key in [s for s in sun_suffixes() if s != 'refl']:
+                name = P+demr+str(doy).zfill(3)+key
+                ref = raster_read(name+'@'+mval)
+                eng = raster_read(name+'@'+msun)
+                valid = ~numpy.isnan(ref) & ~numpy.isnan(eng)
+                ref = ref[valid].astype(numpy.float64)
+                eng = eng[valid].astype(numpy.float64)
+                mean = max(ref.mean(),1e-9)
+                err = numpy.abs(eng - ref) / mean
+                p95 = numpy.percentile(err,95)
+                status = 'OK'
+                if(p95 > rsun_validate_tol):
+                    status = 'FAILED'
+                    ok = False
+                printout("Validate "+name+": bias "+str(round((eng.mean() - ref.mean()) / mean * 100,2))+ \
+                            "%, p95 error "+str(round(p95 * 100,2))+"%, max "+str(round(err.max() * 100,2))+"% "+status,lf)
+    return ok
+
+def linke_path(turb_array):
+    # CSV series are looked up next to the scripts unless the path is absolute
+    if(turb_array.lower().endswith('.csv') and os.path.isabs(turb_array) == False):
+        return get_path()+turb_array
+    return turb_array
+
+def linke_monthly_rasters():
+    return [linke_rasters+str(month).zfill(2)+'@PERMANENT' for month in range(1,13)]
+
+_linke_means = []
+
+def linke_means():
+    # mean of each monthly Linke raster, read once
+    if(len(_linke_means) == 0):
+        for rast in linke_monthly_rasters():
+            _linke_means.append(float(grass.parse_command('r.univar', flags='g', map=rast)['mean']))
+    return numpy.array(_linke_means)
+
+def linke_expr(day):
+    # r.mapcalc expression of the Linke raster of a day: the monthly rasters with the spline weights
+    w = linke_weights(day)
+    terms = []
+    for rast,wk in zip(linke_monthly_rasters(),w):
+        if(abs(wk) > 1e-9):
+            terms.append('(%.10f * %s)' % (wk,rast))
+    return ' + '.join(terms)
 
 def linke_interp(day,turb_array):
-    # put monthly data here
-    # Angelo area LT from helios satellite data (http://www.soda-is.com/linke/linke_helioserve.html)
-    # ltm1 and angelo-1 are identical, kept for backwards compatibility.  They are helios - 1
-    if turb_array == 'helios':
-        linke_data = numpy.array ([3.2,3.2,3.2,3.4,3.7,3.8,3.7,3.8,3.5,3.4,3.1,2.9])
-    elif turb_array == 'angelo80':
-        linke_data = numpy.array ([2.56,2.56,2.56,2.72,2.96,3.04,2.96,3.04,2.80,2.72,2.48,2.32])
-    elif turb_array == 'angelo70':
-        linke_data = numpy.array ([2.3,2.3,2.3,2.5,2.7,2.8,2.7,2.8,2.6,2.5,2.3,2.1])
-    elif turb_array == 'angelo-1':
-        linke_data = numpy.array ([2.2,2.2,2.2,2.4,2.7,2.8,2.7,2.8,2.5,2.4,2.1,1.9])
-    elif turb_array == 'ltm1':
-        linke_data = numpy.array ([2.2,2.2,2.2,2.4,2.7,2.8,2.7,2.8,2.5,2.4,2.1,1.9])
-    else:
-        linke_data = numpy.array ([1.5,1.6,1.8,1.9,2.0,2.3,2.3,2.3,2.1,1.8,1.6,1.5])
-    
-    linke_data_wrap = numpy.concatenate((linke_data[9:12],linke_data, linke_data[0:3]))
-    monthDays = numpy.array ([0,31,28,31,30,31,30,31,31,30,31,30,31])
-    midmonth_day = numpy.array ([0,0,0,0,0,0,0,0,0,0,0,0]) # create empty array to fill
-    for i in range(1, 12+1):
-        midmonth_day[i-1] = 15 + sum(monthDays[0:i])
-    midmonth_day_wrap = numpy.concatenate((midmonth_day[9:12]-365, midmonth_day,midmonth_day[0:3]+365))
-    linke = interpolate.interp1d(midmonth_day_wrap, linke_data_wrap, kind='cubic')
-    lt = linke(day)
-    return lt
+    # Linke turbidity of a day from the 366-day table of the series (ssr_linke).
+    # With linke_rasters, the same blend of the monthly raster means.
+    if(linke_rasters != ''):
+        return float(numpy.dot(linke_weights(day),linke_means()))
+    return float(linke_day(day,linke_path(turb_array)))
 
 
 def main():
     ##################################
     # R.SUN SOLAR MODEL
     ##################################
-    cores = mp.cpu_count() - 2
+    cores = rsun_cores
+    if(cores < 1):
+        cores = max(1,mp.cpu_count() - 2)
     
     # Set local file path to this script
     localpath = get_path()
@@ -155,26 +708,41 @@ def main():
     
     printout("STARTING R.SUN MODELING RUN",lf)
     printout("LOCATION: "+location,lf)
-    printout("HORIZONS: NOT USED. JUST DOING -S ON THE FLY",lf)
+    if(horizon_run > 0):
+        printout("HORIZONS: PRECOMPUTED IN "+mhorizon,lf)
+    else:
+        printout("HORIZONS: NOT USED. JUST DOING -S ON THE FLY",lf)
     printout("This computer has "+str(cores)+" CPU cores.",lf) 
     printout("Source DEM: "+demsource,lf) 
     printout("Source CAN: "+cansource,lf)
     printout('Prefix: '+P,lf)
     printout('dem: '+dem,lf)
     printout('can: '+can,lf)
-    #printout('horizon mapset: '+mhorizon,lf)
+    printout('horizon mapset: '+mhorizon,lf)
     printout('horizonstep: '+hstep,lf)
     printout('dist: '+dist,lf)
     printout('maxdistance: '+maxdistance,lf)
     printout('r.sun mapset: '+msun,lf)
     printout('linke_array: '+linke_array,lf)
+    printout('linke_rasters: '+linke_rasters,lf)
+    if(linke_rasters == ''):
+        # 366-day table of the series, made once here and shared by the workers
+        table = linke_table(linke_path(linke_array))
+        printout('Linke turbidity '+str(round(table[1:].min(),2))+' to '+str(round(table[1:].max(),2))+' over the year',lf)
     printout('timestep: '+timestep,lf)
+    printout('r.sun outputs: '+','.join(sun_suffixes()),lf)
+    printout('r.sun engine: '+rsun_engine,lf)
     printout('start julian day: '+str(start_day),lf)
     printout('week step: '+str(week_step),lf)
+    printout('day pairs (declination tolerance, 0 = off): '+str(rsun_dedup),lf)
     printout('Run Preprocessing: '+str(preprocessing_run),lf)
+    printout('Run r.horizon: '+str(horizon_run),lf)
     printout('Run r.sun: '+str(rsun_run),lf)
     printout('_________________________________',lf)
     
+    # False if r.sun jobs are left for a rerun (exit status 1)
+    complete = True
+
     # Preprocessing
     if(preprocessing_run > 0):
         R1start = dt.datetime.now()
@@ -198,47 +766,104 @@ def main():
         R1processingtime = R1end - R1start
         printout('END PREPROCESSING at '+ R1endtime + ', processing time: '+str(R1processingtime),lf)
     
+    # Horizons
+    if(horizon_run > 0):
+        R2start = dt.datetime.now()
+        R2starttime = dt.datetime.strftime(R2start,"%m-%d %H:%M:%S")
+        printout('START HORIZONS at '+ str(R2starttime),lf)
+        horizon_stage(horizon_run > 1,lf)
+        R2end = dt.datetime.now()
+        R2endtime = dt.datetime.strftime(R2end,"%m-%d %H:%M:%S")
+        R2processingtime = R2end - R2start
+        printout('END HORIZONS at '+ R2endtime + ', processing time: '+str(R2processingtime),lf)
+
     # R.SUN Start
     if(rsun_run > 0):
         R3start = dt.datetime.now()
         R3starttime = dt.datetime.strftime(R3start,"%m-%d %H:%M:%S")
         printout('START  '+ R3starttime,lf)
         
-        # Create one temp directory for each CPU core
-        printout("Creating Temporary directories, one per cpu core.",lf)
-        create_temp(cores,bregion,C,lf)
+        days = range(start_day,366,week_step) # 366 normal max day of year
+        if(rsun_engine == 'numpy'):
+            # Clear-sky engine in place of r.sun, written straight to msun
+            engine_run(days,int(rsun_run - 1),cores,lf)
+            if(len(rsun_validate) > 0):
+                if(engine_validate(rsun_validate,lf) == False):
+                    printout("Validate: engine and r.sun differ by more than "+str(rsun_validate_tol*100)+"%",lf)
+                    complete = False
+        else:
+            # Day pairs: r.sun runs for one day of each pair only
+            derived = {}
+            if(rsun_dedup > 0):
+                gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
+                set_region(bregion,C)
+                derived = sun_pairs(days,lf)
+                for a in derived:
+                    for b,f in derived[a]:
+                        days.remove(b)
+
+            # Tiles of rsun_tile cells with a halo, or the whole region per job
+            tiles = []
+            if(rsun_tile > 0 and horizon_run == 0):
+                # shadows on the fly: every tile would need the terrain out to maxdistance
+                printout("WARNING: rsun_tile needs horizon_run > 0, without horizons the tile halo is "+ \
+                            str(tile_halo())+" cells. Running r.sun on the whole region.",lf)
+            elif(rsun_tile > 0):
+                gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
+                set_region(bregion,C)
+                tiles = sun_tiles(rsun_tile,tile_halo())
+                printout("r.sun: "+str(len(tiles))+" tiles of "+str(rsun_tile)+" cells, halo "+str(tile_halo())+" cells",lf)
+
+            # Job ledger: a rerun with the same settings only runs the jobs that did not finish
+            jobs = sun_jobs(days,len(tiles))
+            ledger_file = gisdbase+os.sep+location+os.sep+ledger_name
+            settings = manifest_settings(days=days,pairs=sorted([[a,b] for a in derived for b,f in derived[a]]), \
+                            tiles=len(tiles),rsun_tile=rsun_tile,horizon=(horizon_run > 0), \
+                            linke_array=linke_array,linke_rasters=linke_rasters,timestep=timestep,outputs=sun_suffixes(), \
+                            dem=raster_stamp(dem,'PERMANENT'),can=raster_stamp(can,'PERMANENT'))
+            ledger = ledger_load(ledger_file,settings,lf)
+            todo = ledger_todo(ledger,jobs,lf)
+            manifest_save(ledger_file,ledger)
+
+            # One worker per CPU core, each with its own temp mapset
+            workers = max(1,min(cores,len(todo)))
+            printout("Creating Temporary directories, one per cpu core.",lf)
+            create_temp(workers,bregion,C,lf)
+            ledger['mapsets'] = max(workers,ledger_mapsets(ledger))
+            manifest_save(ledger_file,ledger)
         
-        # Spawn R.SUN processes
-        step = cores * week_step
-        for demr in ['dem','can']:
-            julian_seed = start_day
-            jobs = []
-            for cpu in range(0,cores):
-                p = mp.Process(target=worker_sun, args=(cpu,julian_seed,step,demr,bregion))
-                p.start()
-                jobs.append(p)
-                pid = str(p.pid)
-                printout("r.sun: dem = "+demr+" cpu = "+str(cpu)+" julian_seed = "+str(julian_seed)+" pid = "+pid,lf)
-                julian_seed += week_step
-                
-            # Wait for all the Processes to finish
-            for p in jobs:
-                pid = str(p.pid)
-                palive = str(p.is_alive)
-                p.join()
-                printout(demr+" on "+pid+" joined.",lf)
-            printout("R.Sun finished for "+demr,lf)
+            # R.SUN jobs for both surfaces on a shared queue
+            failed = []
+            if(len(todo) > 0):
+                printout("r.sun: "+str(len(todo))+" jobs on "+str(workers)+" workers",lf)
+                done,failed = sun_run(todo,derived,tiles,workers,int(rsun_run - 1),ledger,ledger_file,lf)
+            for demr,doy,t in failed:
+                printout("r.sun FAILED: "+demr+" day "+str(doy)+("" if t is None else " tile "+str(t)),lf)
+            done = {}
+            for job in jobs:
+                entry = ledger['jobs'].get(job_key(job))
+                if(entry is not None and entry['state'] == 'done'):
+                    done[job] = entry['cpu']
             
-        # Copy all the files back over to sun mapset
-        suffixes = ['glob','beam','diff','refl','dur']
-        printout('Creating mapset '+msun,lf)
-        mapset_gotocreate_outside(msun,bregion,C,lf)
-        printout('Copying temp directories to '+msun,lf)
-        copy_fromtemp(cores,msun,suffixes,1,bregion,C,lf)
+            # Copy all the files back over to sun mapset (tiles are patched together),
+            # each job from the temp mapset the ledger has it in
+            printout('Creating mapset '+msun,lf)
+            mapset_gotocreate_outside(msun,bregion,C,lf)
+            if(len(tiles) > 0):
+                printout('Stitching tiles from temp directories into '+msun,lf)
+                sun_stitch(done,derived,tiles,1,lf)
+            else:
+                printout('Moving rasters from temp directories to '+msun,lf)
+                sun_merge(jobs,derived,ledger,ledger_file,1,lf)
         
-        # Delete the temp mapsets
-        printout("Removing temp mapsets",lf)
-        remove_temp(cores)
+            # Delete the temp mapsets, unless jobs are left for a rerun
+            if(len(done) < len(jobs)):
+                complete = False
+                printout(str(len(jobs)-len(done))+" jobs not done. Temp mapsets and ledger kept, run again to resume.",lf)
+            else:
+                printout("Removing temp mapsets",lf)
+                remove_temp(ledger_mapsets(ledger))
+                os.remove(ledger_file)
 
         # Finish
         R3end = dt.datetime.now()
@@ -250,17 +875,18 @@ def main():
     printout('_________________________________',lf)
     printout('ssr_rsun.py DONE',lf)
     lf.close()
+    return complete
 
 if __name__ == "__main__":
+    # exit status 0 only if everything asked for was made (ssr_pipeline.py checks it)
+    complete = False
     try:
         #options, flags = grass.parser()
-        main()
+        complete = main()
     except:
-        printout('ERROR! quitting.')
-        print traceback.print_exc()
-        traceback.print_exc(file=lf)
-    
+        print 'ERROR! quitting.'
+        traceback.print_exc()
     finally:
-        #lf.close()
-        sys.exit("FINISHED.")
+        print "FINISHED."
+        sys.exit(int(complete == False))
 
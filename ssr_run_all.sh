@@ -4,10 +4,10 @@
 # by Collin Bode, 2016
 # purpose: linux shell script to launch all parts 
 # of the Subcanopy Solar Radiation model in order.
-# Make sure all run_parts have 2 or 1 values.
+# ssr_pipeline.py runs each part whose products are
+# stale (run_parts 1) or always (run_parts 2), see
+# ssr_params.py. "./ssr_run_all.sh -n" lists what
+# would run.
 #
 ####################################################
-python ssr_lidar.py
-python ssr_lpi.py
-python ssr_rsun.py
-python ssr_algore.py
+python ssr_pipeline.py "$@"
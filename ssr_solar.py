@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_solar.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               formulas from r.sun (Hofierka & Suri 2002, ESRA clear-sky model)
+# PURPOSE:      Solar geometry and clear-sky irradiance in numpy, no GRASS needed.
+#               Used by ssr_rsun.py to pair days of (nearly) equal solar declination:
+#               r.sun runs once per pair and the other day is scaled by the ratio of
+#               its clear-sky irradiation, with its own Linke turbidity and sun distance.
+#               Clear-sky engine: beam, diffuse and reflected irradiation and insolation
+#               time over raster arrays for a batch of days, the r.sun model with slope,
+#               aspect and horizon angles as input. ssr_rsun.py runs it in strips of rows
+#               (rsun_engine = 'numpy') in place of one r.sun process per day.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import numpy
+import multiprocessing
+
+solar_const = 1367.0    # W/m2, as in r.sun
+
+
+###############################################################
+#
+#   GEOMETRY AND CLEAR-SKY MODEL (ESRA, as in r.sun)
+#
+###############################################################
+
+def solar_declination(doy):
+    # radians, north positive
+    d = 2.0 * numpy.pi * numpy.asarray(doy,dtype=numpy.float64) / 365.25
+    return numpy.arcsin(0.3978 * numpy.sin(d - 1.4 + 0.0355 * numpy.sin(d - 0.0489)))
+
+def extraterrestrial(doy):
+    # G0, extraterrestrial irradiance normal to the beam (sun - earth distance), W/m2
+    d = 2.0 * numpy.pi * numpy.asarray(doy,dtype=numpy.float64) / 365.25
+    return solar_const * (1.0 + 0.03344 * numpy.cos(d - 0.048869))
+
+def sun_vector(lat,decl,hour):
+    # unit vector to the sun (east, north, up). lat, decl in radians, hour in local solar time.
+    # up is the sine of the solar altitude.
+    omega = (numpy.asarray(hour,dtype=numpy.float64) - 12.0) * numpy.pi / 12.0
+    east = -numpy.cos(decl) * numpy.sin(omega)
+    north = numpy.cos(lat) * numpy.sin(decl) - numpy.sin(lat) * numpy.cos(decl) * numpy.cos(omega)
+    up = numpy.sin(lat) * numpy.sin(decl) + numpy.cos(lat) * numpy.cos(decl) * numpy.cos(omega)
+    return east,north,up
+
+def plane_normal(slope,aspect):
+    # unit normal (east, north, up) of a plane, slope and aspect (downslope, clockwise from north) in degrees
+    s = numpy.radians(slope)
+    a = numpy.radians(aspect)
+    return numpy.sin(s) * numpy.sin(a),numpy.sin(s) * numpy.cos(a),numpy.cos(s)
+
+def air_mass(sinh,z):
+    # relative optical air mass at elevation z (m), with refraction correction
+    h0 = numpy.arcsin(numpy.clip(sinh,0.0,1.0))
+    href = h0 + 0.061359 * (0.1594 + 1.123 * h0 + 0.065656 * h0 * h0) / (1.0 + 28.9344 * h0 + 277.3971 * h0 * h0)
+    hdeg = numpy.degrees(href)
+    return numpy.exp(-z / 8434.5) / (numpy.sin(href) + 0.50572 * (hdeg + 6.07995) ** -1.6364)
+
+def rayleigh(m):
+    # Rayleigh optical thickness at air mass m
+    small = 1.0 / (6.6296 + m * (1.7513 + m * (-0.1202 + m * (0.0065 - m * 0.00013))))
+    if(numpy.max(m) <= 20.0):
+        return small
+    large = 1.0 / (10.4 + 0.718 * m)
+    return numpy.where(m <= 20.0,small,large)
+
+def beam_normal(g0,linke,m):
+    # clear-sky beam irradiance normal to the sun
+    return g0 * numpy.exp(-0.8662 * linke * m * rayleigh(m))
+
+def diffuse_coefs(linke):
+    # diffuse transmission Tn and the solar altitude function coefficients A1..A3
+    tn = -0.015843 + 0.030543 * linke + 0.0003797 * linke * linke
+    a1 = 0.26463 - 0.061581 * linke + 0.0031408 * linke * linke
+    a1 = numpy.where(a1 * tn < 0.0022,0.0022 / tn,a1)
+    a2 = 2.04020 + 0.018945 * linke - 0.011161 * linke * linke
+    a3 = -1.3025 + 0.039231 * linke + 0.0085079 * linke * linke
+    return tn,a1,a2,a3
+
+def diffuse_horizontal(g0,linke,sinh):
+    tn,a1,a2,a3 = diffuse_coefs(linke)
+    return g0 * tn * (a1 + a2 * sinh + a3 * sinh * sinh)
+
+def clearsky_day(lat,doy,linke,z,step):
+    # clear-sky beam irradiance normal to the sun and diffuse irradiance on a horizontal
+    # plane at each time step of a day (W/m2), with the sun vector. lat in degrees, step in hours.
+    # Zero while the sun is down.
+    hours = numpy.arange(step / 2.0,24.0,step)
+    sun = sun_vector(numpy.radians(lat),solar_declination(doy),hours)
+    up = sun[2] > 0
+    g0 = extraterrestrial(doy)
+    bn = numpy.zeros(hours.shape)
+    dh = numpy.zeros(hours.shape)
+    bn[up] = beam_normal(g0,linke,air_mass(sun[2][up],z))
+    dh[up] = diffuse_horizontal(g0,linke,sun[2][up])
+    return bn,dh,sun
+
+def plane_day(bn,dh,sun,slope,aspect):
+    # daily beam and diffuse irradiation (sum over steps) on an unshaded plane.
+    # Diffuse as an isotropic sky, enough to compare two days.
+    n = plane_normal(slope,aspect)
+    cosi = numpy.maximum(n[0] * sun[0] + n[1] * sun[1] + n[2] * sun[2],0.0)
+    return (bn * cosi).sum(),(dh * (1.0 + n[2]) / 2.0).sum()
+
+###############################################################
+#
+#   DAY PAIRS
+#
+###############################################################
+
+def day_pairs(days,tol):
+    # disjoint pairs (a,b) of days whose declinations differ by at most tol degrees,
+    # closest first. r.sun runs for a, b is scaled from it.
+    decl = numpy.degrees(solar_declination(days))
+    cand = []
+    for i in range(0,len(days)):
+        for j in range(i+1,len(days)):
+            dd = abs(decl[i] - decl[j])
+            if(dd <= tol):
+                cand.append((dd,days[i],days[j]))
+    cand.sort()
+    used = set()
+    pairs = []
+    for dd,a,b in cand:
+        if(a not in used and b not in used):
+            used.add(a)
+            used.add(b)
+            pairs.append((a,b,dd))
+    pairs.sort()
+    return pairs
+
+pair_slopes = [0,15,30,45]         # test planes for the error of a day pair (degrees), every 45 degrees of aspect
+
+def pair_factors(lat,a,b,linke_a,linke_b,z,step):
+    # factors turning the r.sun outputs of day a into those of day b: ratios of the clear-sky
+    # daily irradiation on a horizontal plane, each day with its own declination, sun distance
+    # and Linke turbidity. The error bounds are the largest relative error of the scaled
+    # daily totals (beam, and beam + diffuse each with its factor) on unshaded test planes.
+    bna,dha,suna = clearsky_day(lat,a,linke_a,z,step)
+    bnb,dhb,sunb = clearsky_day(lat,b,linke_b,z,step)
+    beama,diffa = plane_day(bna,dha,suna,0,0)
+    beamb,diffb = plane_day(bnb,dhb,sunb,0,0)
+    f = {'beam':beamb / beama,'diff':diffb / diffa,'glob':(beamb + diffb) / (beama + diffa),
+         'errbeam':0.0,'errglob':0.0}
+    for slope in pair_slopes:
+        for aspect in range(0,360,45):
+            beama,diffa = plane_day(bna,dha,suna,slope,aspect)
+            beamb,diffb = plane_day(bnb,dhb,sunb,slope,aspect)
+            if(beamb > 0):
+                f['errbeam'] = max(f['errbeam'],abs(beama * f['beam'] - beamb) / beamb)
+            globb = beamb + diffb
+            f['errglob'] = max(f['errglob'],abs(beama * f['beam'] + diffa * f['diff'] - globb) / globb)
+    return f
+
+
+###############################################################
+#
+#   CLEAR-SKY ENGINE
+#
+###############################################################
+
+def horizon_angle(hor,hstep,azimuth,hscale=1.0):
+    # horizon height (radians) towards azimuth (degrees counterclockwise from east), linear
+    # between the two nearest r.horizon directions. hor is (directions,rows,cols), radians * 1/hscale.
+    n = hor.shape[0]
+    x = (azimuth % 360.0) / hstep
+    lo = int(x) % n
+    hi = (lo + 1) % n
+    w = x - int(x)
+    return hor[lo] * numpy.float32((1.0 - w) * hscale) + hor[hi] * numpy.float32(w * hscale)
+
+def clearsky_strip(z,slope,aspect,alb,hor,hstep,lat,days,linkes,step,hscale=1.0):
+    # r.sun clear-sky model over arrays of rows. z elevation (m), slope and aspect (degrees,
+    # aspect counterclockwise from east as r.slope.aspect), alb albedo, hor horizon angles
+    # (directions,rows,cols) every hstep degrees from east, in radians * 1/hscale (packed int16
+    # horizons are read as they are), or None for self
+    # shading only. lat in degrees, step in hours. linkes holds one Linke turbidity per day,
+    # a number or an array like z. Returns {'beam','diff','refl','dur'} each (days,rows,cols)
+    # float32 in Wh/m2/day (dur in hours). Null (NaN) where an input is.
+    shape = z.shape
+    out = {}
+    for key in ['beam','diff','refl','dur']:
+        out[key] = numpy.zeros((len(days),)+shape,dtype=numpy.float32)
+    f32 = numpy.float32
+    s = numpy.radians(numpy.nan_to_num(slope)).astype(f32)
+    a = numpy.radians(numpy.nan_to_num(aspect)).astype(f32)
+    ne = numpy.sin(s) * numpy.cos(a)
+    nn = numpy.sin(s) * numpy.sin(a)
+    nu = numpy.cos(s)
+    flat = s == 0
+    pres = numpy.exp(-numpy.nan_to_num(z) / 8434.5).astype(f32)
+    ri = (1.0 + nu) / 2.0
+    fx = numpy.sin(s) - s * nu - numpy.pi * numpy.sin(s / 2.0) ** 2
+    rfac = (numpy.nan_to_num(alb) * (1.0 - nu) / 2.0).astype(f32)
+    sins = numpy.sin(s)
+    latr = numpy.radians(lat)
+    for j in range(0,len(days)):
+        decl = solar_declination(days[j])
+        g0 = extraterrestrial(days[j])
+        linke = linkes[j]
+        tn,a1,a2,a3 = diffuse_coefs(linke)
+        beam = out['beam'][j]
+        diff = out['diff'][j]
+        refl = out['refl'][j]
+        dur = out['dur'][j]
+        for hour in numpy.arange(step / 2.0,24.0,step):
+            east,north,up = sun_vector(latr,decl,hour)
+            if(up <= 0):
+                continue
+            h0 = numpy.arcsin(up)
+            azimuth = numpy.degrees(numpy.arctan2(north,east))
+            # beam normal to the sun: air mass scaled by the pressure of each cell
+            m = pres * f32(air_mass(up,0.0))
+            kb = numpy.exp(f32(-0.8662) * linke * m * rayleigh(m))
+            b0 = g0 * kb
+            cosi = ne * f32(east) + nn * f32(north) + nu * f32(up)
+            lit = cosi > 0
+            if(hor is not None):
+                lit &= h0 > horizon_angle(hor,hstep,azimuth,hscale)
+            beam += numpy.where(lit,b0 * cosi,f32(0)) * f32(step)
+            dur += lit * f32(step)
+            # diffuse (Muneer): sky radiance anisotropy depends on the beam share kb = b0 / g0
+            dh = g0 * tn * (a1 + a2 * up + a3 * up * up)
+            fg = ri + (f32(0.00263) - f32(0.712) * kb - f32(0.6883) * kb * kb) * fx
+            if(h0 >= 0.1):
+                dlit = dh * (fg * (1 - kb) + kb * cosi / f32(up))
+            else:
+                aln = f32(numpy.radians(azimuth)) - a
+                dlit = dh * (fg * (1 - kb) + kb * sins * numpy.cos(aln) / f32(0.1 - 0.008 * h0))
+            d = numpy.where(lit,dlit,dh * (ri + f32(0.25227) * fx))
+            diff += numpy.where(flat,dh,d) * f32(step)
+            # reflected from the ground in view of the slope
+            refl += rfac * (b0 * f32(up) + dh) * f32(step)
+        nulls = numpy.isnan(z) | numpy.isnan(slope) | numpy.isnan(aspect)
+        for key in out:
+            out[key][j][nulls] = numpy.nan
+    return out
+
+
+###############################################################
+#
+#   ENGINE STRIPS: the engine over the region in strips of rows
+#   across a process pool. Inputs and outputs are raw float32
+#   files (the memory maps behind grass.script.array). Horizons
+#   are one int16 file of (rows,directions,cols), so the angles
+#   of a strip are one contiguous read. No halo is needed: every
+#   cell only looks at its own horizon angles.
+#
+###############################################################
+
+horizon_scale = 1.0e-4      # radians per unit of a packed horizon
+horizon_null = -32768       # packed null: no horizon
+
+def horizon_pack_new(path,shape,ndir):
+    # packed horizon file to fill direction by direction with horizon_pack_put
+    pack = numpy.memmap(path,dtype=numpy.int16,mode='w+',shape=(shape[0],ndir,shape[1]))
+    pack[:] = horizon_null
+    return pack
+
+def horizon_pack_put(pack,i,angles):
+    # angles: horizon angles (radians, NaN = null) of direction i over the region
+    for r0 in range(0,angles.shape[0],1024):
+        a = angles[r0:r0+1024]
+        q = numpy.round(numpy.nan_to_num(a) / horizon_scale).astype(numpy.int16)
+        q[numpy.isnan(a)] = horizon_null
+        pack[r0:r0+1024,i,:] = q
+
+def sun_strip_rows(shape,ndir,ndays,memory,cores):
+    # rows per strip so that cores strips fit in memory (MB): horizons twice (read and
+    # transposed), inputs, outputs of every day and the temporaries of a time step
+    row = shape[1] * (4 * ndir + 4 * 4 * ndays + 4 * 30)
+    return max(1,min(shape[0],int(memory * 1024 * 1024 // (cores * row))))
+
+def sun_strip(job):
+    # multiprocessing worker: job = (inpaths,horpath,ndir,shape,r0,r1,hstep,lat,days,linkes,step,outpaths)
+    # inpaths: {'z','slope','aspect','alb'}, outpaths: {(day,'beam'|'diff'|'refl'|'dur'): path}, only those written,
+    # linkes: per day a number or the path of a Linke raster
+    inpaths,horpath,ndir,shape,r0,r1,hstep,lat,days,linkes,step,outpaths = job
+    data = {}
+    for key,path in inpaths.items():
+        a = numpy.memmap(path,dtype=numpy.float32,mode='r',shape=shape)
+        data[key] = numpy.array(a[r0:r1])
+        del a
+    # Linke turbidity: a number, or the path of a raw float32 raster of the day
+    linkes = list(linkes)
+    for j in range(0,len(linkes)):
+        if(isinstance(linkes[j],str)):
+            a = numpy.memmap(linkes[j],dtype=numpy.float32,mode='r',shape=shape)
+            linkes[j] = numpy.array(a[r0:r1])
+            del a
+    hor = None
+    if(horpath is not None):
+        pack = numpy.memmap(horpath,dtype=numpy.int16,mode='r',shape=(shape[0],ndir,shape[1]))
+        hor = numpy.ascontiguousarray(pack[r0:r1].transpose(1,0,2))
+        del pack
+    res = clearsky_strip(data['z'],data['slope'],data['aspect'],data['alb'],hor,hstep,lat,days,linkes,step,horizon_scale)
+    for j in range(0,len(days)):
+        for key in res:
+            if((days[j],key) not in outpaths):
+                continue
+            out = numpy.memmap(outpaths[(days[j],key)],dtype=numpy.float32,mode='r+',shape=shape)
+            out[r0:r1] = res[key][j]
+            out.flush()
+            del out
+    return r0,r1
+
+def sun_strips(inpaths,horpath,ndir,shape,hstep,lat,days,linkes,step,outpaths,memory=1024,cores=1):
+    # engine over the whole region, strip by strip. Yields (r0,r1) as strips finish.
+    nrows = sun_strip_rows(shape,ndir,len(days),memory,cores)
+    jobs = []
+    for r0 in range(0,shape[0],nrows):
+        jobs.append((inpaths,horpath,ndir,shape,r0,min(shape[0],r0+nrows),hstep,lat,days,linkes,step,outpaths))
+    if(cores <= 1 or len(jobs) == 1):
+        for job in jobs:
+            yield sun_strip(job)
+        return
+    pool = multiprocessing.Pool(min(cores,len(jobs)))
+    try:
+        for done in pool.imap_unordered(sun_strip,jobs):
+            yield done
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_stages.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               based on ssr_pipeline.py
+# PURPOSE:      Stages of ssr_pipeline.py: the products each script reads and
+#               makes, the parameters of ssr_params.py it depends on, its key,
+#               and whether it has to run. No GRASS needed: the caller hashes
+#               the products ({product: md5, None if missing}).
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import json
+import hashlib
+import datetime as dt
+from ssr_params import *
+from ssr_points import stat_prefix
+from ssr_neighbors import kernel_box, weight_read
+
+gisdbase = os.path.abspath(gisdbase)
+scriptPath = os.path.dirname(os.path.realpath(__file__))+os.sep
+
+
+###############################################################
+#
+#   PRODUCTS: 'name@mapset' is a raster, 'file:path' a file and
+#   'points:dir' the LiDAR tiles of a directory.
+#
+###############################################################
+
+def rast(name,mapset):
+    return name+'@'+mapset
+
+def lpi_month(month):
+    # LPI raster of a month (1-12). ssr_lpi.py writes one raster per weight, not per month.
+    return lpipref + 'w' + str(lpi_month_weights[month])
+
+def stage_key(stage,inputs):
+    # hash of the stage parameters and the content of its inputs ({product: md5})
+    text = json.dumps({'params':stage['params'],'inputs':inputs},sort_keys=True)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+###############################################################
+#
+#   STAGES: products and parameters of each script, as the
+#   scripts name them.
+#
+###############################################################
+
+def lidar_stage():
+    cells = list(lidar_cells)
+    if(C not in cells):
+        cells.insert(0,C)
+    canpref = ''
+    if(cansource == '' and (LidarPoints[1] == 'unfiltered' or LidarPoints[1] == 'all')):
+        canpref = LidarPoints[1]
+    inputs = ['points:'+inPath]
+    outputs = []
+    for c in cells:
+        for pref in LidarPoints:
+            if(c == C):
+                outputs.append(rast(pdensitypref+pref,mlpi))
+            else:
+                outputs.append(rast('pointdensity_c'+c+year+pref,mlpi))
+            if(pref == canpref):
+                canopy = can
+                if(c != C):
+                    canopy = bregion+c+'m'+'can'
+                outputs.append(rast(canopy,'PERMANENT'))
+            for stat in lidar_stats:
+                outputs.append(rast(stat_prefix(stat)+'_c'+c+year+pref,mlpi))
+    if(canpref != ''):
+        # canopy gaps are filled from the dem. Preprocessing makes it from demsource, later.
+        inputs.append(rast(demsource,'PERMANENT'))
+    params = {'region':[bregion,C],'inSuffix':inSuffix,'LidarPoints':LidarPoints,'year':year,'cells':cells, \
+              'canstat':canstat,'lidar_stats':lidar_stats,'overlap':overlap,'sep':sep,'las_ground':las_ground, \
+              'cansource':cansource}
+    return {'name':'lidar','script':'ssr_lidar.py','run':'lidar_run','env':{'SSR_LIDAR_RUN':'2'}, \
+            'inputs':inputs,'outputs':outputs,'params':params}
+
+def lpi_stage():
+    # LPI rasters of the weight files, then the sweep (ssr_lpi.py)
+    weights = [scriptPath+'lpi_box18x18_weight'+str(weight)+'.txt' for weight in range(1,5)]
+    lpis = [lpipref+'w'+str(weight) for weight in range(1,5)]
+    for size,layout in lpi_sweep:
+        for weight in range(1,5):
+            if(layout == 'box'):
+                w = kernel_box(size,weight)
+            else:
+                weights.append(scriptPath+layout+str(weight)+'.txt')
+                w = weight_read(weights[-1])
+            lpi = 'lpi_c'+C+year+'s'+str(w.shape[0])+layout+'w'+str(weight)
+            if(lpi not in lpis):
+                lpis.append(lpi)
+    inputs = [rast(pdensitypref+LidarPoints[0],mlpi),rast(pdensitypref+LidarPoints[1],mlpi)]
+    inputs += ['file:'+path for path in weights]
+    params = {'C':C,'year':year,'lpi_method':lpi_method}
+    return {'name':'lpi','script':'ssr_lpi.py','run':'lpi_run','env':{'SSR_LPI_RUN':'2'}, \
+            'inputs':inputs,'outputs':[rast(lpi,mlpi) for lpi in lpis],'params':params}
+
+def preprocessing_stage():
+    canr = can
+    if(cansource != ''):
+        canr = cansource
+    outputs = [rast(r,'PERMANENT') for r in [sloped,slopec,aspectd,aspectc,vegheight,albedo]]
+    if(demsource != dem):
+        outputs.append(rast(dem,'PERMANENT'))
+    if(canr != can):
+        outputs.append(rast(can,'PERMANENT'))
+    inputs = [rast(demsource,'PERMANENT'),rast(canr,'PERMANENT'),'file:'+scriptPath+'albedo_recode.txt']
+    return {'name':'preprocessing','script':'ssr_rsun.py','run':'preprocessing_run','env':{'SSR_PREPROCESSING_RUN':'2'}, \
+            'inputs':inputs,'outputs':outputs,'params':{'region':[bregion,C]}}
+
+def horizon_file():
+    # the horizon manifest (ssr_rsun.py) stands for the horizon maps: it changes when they are recomputed
+    return 'file:'+gisdbase+os.sep+location+os.sep+mhorizon+os.sep+'ssr_horizon_manifest.json'
+
+def horizon_stage():
+    # ssr_rsun.py checks each surface again, so 1 recomputes only the changed one
+    params = {'region':[bregion,C],'hstep':hstep,'maxdistance':maxdistance,'dist':dist}
+    return {'name':'horizon','script':'ssr_rsun.py','run':'horizon_run','env':{'SSR_HORIZON_RUN':str(horizon_run)}, \
+            'inputs':[rast(dem,'PERMANENT'),rast(can,'PERMANENT')],'outputs':[horizon_file()],'params':params}
+
+def rsun_products(suffixes):
+    outputs = []
+    for doy in range(start_day,366,week_step):
+        for demr in ['dem','can']:
+            for suffix in suffixes:
+                outputs.append(rast(P+demr+str(doy).zfill(3)+suffix,msun))
+    return outputs
+
+def rsun_stage(suffixes):
+    inputs = [rast(dem,'PERMANENT'),rast(can,'PERMANENT'),rast(albedo,'PERMANENT')]
+    if(rsun_engine == 'numpy'):
+        inputs += [rast(r,'PERMANENT') for r in [sloped,aspectd,slopec,aspectc]]
+    if(horizon_run > 0):
+        inputs.append(horizon_file())
+    if(linke_rasters != ''):
+        inputs += [rast(linke_rasters+str(month).zfill(2),'PERMANENT') for month in range(1,13)]
+    elif(linke_array.lower().endswith('.csv')):
+        path = linke_array
+        if(os.path.isabs(path) == False):
+            path = scriptPath+path
+        inputs.append('file:'+path)
+    params = {'region':[bregion,C],'start_day':start_day,'week_step':week_step,'timestep':timestep, \
+              'linke_array':linke_array,'linke_rasters':linke_rasters,'rsun_dedup':rsun_dedup, \
+              'rsun_dedup_maxerr':rsun_dedup_maxerr,'rsun_engine':rsun_engine,'horizon':(horizon_run > 0), \
+              'hstep':hstep}
+    # horizons are only checked (1) here, the horizon stage recomputes them
+    env = {'SSR_RSUN_RUN':'2','SSR_HORIZON_RUN':str(min(horizon_run,1)),'SSR_RSUN_OUTPUTS':','.join(suffixes)}
+    return {'name':'rsun','script':'ssr_rsun.py','run':'rsun_run','env':env, \
+            'inputs':inputs,'outputs':rsun_products(suffixes),'params':params}
+
+def algore_stage():
+    # inputs and outputs as the weekly loop of ssr_algore.py names them
+    inputs = [rast(vegheight,'PERMANENT')]
+    outputs = []
+    lpipart = C + 'm' + year + 's' + boxsize + 'm' + algore
+    if(lpivsjune == True):
+        lpipart = C + 'm' + year + 's' + boxsize+'mjune' + algore
+    for doyn in range(5,366,7):
+        doy = str(doyn).zfill(3)
+        month = int(dt.datetime.strftime(dt.datetime(2011,1,1) + dt.timedelta(doyn -1),"%m"))
+        if(lpivsjune == True):
+            month = 6
+        for demr in ['dem','can']:
+            for suffix in ['beam','diff']:
+                inputs.append(rast(bregion+C+'m'+demr+doy+suffix,msun))
+        lpi = rast(lpi_month(month),mlpi)
+        if(lpi not in inputs):
+            inputs.append(lpi)
+        outputs.append(rast('ssr_'+lpipart+doy,mssr))
+    params = {'algore':algore,'maxheight':maxheight,'sky':sky}
+    return {'name':'algore','script':'ssr_algore.py','run':'algore_run','env':{'SSR_ALGORE_RUN':'2'}, \
+            'inputs':inputs,'outputs':outputs,'params':params}
+
+def pipeline_stages():
+    # stages in run order. r.sun writes only the outputs a later stage reads, plus rsun_outputs;
+    # all of them when nothing reads them and rsun_outputs is empty. Stages that are off count
+    # as readers too, so switching one on or off does not change what r.sun makes.
+    stages = [lidar_stage(),lpi_stage(),preprocessing_stage(),horizon_stage(),None,algore_stage()]
+    used = set()
+    for stage in stages[5:]:        # stages after r.sun
+        used.update(stage['inputs'])
+    suffixes = []
+    for suffix in ['beam','diff','refl','dur']:
+        if(suffix in rsun_outputs or len(used.intersection(rsun_products([suffix]))) > 0):
+            suffixes.append(suffix)
+    if(len(suffixes) == 0):
+        suffixes = ['beam','diff','refl','dur']
+    stages[4] = rsun_stage(suffixes)
+    return stages
+
+def stage_upstream(stages,stage):
+    # stages making the inputs of a stage
+    up = []
+    for other in stages:
+        if(other is not stage and len(set(other['outputs']).intersection(stage['inputs'])) > 0):
+            up.append(other['name'])
+    return up
+
+
+###############################################################
+#
+#   RUN: stale stages, and what a run leaves in the manifest
+#
+###############################################################
+
+def stage_stale(manifest,stage,key,outputs):
+    # reason the stage has to run, '' if its products are current, and the missing outputs
+    # if they are the only reason. Outputs the last run did not record are taken as they are.
+    old = manifest['stages'].get(stage['name'])
+    if(globals()[stage['run']] > 1):
+        return 'forced ('+stage['run']+' = 2)',[]
+    if(old is None):
+        return 'never run',[]
+    if(old['key'] != key):
+        return 'inputs or parameters changed',[]
+    changed = [p for p,md5 in outputs.items() if md5 is not None and p in old['outputs'] and old['outputs'][p] != md5]
+    if(len(changed) > 0):
+        return 'outputs changed since the last run, e.g. '+changed[0],[]
+    missing = sorted([p for p,md5 in outputs.items() if md5 is None])
+    if(len(missing) > 0):
+        return str(len(missing))+' outputs missing, e.g. '+missing[0],missing
+    return '',[]
+
+def stage_env(stage,missing):
+    # environment of the stage run. With only outputs missing, r.sun makes just their kinds.
+    env = dict(stage['env'])
+    if(stage['name'] == 'rsun' and len(missing) > 0):
+        suffixes = [s for s in ['beam','diff','refl','dur'] if len([p for p in missing if p.split('@')[0].endswith(s)]) > 0]
+        env['SSR_RSUN_OUTPUTS'] = ','.join(suffixes)
+    return env
+
+def stage_record(manifest,stage,key,ret,outputs):
+    # after a run: done is exit status 0 and every output there. A crash can leave the outputs
+    # of an earlier run behind, so they alone do not count. A done stage is recorded with its
+    # key and output checksums, a failed one is dropped so it runs again. '' when done, else why not.
+    missing = sorted([p for p,md5 in outputs.items() if md5 is None])
+    if(ret != 0):
+        failed = stage['script']+' exit status '+str(ret)
+    elif(len(missing) > 0):
+        failed = str(len(missing))+' of '+str(len(outputs))+' outputs missing, e.g. '+missing[0]
+    else:
+        manifest['stages'][stage['name']] = {'key':key,'outputs':outputs}
+        return ''
+    manifest['stages'].pop(stage['name'],None)
+    return failed
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       ssr_tiles.py
+# AUTHOR:       Collin Bode, UC Berkeley
+#               based on ssr_lidar.py
+# PURPOSE:      Bookkeeping for LiDAR point cloud tiles.
+#               Tile index: a sidecar file (ssr_tileindex.json) in each input
+#               directory with the bounds (n,s,e,w,b,t) and point count of
+#               every tile, keyed by file name, size and mtime. Entries are
+#               filled as tiles are binned (or from the .las header), so
+#               reruns of ssr_lidar.py never scan a file just for bounds.
+#               Tile manifest: kept next to the point density rasters. Records
+#               the content hash, bounds and the mosaic window of every tile,
+#               so a rerun only re-bins changed tiles and patches their windows.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import json
+import hashlib
+from ssr_points import is_las, las_header, windows_intersect
+
+index_name = 'ssr_tileindex.json'
+manifest_name = 'ssr_lidar_manifest'
+
+
+###############################################################
+#
+#   TILE INDEX
+#
+###############################################################
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_size,st.st_mtime
+
+def index_load(inDir):
+    path = os.path.join(inDir,index_name)
+    if(os.path.exists(path) == False):
+        return {}
+    f = open(path,'r')
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}   # damaged index, rebuilt as tiles are read
+    finally:
+        f.close()
+
+def index_save(inDir,index):
+    # returns False if the directory is read only. The index is then rebuilt every run.
+    path = os.path.join(inDir,index_name)
+    try:
+        f = open(path+'.tmp','w')
+        try:
+            json.dump(index,f,indent=1,sort_keys=True)
+        finally:
+            f.close()
+        os.rename(path+'.tmp',path)
+    except (IOError,OSError):
+        return False
+    return True
+
+def index_get(index,path):
+    # entry for the tile, or None if missing or the file changed since it was indexed
+    entry = index.get(os.path.basename(path))
+    if(entry is None):
+        return None
+    size,mtime = file_stamp(path)
+    if(entry['size'] != size or entry['mtime'] != mtime):
+        return None
+    return entry
+
+def index_put(index,path,bounds,npoints):
+    size,mtime = file_stamp(path)
+    index[os.path.basename(path)] = {'size':size,'mtime':mtime,
+                                     'bounds':[float(b) for b in bounds],'npoints':int(npoints)}
+
+def indexes_load(tiles):
+    # one index per input directory, tiles as returned by ssr_points.point_tiles
+    indexes = {}
+    for tilepath,tile,prefs in tiles:
+        inDir = os.path.dirname(tilepath)
+        if(inDir not in indexes):
+            indexes[inDir] = index_load(inDir)
+    return indexes
+
+def indexes_save(indexes):
+    # returns the directories that could not be written
+    failed = []
+    for inDir,index in indexes.items():
+        if(index_save(inDir,index) == False):
+            failed.append(inDir)
+    return failed
+
+def tile_bounds(indexes,path):
+    # n,s,e,w,b,t of a tile from the index. A .las header is read (not its points) when missing.
+    index = indexes[os.path.dirname(path)]
+    entry = index_get(index,path)
+    if(entry is None and is_las(path) and path.lower().endswith('.las')):
+        h = las_header(path)
+        index_put(index,path,h['bounds'],h['count'])
+        entry = index_get(index,path)
+    if(entry is None):
+        return None
+    return entry['bounds']
+
+
+###############################################################
+#
+#   TILE MANIFEST
+#
+###############################################################
+
+def file_md5(path):
+    h = hashlib.md5()
+    f = open(path,'rb')
+    try:
+        while True:
+            block = f.read(8*1024*1024)
+            if(not block):
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def manifest_load(path):
+    if(os.path.exists(path) == False):
+        return {'settings':None,'tiles':{}}
+    f = open(path,'r')
+    try:
+        return json.load(f)
+    except ValueError:
+        return {'settings':None,'tiles':{}}
+    finally:
+        f.close()
+
+def manifest_save(path,manifest):
+    f = open(path+'.tmp','w')
+    try:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    finally:
+        f.close()
+    os.rename(path+'.tmp',path)
+
+def manifest_settings(**settings):
+    # settings as they read back from json, so they compare equal to a loaded manifest
+    return json.loads(json.dumps(settings))
+
+def tile_entry(manifest,path):
+    # manifest entry with a current content hash. Files whose size and mtime did not
+    # change keep their recorded hash, everything else is hashed again.
+    size,mtime = file_stamp(path)
+    old = manifest['tiles'].get(path)
+    if(old is not None and old['size'] == size and old['mtime'] == mtime):
+        md5 = old['md5']
+    else:
+        md5 = file_md5(path)
+    return {'size':size,'mtime':mtime,'md5':md5,'bounds':None,'windows':{}}
+
+def tile_changed(manifest,path,entry):
+    old = manifest['tiles'].get(path)
+    return old is None or old['md5'] != entry['md5']
+
+def tiles_replay(paths,manifest,binned,affected):
+    # Tiles to write again after the affected windows of the mosaics were cleared, in tile order:
+    # the tiles binned already (new or changed, binned = their numbers) and every other tile whose
+    # recorded window meets an affected one. paths: tile files in tile order. affected: {layer: [windows]}.
+    replay = []
+    for t,path in enumerate(paths):
+        if(t in binned):
+            replay.append(t)
+            continue
+        for layer,win in manifest['tiles'][path]['windows'].items():
+            if(win is not None and layer in affected and any([windows_intersect(win,a) for a in affected[layer]])):
+                replay.append(t)
+                break
+    return replay
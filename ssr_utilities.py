@@ -20,9 +20,12 @@ import re
 import shutil
 import platform
 import datetime as dt
+import numpy
 import grass.script as grass
 import grass.script.setup as gsetup
+import grass.script.array as garray
 from ssr_params import *
+from ssr_stages import lpi_month
 
 ###############################################################
 #
@@ -78,6 +81,61 @@ def raster_exists(raster,mapset):
            booexists = True
     return booexists
 
+# null value used to pass NaN cells through r.in.bin / r.out.bin
+nullval = -9999.0
+
+def raster_new():
+    # NaN (null) filled float32 array over the current region, memory mapped to a GRASS temp file
+    a = garray.array(dtype=numpy.float32)
+    a.fill(numpy.nan)
+    return a
+
+def raster_write(data,raster,ow):
+    # write a numpy array (NaN = null) as FCELL raster. Array must match the current region.
+    # Arrays from raster_new() are written in place, without a copy. Nulls are set strip by strip.
+    if(isinstance(data,garray.array) and data.dtype == numpy.float32):
+        out = data
+    else:
+        out = garray.array(dtype=numpy.float32)
+        out[...] = data
+    for row in range(0,out.shape[0],1024):
+        strip = out[row:row+1024]
+        strip[numpy.isnan(strip)] = nullval
+    out.write(raster,null=nullval,overwrite=ow)
+
+def raster_load(raster):
+    # like raster_read, but into a memory mapped array that raster_write can write back in place
+    a = garray.array(dtype=numpy.float32)
+    a.read(raster,null=nullval)
+    for row in range(0,a.shape[0],1024):
+        strip = a[row:row+1024]
+        strip[strip == nullval] = numpy.nan
+    return a
+
+def raster_file(raster,mapset):
+    # path of the raster's data file, None if the map does not exist
+    for element in ['fcell','cell']:
+        path = gisdbase+os.sep+location+os.sep+mapset+os.sep+element+os.sep+raster
+        if(os.path.exists(path)):
+            return path
+    return None
+
+def raster_stamp(raster,mapset):
+    # size and mtime of the raster's data file. Cheap test of whether a map was rewritten.
+    path = raster_file(raster,mapset)
+    if(path is None):
+        return None
+    st = os.stat(path)
+    return [st.st_size,st.st_mtime]
+
+def raster_read(raster):
+    # read a raster over the current region into a float32 numpy array (null = NaN)
+    a = garray.array(dtype=numpy.float32)
+    a.read(raster,null=nullval)
+    data = numpy.array(a)
+    data[data == nullval] = numpy.nan
+    del a
+    return data
 		
 ###############################################################
 #
@@ -150,9 +208,16 @@ def copy_fromtemp(cores,mapset_to,suffixes,overwrite,bregion,C,lf):  # OUTSIDE
                 raster_list = grass.list_pairs(type = 'rast')
                 # Switch to target mapset and copy rasters over
                 grass.run_command("g.mapset", mapset=mapset_to,quiet=0)
+                # a raster matching several filters is moved (or copied) once
+                done = set()
                 for regfilter in suffixes:
                         for rast in raster_list:
-                                if(rast[1] != 'PERMANENT' and re.search(regfilter,rast[0])):
+                                if(rast[1] != 'PERMANENT' and rast[0] not in done and re.search(regfilter,rast[0])):
+                                        done.add(rast[0])
+                                        # the temp mapset is removed afterwards: move the files, copy only if that fails
+                                        if(raster_move(rast[0],rast[1],mapset_to,overwrite)):
+                                                printout("moved "+rast[0]+"@"+rast[1]+" to "+mapset_to,lf)
+                                                continue
                                         old = rast[0]+ '@' + rast[1]
                                         new = rast[0]
                                         cmd = old+","+new
@@ -176,6 +241,51 @@ def copy_mapset(mapset_from,mapset_to,regfilter,overwrite,lf):      # OUTSIDE
                         grass.run_command("g.copy", rast=cmd, overwrite=overwrite)
 
 
+# files and directories of a raster map, one per element directory of the mapset (as g.remove rast=)
+raster_elements = ['cellhd','cell','fcell','cats','colr','hist','cell_misc','g3dcell']
+
+def raster_element_paths(raster,mapset):
+    # paths of every element a raster can have in its mapset. The secondary colour table
+    # colr2/<mapset>/<raster> overrides colr, so it goes with the map.
+    base = gisdbase+os.sep+location+os.sep+mapset+os.sep
+    paths = [base+element+os.sep+raster for element in raster_elements]
+    return paths + [base+'colr2'+os.sep+mapset+os.sep+raster]
+
+def raster_move(raster,mapset_from,mapset_to,overwrite):           # OUTSIDE
+    # moves a raster to another mapset of the location by renaming its element files, no copy.
+    # Returns False, changing nothing, when it can not: missing or reclass map, target exists
+    # and no overwrite, or the mapsets are on different file systems. Use g.copy then.
+    loc = gisdbase+os.sep+location+os.sep
+    src = loc+mapset_from+os.sep
+    dst = loc+mapset_to+os.sep
+    header = src+'cellhd'+os.sep+raster
+    if(os.path.exists(header) == False or os.path.isdir(dst) == False):
+        return False
+    f = open(header,'r')
+    try:
+        if(f.readline().startswith('reclass')):
+            return False
+    finally:
+        f.close()
+    if(os.path.exists(dst+'cellhd'+os.sep+raster) and not overwrite):
+        return False
+    if(os.stat(src).st_dev != os.stat(dst).st_dev):
+        return False
+    # old target first, so no element of it (colour tables included) is left next to the new map
+    sources = raster_element_paths(raster,mapset_from)
+    targets = raster_element_paths(raster,mapset_to)
+    for target in targets:
+        if(os.path.isdir(target)):
+            shutil.rmtree(target)
+        elif(os.path.exists(target)):
+            os.remove(target)
+    for source,target in zip(sources,targets):
+        if(os.path.exists(source)):
+            if(os.path.isdir(os.path.dirname(target)) == False):
+                os.makedirs(os.path.dirname(target))
+            os.rename(source,target)
+    return True
+
 def mapset_gotocreate_outside(mapset,bregion,C,lf):            # OUTSIDE
     gsetup.init(gisbase, gisdbase, location, 'PERMANENT')
     mapset_gotocreate(mapset,bregion,C,lf)
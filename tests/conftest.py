@@ -0,0 +1,58 @@
+############################################################################
+#
+# MODULE:       tests/conftest.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      Shared fixtures of the numpy tests. The ssr_*.py modules live
+#               in the repository root, next to this directory.
+#               Run with: python -m pytest tests   (no GRASS needed)
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import sys
+import struct
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_las(filename,fmt,points):
+    # LAS 1.4 file of point format 1 or 6, points = [(x,y,z,flags,cls)], scale 0.01.
+    # flags is byte 15 (format 1: class in bits 0-4, withheld 0x80;
+    # format 6: classification flags, withheld 0x04, overlap 0x08), cls byte 16 for format 6.
+    reclen = {1:28,6:30}[fmt]
+    head = bytearray(375)
+    head[0:4] = b'LASF'
+    head[24:26] = struct.pack('<BB',1,4)
+    head[94:96] = struct.pack('<H',375)
+    head[96:100] = struct.pack('<I',375)
+    head[104:107] = struct.pack('<BH',fmt,reclen)
+    head[131:179] = struct.pack('<6d',0.01,0.01,0.01,0.0,0.0,0.0)
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    zs = [p[2] for p in points]
+    head[179:227] = struct.pack('<6d',max(xs),min(xs),max(ys),min(ys),max(zs),min(zs))
+    head[247:255] = struct.pack('<Q',len(points))
+    recs = bytearray()
+    for x,y,z,flags,cls in points:
+        rec = bytearray(reclen)
+        rec[0:12] = struct.pack('<3i',int(round(x*100)),int(round(y*100)),int(round(z*100)))
+        rec[15] = flags
+        if(fmt >= 6):
+            rec[16] = cls
+        recs += rec
+    f = open(filename,'wb')
+    try:
+        f.write(bytes(head+recs))
+    finally:
+        f.close()
+    return filename
+
+@pytest.fixture
+def las_file():
+    return write_las
@@ -0,0 +1,71 @@
+############################################################################
+#
+# MODULE:       tests/test_linke.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_linke.py: the numpy spline against linke_interp() as it
+#               was in ssr_rsun.py (SciPy interp1d kind='cubic'), and the
+#               CSV series.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import numpy
+import pytest
+from ssr_linke import *
+
+
+def linke_interp(day,linke_data):
+    # the old ssr_rsun.linke_interp, monthly values passed in
+    interpolate = pytest.importorskip('scipy.interpolate')
+    linke_data = numpy.array(linke_data)
+    linke_data_wrap = numpy.concatenate((linke_data[9:12],linke_data,linke_data[0:3]))
+    monthDays = numpy.array([0,31,28,31,30,31,30,31,31,30,31,30,31])
+    midmonth_day = numpy.array([0,0,0,0,0,0,0,0,0,0,0,0])
+    for i in range(1,12+1):
+        midmonth_day[i-1] = 15 + sum(monthDays[0:i])
+    midmonth_day_wrap = numpy.concatenate((midmonth_day[9:12]-365,midmonth_day,midmonth_day[0:3]+365))
+    linke = interpolate.interp1d(midmonth_day_wrap,linke_data_wrap,kind='cubic')
+    return linke(day)
+
+@pytest.mark.parametrize('name',sorted(linke_monthly.keys()))
+def test_spline_matches_interp1d(name):
+    days = numpy.arange(1,367)
+    old = linke_interp(days,linke_monthly[name])
+    numpy.testing.assert_allclose(linke_table(name)[1:],old,rtol=0,atol=1e-9)
+    assert abs(linke_day(172,name) - old[171]) < 1e-9
+
+def test_spline_of_any_points():
+    interpolate = pytest.importorskip('scipy.interpolate')
+    xs = numpy.array([0.0,1.0,2.5,4.0,7.0,8.0])
+    ys = numpy.array([1.0,-2.0,0.5,3.0,2.0,-1.0])
+    x = numpy.linspace(0.0,8.0,81)
+    old = interpolate.interp1d(xs,ys,kind='cubic')(x)
+    numpy.testing.assert_allclose(numpy.dot(spline_weights(xs,x),ys),old,rtol=0,atol=1e-9)
+
+def test_weights_pass_through_the_midmonth_days():
+    W = linke_weights()
+    assert W.shape == (367,12)
+    numpy.testing.assert_allclose(W.sum(axis=1),1.0,atol=1e-12)
+    numpy.testing.assert_allclose(W[46],numpy.eye(12)[1],atol=1e-12)     # Feb 15
+
+def test_unknown_series_is_the_default():
+    numpy.testing.assert_array_equal(linke_table('nosuchseries'),linke_table('default'))
+
+def test_csv_monthly_and_daily(tmpdir):
+    monthly = tmpdir.join('monthly.csv')
+    monthly.write('month,linke\n'+''.join(['%d,%s\n' % (m+1,v) for m,v in enumerate(linke_monthly['helios'])]))
+    numpy.testing.assert_allclose(linke_table(str(monthly)),linke_table('helios'))
+    daily = tmpdir.join('daily.csv')
+    daily.write('# one value a day\n'+''.join(['%d;%.3f\n' % (d,2.0+d/1000.0) for d in range(1,366)]))
+    table = linke_table(str(daily))
+    assert abs(table[1] - 2.001) < 1e-12
+    assert abs(table[365] - 2.365) < 1e-12
+    assert table[366] == table[365]
+    bad = tmpdir.join('bad.csv')
+    bad.write('1\n2\n3\n')
+    with pytest.raises(ValueError):
+        linke_csv(str(bad))
@@ -0,0 +1,142 @@
+############################################################################
+#
+# MODULE:       tests/test_neighbors.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_neighbors.py: the three neighborhood sum methods against
+#               a cell by cell r.neighbors method=sum, and the LPI strips
+#               against one pass over the whole region.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import numpy
+import pytest
+from ssr_neighbors import *
+
+scriptPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))+os.sep
+
+
+def density(shape,seed=1):
+    # point counts with scattered nulls and a null block wider than the windows
+    rng = numpy.random.RandomState(seed)
+    data = rng.randint(0,20,shape).astype(numpy.float64)
+    data[rng.uniform(size=shape) < 0.2] = numpy.nan
+    data[5:30,40:70] = numpy.nan
+    return data
+
+def rneighbors_sum(data,w):
+    # r.neighbors method=sum weight=w, one cell at a time: nulls are skipped, cells outside
+    # the region are null, and a cell is null only when its whole window is null
+    h = w.shape[0]//2
+    rows,cols = data.shape
+    out = numpy.empty((rows,cols))
+    for i in range(rows):
+        for j in range(cols):
+            total = 0.0
+            seen = False
+            for a in range(-h,h+1):
+                for b in range(-h,h+1):
+                    if(0 <= i+a < rows and 0 <= j+b < cols and not numpy.isnan(data[i+a,j+b])):
+                        seen = True
+                        total += w[a+h,b+h]*data[i+a,j+b]
+            out[i,j] = total if seen else numpy.nan
+    return out
+
+def kernels():
+    rng = numpy.random.RandomState(2)
+    ragged = rng.randint(0,4,(5,5)).astype(numpy.float64)     # weights 0-3, holes included
+    yy,xx = numpy.mgrid[-7:8,-7:8]
+    gauss = numpy.exp(-(xx**2+yy**2)/18.0)
+    return {'box9w1':kernel_box(9,1),'box9w4':kernel_box(9,4),'ragged':ragged,'gauss':gauss}
+
+@pytest.fixture(scope='module')
+def data():
+    return density((40,90))
+
+@pytest.fixture(scope='module')
+def reference(data):
+    return dict([(name,rneighbors_sum(data,w)) for name,w in kernels().items()])
+
+
+def test_kernel_box_matches_the_weight_files():
+    for weight in [1,2,3,4]:
+        w = weight_read(scriptPath+'lpi_box18x18_weight'+str(weight)+'.txt')
+        numpy.testing.assert_array_equal(kernel_box(17,weight),w)
+
+def test_kernel_rects_cover_the_kernel():
+    for name,w in kernels().items():
+        rebuilt = numpy.zeros(w.shape)
+        for r0,r1,c0,c1,v in kernel_rects(w):
+            assert (rebuilt[r0:r1,c0:c1] == 0).all()
+            rebuilt[r0:r1,c0:c1] = v
+        numpy.testing.assert_array_equal(rebuilt,w)
+
+@pytest.mark.parametrize('method',['sat','direct','fft'])
+@pytest.mark.parametrize('name',['box9w1','box9w4','ragged','gauss'])
+def test_sum_matches_rneighbors(data,reference,method,name):
+    w = kernels()[name]
+    out = neighbor_sum(sat_new(data,8),w,method)
+    ref = reference[name]
+    numpy.testing.assert_array_equal(numpy.isnan(out),numpy.isnan(ref))
+    assert numpy.isnan(ref).any()
+    numpy.testing.assert_allclose(out[~numpy.isnan(ref)],ref[~numpy.isnan(ref)],rtol=1e-9,atol=1e-9)
+
+def test_whole_counts_are_exact(data,reference):
+    # point counts with 0/1 weights: every method gives the same whole numbers
+    w = kernels()['box9w4']
+    ref = reference['box9w4']
+    for method in ['sat','direct','fft']:
+        out = neighbor_sum(sat_new(data,8),w,method)
+        numpy.testing.assert_array_equal(out,ref)
+
+def test_kernel_method_picks_the_cheapest():
+    assert kernel_method(kernel_box(17,1)) == 'sat'
+    assert kernel_method(numpy.eye(3)) == 'direct'      # 3 weights, but 3 rectangles
+    assert kernel_method(kernels()['gauss']) == 'fft'
+
+def test_lpi_ratio_nulls_and_clamp():
+    filt = numpy.array([1.0,2.0,numpy.nan,3.0])
+    unf = numpy.array([4.0,0.0,5.0,2.0])
+    lpi = lpi_ratio(filt,unf,'')
+    assert lpi[0] == 0.25
+    assert numpy.isnan(lpi[1]) and numpy.isnan(lpi[2])
+    assert lpi[3] == 1.0
+
+
+###############################################################
+#   STRIPS
+###############################################################
+
+def test_strip_rows_at_least_two_pads():
+    assert strip_rows((1000,1000),8,1,4) == 16
+    assert strip_rows((10,1000),8,1,4) == 10
+    assert strip_rows((1000,100),8,1024,1) == 1000
+
+@pytest.mark.parametrize('cores',[1,2])
+def test_strips_match_the_whole_region(tmpdir,cores):
+    shape = (61,90)
+    filt = density(shape,seed=3)
+    unf = filt + density(shape,seed=4)
+    filtpath = str(tmpdir.join('filt.raw'))
+    unfpath = str(tmpdir.join('unf.raw'))
+    filt.astype(numpy.float32).tofile(filtpath)
+    unf.astype(numpy.float32).tofile(unfpath)
+    ws = [kernel_box(17,1),kernel_box(17,3)]
+    outpaths = []
+    for k in range(len(ws)):
+        outpaths.append(str(tmpdir.join('lpi'+str(k)+'.raw')))
+        numpy.zeros(shape,dtype=numpy.float32).tofile(outpaths[k])
+    # a memory budget this small gives strips of 2*pad = 16 rows
+    done = list(lpi_strips(filtpath,unfpath,shape,ws,'yr4',outpaths,memory=0.1,cores=cores))
+    assert len(done) == 4
+    f32 = filt.astype(numpy.float32).astype(numpy.float64)
+    u32 = unf.astype(numpy.float32).astype(numpy.float64)
+    for w,outpath in zip(ws,outpaths):
+        whole = lpi_ratio(neighbor_sum(sat_new(f32,8),w),neighbor_sum(sat_new(u32,8),w),'yr4').astype(numpy.float32)
+        strips = numpy.fromfile(outpath,dtype=numpy.float32).reshape(shape)
+        numpy.testing.assert_array_equal(strips,whole)
@@ -0,0 +1,272 @@
+############################################################################
+#
+# MODULE:       tests/test_points.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_points.py: LAS reading, binning and the per cell
+#               statistics against a point by point reference.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import time
+import numpy
+import pytest
+from ssr_points import *
+
+north = 1000.0
+west = 500.0
+res = 2.0
+
+
+def random_points(n,seed=1):
+    rng = numpy.random.RandomState(seed)
+    x = west + rng.uniform(0.0,40.0,n)
+    y = north - rng.uniform(0.0,30.0,n)
+    z = rng.uniform(100.0,160.0,n)
+    return x,y,z
+
+def naive_cells(x,y,z):
+    # {(row,col): [z]} one point at a time, as r.in.xyz bins them
+    cells = {}
+    for xi,yi,zi in zip(x,y,z):
+        r = int(numpy.floor((north - yi)/res))
+        c = int(numpy.floor((xi - west)/res))
+        cells.setdefault((r,c),[]).append(zi)
+    return cells
+
+def cell_values(grid,stat):
+    # {(row,col): value} of the cells holding points, rows and cols of the region
+    out = grid_stat(grid,stat)
+    values = {}
+    for r,c in zip(*numpy.nonzero(grid['count'])):
+        values[(r+grid['row0'],c+grid['col0'])] = out[r,c]
+    return values
+
+def binned(x,y,z,stats,nchunks=1):
+    grid = grid_new(north,west,res,stats)
+    for part in numpy.array_split(numpy.arange(x.size),nchunks):
+        grid_add(grid,x[part],y[part],z[part])
+    return grid
+
+
+###############################################################
+#   LAS
+###############################################################
+
+def test_las_format6_withheld_and_overlap(las_file,tmpdir):
+    # withheld points are dropped, overlap points kept, ground from the classification byte
+    path = las_file(str(tmpdir.join('f6.las')),6,[(1.0,2.0,3.0,0x00,2),(4.0,5.0,6.0,0x04,2),(7.0,8.0,9.0,0x08,5)])
+    got = [(list(x),list(g)) for x,y,z,g in read_las(path)]
+    assert got == [([1.0,7.0],[True,False])]
+
+def test_las_format1_withheld(las_file,tmpdir):
+    path = las_file(str(tmpdir.join('f1.las')),1,[(1.0,2.0,3.0,0x02,0),(4.0,5.0,6.0,0x82,0),(7.0,8.0,9.0,0x05,0)])
+    got = [(list(x),list(g)) for x,y,z,g in read_las(path)]
+    assert got == [([1.0,7.0],[True,False])]
+
+def test_las_header_bounds(las_file,tmpdir):
+    path = las_file(str(tmpdir.join('b.las')),6,[(1.0,2.0,3.0,0,2),(4.0,8.0,6.0,0,2)])
+    h = las_header(path)
+    assert h['count'] == 2
+    assert h['bounds'] == [8.0,2.0,4.0,1.0,3.0,6.0]
+
+
+###############################################################
+#   BINNING
+###############################################################
+
+def test_stats_match_naive():
+    x,y,z = random_points(3000)
+    grid = binned(x,y,z,['n','min','max','mean'],nchunks=3)
+    cells = naive_cells(x,y,z)
+    count = cell_values(grid,'n')
+    zmin = cell_values(grid,'min')
+    zmax = cell_values(grid,'max')
+    zmean = cell_values(grid,'mean')
+    assert sorted(count.keys()) == sorted(cells.keys())
+    for cell,zs in cells.items():
+        assert count[cell] == len(zs)
+        assert abs(zmin[cell] - min(zs)) < 1e-4
+        assert abs(zmax[cell] - max(zs)) < 1e-4
+        assert abs(zmean[cell] - sum(zs)/len(zs)) < 1e-4
+    assert grid['npoints'] == x.size
+    assert grid['bounds'] == [y.max(),y.min(),x.max(),x.min(),z.min(),z.max()]
+
+def test_empty_cells_are_null():
+    x = numpy.array([west+1.0,west+9.0])
+    y = numpy.array([north-1.0,north-1.0])
+    z = numpy.array([5.0,6.0])
+    grid = binned(x,y,z,['n','max'])
+    assert grid['count'].shape == (1,5)
+    assert list(numpy.isnan(grid_max(grid))[0]) == [False,True,True,True,False]
+    assert list(numpy.isnan(grid_count(grid))[0]) == [False,True,True,True,False]
+
+def test_chunks_do_not_change_the_grids():
+    x,y,z = random_points(2000,seed=2)
+    one = binned(x,y,z,['n','min','max','mean'])
+    many = binned(x,y,z,['n','min','max','mean'],nchunks=7)
+    for stat in ['n','min','max','mean']:
+        numpy.testing.assert_array_equal(grid_stat(one,stat),grid_stat(many,stat))
+
+def test_grid_reserve_keeps_the_window():
+    x,y,z = random_points(500,seed=3)
+    grid = grid_new(north,west,res)
+    grid_reserve(grid,[north,north-30.0,west+40.0,west])
+    shape = grid['count'].shape
+    grid_add(grid,x,y,z)
+    assert grid['count'].shape == shape
+    assert grid_edges(grid) == (north,north-32.0,west+42.0,west)
+
+def test_cache_gives_the_same_grids(tmpdir):
+    x,y,z = random_points(1000,seed=4)
+    path = str(tmpdir.join('t1.xyz'))
+    numpy.savetxt(path,numpy.column_stack((x,y,z)),fmt='%.3f',delimiter=',')
+    cachedir = str(tmpdir.join('cache'))
+    frames = [(north,west,res),(north,west,(4.0,4.0))]
+    plain = bin_tile(path,['all'],frames)
+    first = bin_tile(path,['all'],frames,cachedir=cachedir)
+    assert cache_valid(cachedir,path,asprs_ground)
+    again = bin_tile(path,['all'],frames,cachedir=cachedir)
+    for grids in [first,again]:
+        for k in range(len(frames)):
+            for stat in default_stats:
+                numpy.testing.assert_array_equal(grid_stat(grids['all'][k],stat),grid_stat(plain['all'][k],stat))
+
+def test_bin_tiles_keeps_the_job_order(tmpdir):
+    jobs = []
+    for t in range(5):
+        x,y,z = random_points(200+100*t,seed=10+t)
+        path = str(tmpdir.join('t'+str(t)+'.xyz'))
+        numpy.savetxt(path,numpy.column_stack((x,y,z)),fmt='%.3f',delimiter=',')
+        jobs.append((path,['all'],[(north,west,res)],',',asprs_ground,None,'',None))
+    serial = [grids['all'][0]['npoints'] for grids in bin_tiles(jobs,1)]
+    pooled = [grids['all'][0]['npoints'] for grids in bin_tiles(jobs,2,inflight=2)]
+    assert serial == [200,300,400,500,600]
+    assert pooled == serial
+
+
+###############################################################
+#   PERCENTILES: exact (as numpy.percentile, to 1 mm in float32)
+#   while the percentile lies in the upper half of the kept tail,
+#   (count-1)*(1-p) <= sketch_tail/2-2. Denser cells: within 3
+#   ranks of the thinning weight w, and 0.5 m on canopy heights.
+###############################################################
+
+def canopy_heights(n,seed):
+    # gamma shaped heights, std about 14 m, as the canopy returns of a cell
+    return numpy.random.RandomState(seed).gamma(2.0,10.0,n).astype(numpy.float32)
+
+def one_cell(z,stats,nchunks=1):
+    x = numpy.empty(z.size)
+    x.fill(west+0.5)
+    y = numpy.empty(z.size)
+    y.fill(north-0.5)
+    return binned(x,y,z,stats,nchunks)
+
+def rank_error(z,p,value):
+    # ranks between value and the exact percentile, (n-1)*p in the sorted heights
+    zs = numpy.sort(z.astype(numpy.float64))
+    lo = numpy.searchsorted(zs,value,'left')
+    hi = numpy.searchsorted(zs,value,'right')
+    h = (z.size-1)*p
+    return max(0.0,lo-h,h-hi)
+
+def test_percentiles_exact_per_cell():
+    # cells of 1 to 1241 points, read in 5 chunks
+    rng = numpy.random.RandomState(8)
+    counts = [1,2,3,10,33,100,300,1000,1241]
+    x = []
+    y = []
+    z = []
+    for k,n in enumerate(counts):
+        x.append(west + 2.0*k + rng.uniform(0.0,res,n))
+        y.append(north - rng.uniform(0.0,res,n))
+        z.append(canopy_heights(n,k))
+    order = rng.permutation(sum(counts))
+    x = numpy.concatenate(x)[order]
+    y = numpy.concatenate(y)[order]
+    z = numpy.concatenate(z)[order]
+    grid = binned(x,y,z,['p5','p95','p99'],nchunks=5)
+    cells = naive_cells(x,y,z)
+    for stat,p in [('p5',5),('p95',95),('p99',99)]:
+        values = cell_values(grid,stat)
+        for cell,zs in cells.items():
+            assert abs(values[cell] - numpy.percentile(numpy.array(zs,dtype=numpy.float64),p)) < 1e-3
+
+@pytest.mark.parametrize('n',[100,300,1000,6201])
+def test_p95_p99_exact_single_cell(n):
+    z = canopy_heights(n,n)
+    for nchunks in [1,9]:
+        grid = one_cell(z,['p95','p99'],nchunks)
+        if(n <= 1241):
+            assert abs(grid_stat(grid,'p95')[0,0] - numpy.percentile(z.astype(numpy.float64),95)) < 1e-3
+        assert abs(grid_stat(grid,'p99')[0,0] - numpy.percentile(z.astype(numpy.float64),99)) < 1e-3
+
+@pytest.mark.parametrize('n',[3000,20000,200000])
+def test_dense_cells_within_tolerance(n):
+    for seed in range(3):
+        z = canopy_heights(n,seed)
+        for nchunks in [1,7,20]:
+            start = time.time()
+            grid = one_cell(z,['p5','p95','p99'],nchunks)
+            assert time.time() - start < 5.0
+            for stat,p in [('p5',0.05),('p95',0.95),('p99',0.99)]:
+                value = grid_stat(grid,stat)[0,0]
+                w = 2**int(grid['l'+stat][0,0])
+                assert rank_error(z,p,value) <= 3*w
+                if(nchunks <= 7 and n >= 20000):
+                    assert abs(value - numpy.percentile(z.astype(numpy.float64),100*p)) < 0.5
+
+def test_percentile_names():
+    assert stat_quantile('p95') == 0.95
+    assert abs(stat_quantile('p99.9') - 0.999) < 1e-12
+    assert stat_prefix('p99') == 'p99' and stat_prefix('max') == 'pmax'
+    for bad in ['q95','p100','p0','pxx']:
+        with pytest.raises(ValueError):
+            stat_quantile(bad)
+
+
+###############################################################
+#   MOSAIC
+###############################################################
+
+def test_mosaic_first_tile_wins():
+    # two tiles over the same cells: the first one written keeps them, as r.patch
+    mosaic = numpy.empty((15,20),dtype=numpy.float32)
+    mosaic.fill(numpy.nan)
+    x1,y1,z1 = random_points(400,seed=5)
+    x2,y2,z2 = random_points(400,seed=6)
+    g1 = binned(x1,y1,z1,['max'])
+    g2 = binned(x2,y2,z2,['max'])
+    mosaic_add(mosaic,g1,grid_max(g1))
+    mosaic_add(mosaic,g2,grid_max(g2))
+    first = naive_cells(x1,y1,z1)
+    second = naive_cells(x2,y2,z2)
+    for r in range(15):
+        for c in range(20):
+            if((r,c) in first):
+                assert abs(mosaic[r,c] - max(first[(r,c)])) < 1e-4
+            elif((r,c) in second):
+                assert abs(mosaic[r,c] - max(second[(r,c)])) < 1e-4
+            else:
+                assert numpy.isnan(mosaic[r,c])
+
+def test_mosaic_clips_the_overlap():
+    mosaic = numpy.empty((15,20),dtype=numpy.float32)
+    mosaic.fill(numpy.nan)
+    x,y,z = random_points(2000,seed=7)
+    grid = binned(x,y,z,['n'])
+    edges = grid_clip_edges(grid,grid['bounds'],4.0)
+    win = mosaic_add(mosaic,grid,grid_count(grid),edges)
+    r0,r1,c0,c1 = win
+    assert numpy.isnan(mosaic[:r0]).all() and numpy.isnan(mosaic[r1:]).all()
+    assert numpy.isnan(mosaic[:,:c0]).all() and numpy.isnan(mosaic[:,c1:]).all()
+    # only cells whose centres lie 4 m inside the tile bounds are written
+    n,s,e,w = grid['bounds'][0:4]
+    assert north - (r0+0.5)*res <= n-4.0 and north - (r1-0.5)*res >= s+4.0
+    assert west + (c0+0.5)*res >= w+4.0 and west + (c1-0.5)*res <= e-4.0
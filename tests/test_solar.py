@@ -0,0 +1,202 @@
+############################################################################
+#
+# MODULE:       tests/test_solar.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_solar.py: solar geometry against known values, the
+#               clear-sky engine on a flat unshaded surface against the
+#               scalar model, the packed int16 horizons, and the engine
+#               strips against one pass over the whole region.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import numpy
+import pytest
+from ssr_solar import *
+
+lat = 38.0
+step = 0.5
+hstep = 45.0
+ndir = 8
+
+
+def surface(shape,seed=1):
+    # elevation, slope, aspect, albedo with a few nulls
+    rng = numpy.random.RandomState(seed)
+    f32 = numpy.float32
+    data = {'z':rng.uniform(0.0,1500.0,shape).astype(f32),
+            'slope':rng.uniform(0.0,40.0,shape).astype(f32),
+            'aspect':rng.uniform(0.0,360.0,shape).astype(f32),
+            'alb':numpy.ones(shape,dtype=f32)*f32(0.2)}
+    data['z'][rng.uniform(size=shape) < 0.05] = numpy.nan
+    data['slope'][0,:3] = 0.0
+    return data
+
+def horizons(shape,seed=2):
+    # horizon angles (directions,rows,cols) in radians, a few nulls
+    rng = numpy.random.RandomState(seed)
+    hor = rng.uniform(0.0,0.6,(ndir,)+shape)
+    hor[rng.uniform(size=hor.shape) < 0.05] = numpy.nan
+    return hor
+
+
+###############################################################
+#   GEOMETRY
+###############################################################
+
+def test_declination_at_the_solstices():
+    assert abs(numpy.degrees(solar_declination(172)) - 23.44) < 0.05
+    assert abs(numpy.degrees(solar_declination(355)) + 23.44) < 0.05
+    assert abs(numpy.degrees(solar_declination(80))) < 0.5
+
+def test_sun_distance_near_perihelion_and_aphelion():
+    assert abs(extraterrestrial(3) - 1412.7) < 0.5
+    assert abs(extraterrestrial(185) - 1321.3) < 0.5
+
+def test_sun_overhead_at_noon():
+    decl = solar_declination(172)
+    east,north,up = sun_vector(decl,decl,12.0)
+    assert abs(up - 1.0) < 1e-12 and abs(east) < 1e-12 and abs(north) < 1e-12
+    # morning sun in the east, afternoon in the west
+    assert sun_vector(numpy.radians(lat),decl,9.0)[0] > 0
+    assert sun_vector(numpy.radians(lat),decl,15.0)[0] < 0
+
+
+###############################################################
+#   FLAT SURFACE, NO HORIZON
+###############################################################
+
+@pytest.mark.parametrize('doy',[1,80,172,265])
+def test_flat_surface_without_horizon(doy):
+    shape = (2,3)
+    z = numpy.zeros(shape,dtype=numpy.float32)
+    flat = numpy.zeros(shape,dtype=numpy.float32)
+    alb = numpy.ones(shape,dtype=numpy.float32)*numpy.float32(0.2)
+    linke = 3.0
+    out = clearsky_strip(z,flat,flat,alb,None,hstep,lat,[doy],[linke],step)
+    # the scalar model: beam on the horizontal plane and diffuse, summed over the steps
+    bn,dh,sun = clearsky_day(lat,doy,linke,0.0,step)
+    beam,diff = plane_day(bn,dh,sun,0,0)
+    numpy.testing.assert_allclose(out['beam'][0],beam*step,rtol=1e-5)
+    numpy.testing.assert_allclose(out['diff'][0],diff*step,rtol=1e-5)
+    # no ground in view of a flat plane
+    assert (out['refl'][0] == 0).all()
+    # insolation time is the day length, to a time step
+    decl = solar_declination(doy)
+    length = 24.0/numpy.pi*numpy.arccos(-numpy.tan(numpy.radians(lat))*numpy.tan(decl))
+    assert (numpy.abs(out['dur'][0] - length) <= step).all()
+
+def test_flat_summer_day_magnitude():
+    # clear-sky global irradiation on a horizontal plane at 38N in June: about 8 kWh/m2
+    bn,dh,sun = clearsky_day(lat,172,3.0,0.0,step)
+    beam,diff = plane_day(bn,dh,sun,0,0)
+    assert 7000.0 < (beam + diff)*step < 9000.0
+
+def test_nulls_pass_through():
+    data = surface((4,5))
+    out = clearsky_strip(data['z'],data['slope'],data['aspect'],data['alb'],None,hstep,lat,[172],[3.0],step)
+    for key in out:
+        numpy.testing.assert_array_equal(numpy.isnan(out[key][0]),numpy.isnan(data['z']))
+
+
+###############################################################
+#   PACKED HORIZONS: int16, horizon_scale = 1e-4 radians
+###############################################################
+
+def test_horizon_pack_round_trip(tmpdir):
+    assert horizon_scale == 1.0e-4
+    shape = (5,7)
+    hor = horizons(shape)
+    hor[0,0,0] = numpy.pi/2.0
+    hor[1,0,0] = -0.3
+    pack = horizon_pack_new(str(tmpdir.join('hor.raw')),shape,ndir)
+    for i in range(ndir):
+        horizon_pack_put(pack,i,hor[i])
+    pack.flush()
+    del pack
+    back = numpy.fromfile(str(tmpdir.join('hor.raw')),dtype=numpy.int16).reshape(shape[0],ndir,shape[1]).transpose(1,0,2)
+    nulls = numpy.isnan(hor)
+    assert (back[nulls] == horizon_null).all()
+    assert (back[~nulls] != horizon_null).all()
+    assert (numpy.abs(back[~nulls]*horizon_scale - hor[~nulls]) <= horizon_scale/2.0 + 1e-12).all()
+
+def test_horizon_angle_reads_packed_horizons():
+    shape = (3,4)
+    hor = horizons(shape)
+    hor[numpy.isnan(hor)] = 0.0
+    packed = numpy.round(hor/horizon_scale).astype(numpy.int16)
+    for azimuth in [0.0,30.0,45.0,190.0,350.0]:
+        a = horizon_angle(hor,hstep,azimuth)
+        b = horizon_angle(packed,hstep,azimuth,horizon_scale)
+        assert numpy.abs(a - b).max() <= horizon_scale
+    # halfway between two directions
+    numpy.testing.assert_allclose(horizon_angle(hor,hstep,22.5),(hor[0] + hor[1])/2.0,rtol=1e-6)
+
+def test_null_horizon_is_no_horizon():
+    data = surface((4,5))
+    args = (data['z'],data['slope'],data['aspect'],data['alb'])
+    none = clearsky_strip(*args+(None,hstep,lat,[100,172],[3.0,3.5],step))
+    hor = numpy.empty((ndir,4,5),dtype=numpy.int16)
+    hor.fill(horizon_null)
+    nulls = clearsky_strip(*args+(hor,hstep,lat,[100,172],[3.0,3.5],step,horizon_scale))
+    for key in none:
+        numpy.testing.assert_array_equal(nulls[key],none[key])
+
+def test_high_horizon_blocks_the_beam():
+    data = surface((4,5))
+    hor = numpy.empty((ndir,4,5),dtype=numpy.int16)
+    hor.fill(int(round(1.5/horizon_scale)))
+    out = clearsky_strip(data['z'],data['slope'],data['aspect'],data['alb'],hor,hstep,lat,[172],[3.0],step,horizon_scale)
+    valid = ~numpy.isnan(data['z'])
+    assert (out['beam'][0][valid] == 0).all()
+    assert (out['dur'][0][valid] == 0).all()
+    assert (out['diff'][0][valid] > 0).all()
+
+
+###############################################################
+#   STRIPS
+###############################################################
+
+def test_sun_strip_rows():
+    assert sun_strip_rows((1000,100),8,4,1024,1) == 1000
+    assert sun_strip_rows((1000,100),8,4,0.01,1) == 1
+    rows = sun_strip_rows((1000,100),8,4,1,2)
+    assert 1 < rows < 1000
+
+@pytest.mark.parametrize('cores',[1,2])
+def test_strips_match_the_whole_region(tmpdir,cores):
+    shape = (23,11)
+    days = [100,172]
+    linkes = [3.0,3.5]
+    data = surface(shape,seed=3)
+    hor = horizons(shape,seed=4)
+    inpaths = {}
+    for key in data:
+        inpaths[key] = str(tmpdir.join(key+'.raw'))
+        data[key].tofile(inpaths[key])
+    horpath = str(tmpdir.join('hor.raw'))
+    pack = horizon_pack_new(horpath,shape,ndir)
+    for i in range(ndir):
+        horizon_pack_put(pack,i,hor[i])
+    pack.flush()
+    packed = numpy.ascontiguousarray(numpy.array(pack).transpose(1,0,2))
+    del pack
+    outpaths = {}
+    for doy in days:
+        for key in ['beam','diff','refl','dur']:
+            outpaths[(doy,key)] = str(tmpdir.join(key+str(doy)+'.raw'))
+            numpy.zeros(shape,dtype=numpy.float32).tofile(outpaths[(doy,key)])
+    # a memory budget this small gives strips of a few rows
+    assert sun_strip_rows(shape,ndir,len(days),0.01,cores) < shape[0]//2
+    done = list(sun_strips(inpaths,horpath,ndir,shape,hstep,lat,days,linkes,step,outpaths,memory=0.01,cores=cores))
+    assert len(done) > 1 and sum([r1-r0 for r0,r1 in done]) == shape[0]
+    whole = clearsky_strip(data['z'],data['slope'],data['aspect'],data['alb'],packed,hstep,lat,days,linkes,step,horizon_scale)
+    for j in range(len(days)):
+        for key in whole:
+            strips = numpy.fromfile(outpaths[(days[j],key)],dtype=numpy.float32).reshape(shape)
+            numpy.testing.assert_allclose(strips,whole[key][j],rtol=1e-6,atol=1e-6)
+            numpy.testing.assert_array_equal(numpy.isnan(strips),numpy.isnan(data['z']))
@@ -0,0 +1,161 @@
+############################################################################
+#
+# MODULE:       tests/test_stages.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_stages.py: the stage keys and staleness of ssr_pipeline.py
+#               over a made up set of products. A stage run writes its
+#               outputs with checksums of its key, a crashed one exits 1.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import hashlib
+import pytest
+import ssr_stages
+from ssr_stages import *
+
+
+@pytest.fixture(autouse=True)
+def every_stage_on(monkeypatch):
+    for flag in ['lidar_run','lpi_run','preprocessing_run','horizon_run','rsun_run','algore_run']:
+        monkeypatch.setattr(ssr_stages,flag,1)
+
+def md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def source_products():
+    # products no stage makes (point tiles, source rasters, weight files), as they are on disk
+    stages = pipeline_stages()
+    made = set()
+    for stage in stages:
+        made.update(stage['outputs'])
+    products = {}
+    for stage in stages:
+        for p in stage['inputs']:
+            if(p not in made):
+                products[p] = md5(p)
+    return products
+
+def hashes(products,names):
+    # stub of ssr_pipeline.product_hashes: None for products not there
+    return dict([(p,products.get(p)) for p in names])
+
+def pipeline(manifest,products,crash=None):
+    # the stage loop of ssr_pipeline.main(), returns the stages that ran
+    manifest.setdefault('stages',{})
+    ran = []
+    for stage in pipeline_stages():
+        key = stage_key(stage,hashes(products,stage['inputs']))
+        reason,missing = stage_stale(manifest,stage,key,hashes(products,stage['outputs']))
+        if(reason == ''):
+            continue
+        ran.append(stage['name'])
+        ret = 0
+        if(stage['name'] == crash):
+            ret = 1
+        # the same inputs and parameters make the same content
+        for p in stage['outputs']:
+            products[p] = md5(key+p)
+        if(stage_record(manifest,stage,key,ret,hashes(products,stage['outputs']))):
+            break
+    return ran
+
+names = ['lidar','lpi','preprocessing','horizon','rsun','algore']
+
+
+def test_second_run_skips_everything():
+    manifest = {}
+    products = source_products()
+    assert pipeline(manifest,products) == names
+    assert sorted(manifest['stages']) == sorted(names)
+    assert pipeline(manifest,products) == []
+
+def test_boxsize_reruns_only_lpi_and_algore(monkeypatch):
+    manifest = {}
+    products = source_products()
+    pipeline(manifest,products)
+    monkeypatch.setattr(ssr_stages,'boxsize','25')
+    monkeypatch.setattr(ssr_stages,'lpipref','lpi_c'+C+year+'s25')
+    assert pipeline(manifest,products) == ['lpi','algore']
+    assert pipeline(manifest,products) == []
+
+def test_algore_does_not_rerun_rsun(monkeypatch):
+    manifest = {}
+    products = source_products()
+    pipeline(manifest,products)
+    monkeypatch.setattr(ssr_stages,'algore','pl')
+    assert pipeline(manifest,products) == ['algore']
+
+def test_a_changed_source_reruns_its_stage_and_later_ones():
+    manifest = {}
+    products = source_products()
+    pipeline(manifest,products)
+    products['file:'+scriptPath+'albedo_recode.txt'] = md5('new albedo classes')
+    ran = pipeline(manifest,products)
+    assert ran[0] == 'preprocessing'
+    assert 'lidar' not in ran and 'lpi' not in ran and 'algore' in ran
+
+def test_same_content_does_not_rerun_later_stages(monkeypatch):
+    # forced again, preprocessing writes what it wrote before: r.sun and algore stay current
+    manifest = {}
+    products = source_products()
+    pipeline(manifest,products)
+    monkeypatch.setattr(ssr_stages,'preprocessing_run',2)
+    assert pipeline(manifest,products) == ['preprocessing']
+
+def test_crashed_stage_is_not_recorded():
+    manifest = {}
+    products = source_products()
+    assert pipeline(manifest,products,crash='rsun') == ['lidar','lpi','preprocessing','horizon','rsun']
+    # its outputs are all there, but the exit status was not 0
+    assert 'rsun' not in manifest['stages']
+    assert 'algore' not in manifest['stages']
+    assert pipeline(manifest,products) == ['rsun','algore']
+
+def test_crash_drops_the_record_of_an_earlier_run(monkeypatch):
+    manifest = {}
+    products = source_products()
+    pipeline(manifest,products)
+    monkeypatch.setattr(ssr_stages,'lpi_run',2)
+    assert pipeline(manifest,products,crash='lpi') == ['lpi']
+    assert 'lpi' not in manifest['stages']
+    monkeypatch.setattr(ssr_stages,'lpi_run',1)
+    assert pipeline(manifest,products) == ['lpi']
+
+def test_missing_outputs_are_not_done():
+    stage = pipeline_stages()[1]
+    manifest = {'stages':{}}
+    outputs = dict([(p,md5(p)) for p in stage['outputs']])
+    outputs[stage['outputs'][-1]] = None
+    assert 'outputs missing' in stage_record(manifest,stage,'key',0,outputs)
+    assert manifest['stages'] == {}
+    assert 'exit status 1' in stage_record(manifest,stage,'key',1,hashes({},[]))
+    outputs[stage['outputs'][-1]] = md5('')
+    assert stage_record(manifest,stage,'key',0,outputs) == ''
+    assert manifest['stages']['lpi'] == {'key':'key','outputs':outputs}
+
+def test_only_missing_rsun_kinds_are_made():
+    stages = pipeline_stages()
+    rsun = stages[4]
+    assert rsun['name'] == 'rsun'
+    manifest = {'stages':{}}
+    outputs = dict([(p,md5(p)) for p in rsun['outputs']])
+    key = stage_key(rsun,hashes(source_products(),rsun['inputs']))
+    stage_record(manifest,rsun,key,0,outputs)
+    lost = [p for p in rsun['outputs'] if p.split('@')[0].endswith('diff')]
+    for p in lost:
+        outputs[p] = None
+    reason,missing = stage_stale(manifest,rsun,key,outputs)
+    assert missing == sorted(lost)
+    assert stage_env(rsun,missing)['SSR_RSUN_OUTPUTS'] == 'diff'
+
+def test_upstream_stages():
+    stages = pipeline_stages()
+    up = dict([(stage['name'],stage_upstream(stages,stage)) for stage in stages])
+    assert up['lidar'] == []
+    assert up['lpi'] == ['lidar']
+    assert up['algore'] == ['lpi','preprocessing','rsun']
@@ -0,0 +1,155 @@
+############################################################################
+#
+# MODULE:       tests/test_tiles.py
+# AUTHOR:       Collin Bode, UC Berkeley
+# PURPOSE:      ssr_tiles.py: tile index, tile manifest, and the incremental
+#               import (patching changed tiles) against a full import.
+#
+# COPYRIGHT:    (c) 2016 Collin Bode
+#               This program is free software under the GNU General Public
+#               License (>=v2). Read the file COPYING that comes with GRASS
+#               for details.
+#
+#############################################################################
+
+import os
+import numpy
+import ssr_tiles
+from ssr_tiles import *
+from ssr_points import grid_new, grid_add, grid_max, mosaic_add, mosaic_window
+
+north = 1000.0
+west = 500.0
+res = 2.0
+shape = (20,40)
+layer = 'all_c2'
+
+
+def touch(path,text,mtime):
+    f = open(path,'w')
+    f.write(text)
+    f.close()
+    os.utime(path,(mtime,mtime))
+    return path
+
+
+###############################################################
+#   TILE INDEX
+###############################################################
+
+def test_index_entry_follows_the_file(tmpdir):
+    path = touch(str(tmpdir.join('t1.xyz')),'1,2,3\n',1000000)
+    index = {}
+    index_put(index,path,[10.0,0.0,20.0,5.0,1.0,3.0],1)
+    assert index_get(index,path)['bounds'] == [10.0,0.0,20.0,5.0,1.0,3.0]
+    os.utime(path,(1000100,1000100))
+    assert index_get(index,path) is None
+
+def test_index_save_and_load(tmpdir):
+    path = touch(str(tmpdir.join('t1.xyz')),'1,2,3\n',1000000)
+    index = {}
+    index_put(index,path,[10.0,0.0,20.0,5.0,1.0,3.0],1)
+    assert index_save(str(tmpdir),index)
+    assert index_load(str(tmpdir)) == index
+    tmpdir.join(index_name).write('{damaged')
+    assert index_load(str(tmpdir)) == {}
+
+def test_tile_bounds_from_the_las_header(tmpdir,las_file):
+    path = las_file(str(tmpdir.join('t1.las')),6,[(1.0,2.0,3.0,0,2),(4.0,8.0,6.0,0,2)])
+    indexes = indexes_load([(path,'t1',['filtered','unfiltered'])])
+    assert tile_bounds(indexes,path) == [8.0,2.0,4.0,1.0,3.0,6.0]
+    assert index_get(indexes[str(tmpdir)],path)['npoints'] == 2
+    assert indexes_save(indexes) == []
+    assert index_load(str(tmpdir)) == indexes[str(tmpdir)]
+
+
+###############################################################
+#   TILE MANIFEST
+###############################################################
+
+def test_unchanged_tiles_are_not_hashed_again(tmpdir,monkeypatch):
+    path = touch(str(tmpdir.join('t1.xyz')),'1,2,3\n',1000000)
+    hashed = []
+    real_md5 = ssr_tiles.file_md5
+    def counting_md5(p):
+        hashed.append(p)
+        return real_md5(p)
+    monkeypatch.setattr(ssr_tiles,'file_md5',counting_md5)
+    manifest = {'settings':None,'tiles':{}}
+    entry = tile_entry(manifest,path)
+    assert tile_changed(manifest,path,entry)
+    manifest['tiles'][path] = entry
+    manifest_save(str(tmpdir.join('m.json')),manifest)
+    manifest = manifest_load(str(tmpdir.join('m.json')))
+    again = tile_entry(manifest,path)
+    assert len(hashed) == 1
+    assert tile_changed(manifest,path,again) == False
+    # rewritten with the same content: hashed again, but not a change
+    touch(path,'1,2,3\n',1000100)
+    assert tile_changed(manifest,path,tile_entry(manifest,path)) == False
+    touch(path,'1,2,4\n',1000200)
+    assert tile_changed(manifest,path,tile_entry(manifest,path))
+    assert len(hashed) == 3
+
+def test_settings_compare_equal_after_a_reload(tmpdir):
+    settings = manifest_settings(region=[[north,west,20,40,res,res]],overlap=0,stats={'all':['n','p95']},dem=None)
+    manifest_save(str(tmpdir.join('m.json')),{'settings':settings,'tiles':{}})
+    assert manifest_load(str(tmpdir.join('m.json')))['settings'] == settings
+    assert manifest_load(str(tmpdir.join('none.json'))) == {'settings':None,'tiles':{}}
+
+
+###############################################################
+#   INCREMENTAL IMPORT: clear the windows of the changed tiles,
+#   replay every tile that can write into them, in tile order.
+#   Must give the mosaic of a full import.
+#
+###############################################################
+
+def tile_points(c0,c1,seed):
+    # points of a tile over columns c0:c1 (cells), all rows
+    rng = numpy.random.RandomState(seed)
+    x = west + rng.uniform(c0*res,c1*res,300)
+    y = north - rng.uniform(0.0,shape[0]*res,300)
+    z = rng.uniform(100.0,160.0,300)
+    return x,y,z
+
+def tile_grid(points):
+    grid = grid_new(north,west,res,['max'])
+    grid_add(grid,*points)
+    return grid
+
+def full_import(paths,points):
+    mosaic = numpy.empty(shape,dtype=numpy.float32)
+    mosaic.fill(numpy.nan)
+    manifest = {'settings':None,'tiles':{}}
+    for path in paths:
+        grid = tile_grid(points[path])
+        win = mosaic_add(mosaic,grid,grid_max(grid))
+        manifest['tiles'][path] = {'windows':{layer:win}}
+    return mosaic,manifest
+
+def test_replay_gives_the_full_import():
+    # four overlapping tiles side by side, the first tile wins where they overlap
+    paths = ['t0','t1','t2','t3']
+    points = {'t0':tile_points(0,12,1),'t1':tile_points(8,22,2),'t2':tile_points(18,32,3),'t3':tile_points(30,40,4)}
+    mosaic,manifest = full_import(paths,points)
+    # t1 changes and shrinks
+    new = dict(points)
+    new['t1'] = tile_points(10,16,5)
+    binned = {1:tile_grid(new['t1'])}
+    affected = {layer:[manifest['tiles']['t1']['windows'][layer],mosaic_window(shape,binned[1])]}
+    for r0,r1,c0,c1 in affected[layer]:
+        mosaic[r0:r1,c0:c1] = numpy.nan
+    replay = tiles_replay(paths,manifest,binned,affected)
+    assert replay == [0,1,2]
+    for t in replay:
+        grid = binned.get(t,tile_grid(new[paths[t]]))
+        mosaic_add(mosaic,grid,grid_max(grid))
+    expected,manifest = full_import(paths,new)
+    numpy.testing.assert_array_equal(mosaic,expected)
+
+def test_replay_skips_tiles_outside_the_windows():
+    paths = ['t0','t1']
+    manifest = {'tiles':{'t0':{'windows':{layer:[0,20,0,10]}},'t1':{'windows':{layer:[0,20,30,40],'other':None}}}}
+    assert tiles_replay(paths,manifest,{},{layer:[[0,20,12,20]]}) == []
+    assert tiles_replay(paths,manifest,{1:None},{layer:[[0,20,5,20]]}) == [0,1]